@@ -15,6 +15,7 @@
 __author__ = 'rew@google.com (Becky Willrich)'
 
 import base_handler
+import cache
 import domains
 import model
 import perms
@@ -199,6 +200,16 @@ class Admin(base_handler.BaseHandler):
         lambda: perms.CheckAccess(perms.Role.DOMAIN_ADMIN, domain_name, user))
 
 
+class CacheStats(base_handler.BaseHandler):
+  """Admin-only JSON endpoint that shows the stats for each named cache."""
+
+  def Get(self):
+    """Writes the cache stats totalled across all instances, as JSON."""
+    perms.AssertAccess(perms.Role.ADMIN)
+    self.WriteJson({'caches': cache.GetStats(),
+                    'local_cache': cache.LOCAL_CACHE.GetStats()})
+
+
 class AdminMap(base_handler.BaseHandler):
   """Administration page for a map."""
 
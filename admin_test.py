@@ -11,10 +11,12 @@
 
 __author__ = 'rew@google.com (Becky Willrich)'
 
+import json
 import time
 import urllib
 
 import admin
+import cache
 import domains
 import model
 import perms
@@ -286,6 +288,18 @@ class AdminDomainTest(test_utils.BaseTest):
                       perms.GetSubjectsForTarget('xyz.com'))
 
 
+class CacheStatsTest(test_utils.BaseTest):
+  def testGet(self):
+    cache.Cache('test', 60).Get('a', lambda: 1)
+    with test_utils.Login('manager'):
+      self.DoGet('/.admin/cache_stats', 403)  # only allowed for ADMIN users
+    with test_utils.RootLogin():
+      response = self.DoGet('/.admin/cache_stats')
+    stats = json.loads(response.body)
+    self.assertEquals(1, stats['caches']['test']['makes'])
+    self.assertGreaterEqual(stats['local_cache']['entries'], 1)
+
+
 class AdminMapTest(test_utils.BaseTest):
   def testNavigate(self):
     with test_utils.RootLogin():
@@ -234,7 +234,7 @@ def CrowdReportFormPost(author, request):
   model.CrowdReport.Create(source=request.root_url, author=author,
                            effective=now, text=text, topic_ids=topic_ids,
                            answers=answers, location=ll)
-  card.InvalidateReportCache(topic_ids, ll)
+  card.InvalidateReportCache(topic_ids)
 
 
 def CrowdReportJsonPost(auth, report_dicts):
@@ -289,12 +289,14 @@ def DictToReport(report, auth, now, spam_check=True):
     except datastore_errors.BadValueError, e:
       return {'id': report_id, 'error': 'Invalid location: %s' % e}
   try:
-    return model.CrowdReport.Create(
+    report = model.CrowdReport.Create(
         id=report_id, source=source, author=author, effective=effective,
         submitted=submitted, text=text, topic_ids=topic_ids, answers=answers,
         location=location, place_id=place_id or None, map_id=map_id or None)
   except (TypeError, ValueError), e:
     return {'id': report_id, 'error': str(e)}
+  card.InvalidateReportCache(topic_ids)
+  return report
 
 
 class CrowdVotes(base_handler.BaseHandler):
@@ -90,6 +90,7 @@ app = webapp2.WSGIApplication([
             Route('/<label>/review', 'map_review.MapReviewByLabel'),
 
             Route('/.admin', 'admin.Admin'),
+            Route('/.admin/cache_stats', 'admin.CacheStats'),
             Route('/.admin/<map_id>', 'admin.AdminMap'),
             Route('/.card/<map_id>.<topic_id>', 'card.CardByIdAndTopic'),
             Route('/.card/<label>', 'card.CardByLabel'),
@@ -127,6 +128,7 @@ app = webapp2.WSGIApplication([
             Route('/.rss2kml', 'rss2kml.Rss2Kml'),
 
             # Tasks executed by cron or taskqueue
+            Route('/.cache_refresh', 'cache_refresh.CacheRefresh'),
             Route('/.metadata_fetch', 'metadata_fetch.MetadataFetch'),
             Route('/.metadata_fetch_log_cleaner',
                   'metadata_fetch.MetadataFetchLogCleaner'),
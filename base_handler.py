@@ -173,6 +173,9 @@ class Error(Exception):
     Exception.__init__(self, message)
     self.status = status
 
+  def __reduce__(self):  # so that cache.Cache can cache these as failures
+    return (self.__class__, (self.status, self.message))
+
 
 class ApiError(Error):
   """An error that carries an HTTP status and a message to emit as text."""
@@ -16,38 +16,145 @@ See cache.Cache() for detailed usage instructions.
 
 To avoid key collisions, don't use memcache directly; use this module.
 (If you must use memcache, use keys produced by calling Cache.KeyToJson.)
+
+Entries can be stored with tags, so that whole groups of entries (e.g. all
+the entries for a map) can be invalidated at once with InvalidateTags().
 """
-# TODO(user):
-# - consider tracking size of local cache.
 # TODO(kpy):
 # - define a simpler GetOnlyCache() that has only a Get() method and no ULL
 # - define a CounterCache() that supports Incr() and Decr()
-# TODO(user):
-# - Use a lock or condition variable to avoid multiple threads within one
-#   instance polling memcache for the same key when no value exists in memcache.
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
 import copy
+import cPickle as pickle
+import hashlib
 import json
 import logging
 import random
+import sys
+import threading
 import time
 
 import local_cache
 import memcache_big as memcache
 
+from google.appengine.api import memcache as raw_memcache
+from google.appengine.api import taskqueue
+
 
 # Value to add to cache keys to prevent collisions if/when the cache entry type
 # changes. Otherwise, modifying the cache entry may break an app that uses an
 # older version of this module.
 CACHE_ENTRY_VERSION = 'v3'
 
-LOCAL_CACHE = local_cache.LocalCache(0)  # key => CacheEntry
+# Budget for the estimated size of all the values in the local RAM cache.
+# Beyond this, the least recently used entries are evicted, so that big values
+# (e.g. KMZ files) can't push an instance over its memory limit.
+LOCAL_CACHE_MAX_BYTES = 32 * 1000 * 1000
+
+LOCAL_CACHE = local_cache.LocalCache(
+    0, max_bytes=LOCAL_CACHE_MAX_BYTES)  # key => CacheEntry
+
+# Memcache keys can't exceed 250 bytes, and memcache_big and the make_value lock
+# add prefixes of up to about 20 bytes to the key JSON, so keys longer than this
+# are replaced with a fixed-length digest (see Cache.KeyToJson).
+MAX_KEY_JSON_LENGTH = 200
+
+# A mapping from digest keys back to the original key JSON, for debugging.
+# It only knows about the keys that this instance has seen recently.
+LONG_KEYS = local_cache.LocalCache(3600, max_bytes=1000 * 1000)
+
+# Counters kept for each cache name, to help with tuning TTLs and ULLs.
+STATS_COUNTERS = [
+    'local_hits',  # values found in the local cache
+    'memcache_hits',  # values found in memcache before their refresh_time
+    'stale_serves',  # values served after their refresh_time
+    'misses',  # lookups without make_value that returned None
+    'lock_contention',  # failed attempts to get the make_value lock
+    'spin_ms',  # time spent sleeping while waiting for a value or the lock
+    'makes',  # calls to make_value
+    'make_ms',  # time spent in make_value
+    'make_errors',  # calls to make_value that raised an exception
+    'long_keys',  # lookups with keys longer than MAX_KEY_JSON_LENGTH
+]
+
+# Each instance adds up its counters in RAM and adds them to the totals in
+# memcache at most this often.
+STATS_FLUSH_INTERVAL_SEC = 60
+
+# Memcache key prefix for the stats totals, and the key for the list of names
+# of the caches that have stats.
+STATS_KEY_PREFIX = 'cache.stats'
+STATS_NAMES_KEY = 'cache.stats_names'
+
+_stats = {}  # name => {counter: amount}, accumulated since the last flush
+_stats_flush_time = time.time()
+_STATS_LOCK = threading.Lock()  # lock held while updating _stats
 
 # Sleep time between failing to grab a make_value lock and checking key
 # existence in the cache / retrying to get a lock again.
 RETRY_INTERVAL_SEC = 0.05
 
+# Sentinel for Cache._Get, meaning that memcache hasn't been consulted yet.
+_NOT_FETCHED = object()
+
+# Returned by Cache._Get when it would have to wait for another thread's value.
+_BUSY = object()
+
+# Queue and URL path for the tasks that regenerate refresh-ahead cache entries.
+# The path is relative to the app's root_path; see cache_refresh.py.
+REFRESH_QUEUE_NAME = 'cache-refresh'
+REFRESH_TASK_PATH = '/.cache_refresh'
+
+# When a refresh task is queued, other threads won't try to queue another one
+# for the same entry until this many seconds have passed.
+REFRESH_TASK_TIMEOUT_SEC = 60
+
+# Prefix for the keys of the tag generation counters.  The counters are plain
+# integers that memcache increments in place, so they're kept in raw memcache
+# rather than memcache_big, and in the local cache as (generation, fetch_time).
+GENERATION_KEY_PREFIX = 'cache.generation'
+
+# Caches that have a refresh_factory, keyed by cache name.
+_REFRESH_CACHES = {}  # name => Cache
+
+# Lookups with make_value in progress in this process, keyed by key_json.
+_FLIGHTS = {}  # key_json => _Flight
+_FLIGHTS_LOCK = threading.Lock()  # lock held while updating _FLIGHTS
+
+
+class _Flight(object):
+  """A Get() with make_value in progress, which other threads can wait for."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.waiters = 0  # threads waiting for the value; guarded by _FLIGHTS_LOCK
+    self.value = None
+    self.exc_info = None
+
+
+class MakeValueError(Exception):
+  """Stands in for a make_value exception that couldn't be pickled."""
+  pass
+
+
+class _Failure(object):
+  """Stored in place of a value to remember that make_value failed."""
+
+  def __init__(self, error):
+    try:
+      pickle.dumps(error, pickle.HIGHEST_PROTOCOL)
+    except Exception:  # pylint:disable=broad-except
+      error = MakeValueError('%s: %s' % (error.__class__.__name__, error))
+    self.error = error
+
+
+def _Unwrap(value):
+  """Returns a cached value, or raises the error if it's a cached failure."""
+  if isinstance(value, _Failure):
+    raise value.error
+  return value
+
 
 class CacheEntry(object):
   """Entry to be stored in local cache and memcache.
@@ -59,7 +166,7 @@ class CacheEntry(object):
     """Cache Entry.
 
     Args:
-      value: The value. Will be deep-copied by local_cache.
+      value: The value. Will be copied or frozen by local_cache.
       ttl: How long this value is valid. After this time has passed this value
           MUST be ignored and regenerated.
       ttc: How long before we should check for a newer version from the origin.
@@ -107,9 +214,119 @@ class CacheEntry(object):
         (self.value, self.ttl, self.ttc, self._creation_time))
 
 
+def Refresh(name, key, tags=None):
+  """Regenerates a refresh-ahead cache entry.  Called by cache_refresh.py.
+
+  Args:
+    name: The name of a Cache that was created with a refresh_factory.
+    key: The cache key whose value should be regenerated.
+    tags: The tags the entry was stored with, if any.
+  """
+  instance = _REFRESH_CACHES.get(name)
+  if instance:
+    instance.Refresh(key, tags)
+  else:
+    logging.warn('No refresh_factory registered for cache %r', name)
+
+
+def _GenerationKey(tag):
+  return GENERATION_KEY_PREFIX + json.dumps(tag, sort_keys=True)
+
+
+def _NewGeneration():
+  # A counter that has been evicted from memcache restarts at the current time
+  # in milliseconds, which is almost surely past any generation it reached
+  # before, so entries made under an old generation can't come back to life.
+  return int(time.time() * 1000)
+
+
+def InvalidateTags(*tags):
+  """Invalidates all the cache entries that were stored with any of the tags.
+
+  Each tag has a generation number that is part of the keys of the entries
+  stored with it, so incrementing the generation makes all those entries
+  unreachable (they then age out of memcache on their own).  This takes one
+  memcache call, no matter how many entries or caches are affected.  Other
+  app instances see the change within the ULL of the cache holding the entry.
+
+  Args:
+    *tags: The tags to invalidate.  Each can be any JSON-serializable value,
+        e.g. ['map', map_id].
+  """
+  generation_keys = map(_GenerationKey, tags)
+  raw_memcache.offset_multi(dict.fromkeys(generation_keys, 1),
+                            initial_value=_NewGeneration())
+  for generation_key in generation_keys:
+    LOCAL_CACHE.Delete(generation_key)
+
+
+def _StatsKey(name, counter):
+  return STATS_KEY_PREFIX + json.dumps([name, counter])
+
+
+def _AddStats(name, counter, amount=1):
+  """Adds to a counter for a cache, flushing the counters when they're due."""
+  with _STATS_LOCK:
+    counts = _stats.setdefault(name, {})
+    counts[counter] = counts.get(counter, 0) + amount
+    due = time.time() > _stats_flush_time + STATS_FLUSH_INTERVAL_SEC
+  if due:
+    FlushStats()
+
+
+def FlushStats():
+  """Adds the counters accumulated in this instance to the memcache totals."""
+  global _stats, _stats_flush_time  # pylint: disable=global-statement
+  with _STATS_LOCK:
+    stats, _stats = _stats, {}
+    _stats_flush_time = time.time()
+  if stats:
+    raw_memcache.offset_multi(
+        dict((_StatsKey(name, counter), int(amount))
+             for name, counts in stats.items()
+             for counter, amount in counts.items()), initial_value=0)
+    names = raw_memcache.get(STATS_NAMES_KEY) or []
+    if set(stats) - set(names):
+      raw_memcache.set(STATS_NAMES_KEY, sorted(set(names) | set(stats)))
+
+
+def GetStats():
+  """Gets the counters for all the caches, totalled across all instances.
+
+  Other instances' counts show up here within STATS_FLUSH_INTERVAL_SEC.  The
+  totals go back to when they were last evicted from memcache.
+
+  Returns:
+    A dictionary {cache_name: {counter: total}}, where the counters are the
+    ones listed in STATS_COUNTERS.
+  """
+  FlushStats()
+  names = raw_memcache.get(STATS_NAMES_KEY) or []
+  totals = raw_memcache.get_multi(
+      [_StatsKey(name, counter)
+       for name in names for counter in STATS_COUNTERS])
+  return dict((name, dict((counter, totals.get(_StatsKey(name, counter), 0))
+                          for counter in STATS_COUNTERS))
+              for name in names)
+
+
+def GetOriginalKeyJson(key_json):
+  """Gets the original key JSON for a digest key produced by Cache.KeyToJson.
+
+  Args:
+    key_json: A key produced by Cache.KeyToJson.
+  Returns:
+    The long key JSON that key_json is a digest of, if this instance has seen
+    it recently; otherwise key_json itself.
+  """
+  return LONG_KEYS.Get(key_json) or key_json
+
+
 def Reset():
   """Reset the state of this module.  For use in tests only."""
   LOCAL_CACHE.Clear()
+  LONG_KEYS.Clear()
+  _stats.clear()
   memcache.flush_all()
 
 
@@ -168,6 +385,9 @@ class Cache(object):
       >>> c.Get('x')
       [2, 3, 4]
 
+  (Unless the cache is created with local_mode=local_cache.FROZEN, in which
+  case values from the local cache are immutable and can't be mutated at all.)
+
   Cache instances have two parameters: TTL (time to live) and ULL (update
   latency limit).  The TTL controls when items expire; the ULL controls
   when updates to items become visible in all app instances.  You must
@@ -199,7 +419,9 @@ class Cache(object):
       updates sooner than the TTL expires.
   """
 
-  def __init__(self, name, ttl, ull=None, get_timeout=None, lock_timeout=1.1):
+  def __init__(self, name, ttl, ull=None, get_timeout=None, lock_timeout=1.1,
+               local_mode=local_cache.COPY, refresh_factory=None,
+               failure_ttl=0, failure_types=(Exception,)):
     """A two-level cache (local RAM and memcache).
 
     Args:
@@ -231,6 +453,26 @@ class Cache(object):
           for part of the second. This is ok though because the lock is per key
           and anything that needs to be cached for less than a second probably
           isn't worth caching through memcache.
+      local_mode: How values are kept in the local RAM cache: one of
+          local_cache.COPY, PICKLE, or FROZEN.  COPY (the default) deep-copies
+          the value on every local hit.  For large values, PICKLE is cheaper
+          and still returns a private copy; FROZEN returns a shared immutable
+          snapshot at no cost per hit, but is only suitable if callers never
+          modify the values they get.  See local_cache.LocalCache for details.
+      refresh_factory: An optional function that takes a key and returns its
+          value (or a CacheEntry).  Setting this enables refresh-ahead: when an
+          entry passes its refresh_time, the thread that gets the make_value
+          lock serves the stale value and queues a task to regenerate the
+          entry in the background, instead of calling make_value inline.
+          This function is also used as the default make_value for Get().
+          The function must be defined at the top level of a module that
+          cache_refresh.py imports, so the task can find it.
+      failure_ttl: If nonzero, failures are cached too: when make_value raises
+          one of the failure_types and there's no old value to fall back on,
+          the exception is remembered for this many seconds.  In that time,
+          Get() re-raises it right away instead of calling make_value again,
+          so a server that is down doesn't get hit by every request.
+      failure_types: The exception classes that failure_ttl applies to.
 
     Raises:
       ValueError: ull > ttl is not allowed.
@@ -250,18 +492,81 @@ class Cache(object):
       raise ValueError('Value for lock_timeout must be 0 or >= 1')
     if get_timeout and get_timeout <= 0:
       raise ValueError('Value for get_timeout should be positive')
+    if refresh_factory and lock_timeout == 0:
+      # Without the make_value lock, every Get() would queue a refresh task.
+      raise ValueError('refresh_factory requires a nonzero lock_timeout')
 
     self.name = name
     self.ttl = ttl
     self.ull = ull
     self.lock_timeout = lock_timeout
     self.get_timeout = get_timeout or 10
+    self.local_mode = local_mode
+    self.refresh_factory = refresh_factory
+    self.failure_ttl = failure_ttl
+    self.failure_types = failure_types
+    if refresh_factory:
+      _REFRESH_CACHES[name] = self
 
-  def KeyToJson(self, key):
-    """Converts a cache key to a canonical fully qualified string."""
-    return json.dumps([CACHE_ENTRY_VERSION, self.name, key], sort_keys=True)
+  def KeyToJson(self, key, tags=None):
+    """Converts a cache key to a canonical fully qualified string.
 
-  def Get(self, key, make_value=None):
+    Args:
+      key: The cache key.  Can be any JSON-serializable value.
+      tags: An optional list of tags; see InvalidateTags().  The current
+          generation of each tag becomes part of the result.  Looking up the
+          generations costs a memcache call unless they're in the local cache.
+    Returns:
+      The string to use as a memcache key.  If the JSON would be longer than
+      MAX_KEY_JSON_LENGTH, a digest of it is used instead, so that the key
+      still fits in memcache; GetOriginalKeyJson() maps it back.
+    """
+    if tags:
+      key_json = json.dumps([CACHE_ENTRY_VERSION, self.name, key,
+                             self._GetGenerations(tags)], sort_keys=True)
+    else:
+      key_json = json.dumps([CACHE_ENTRY_VERSION, self.name, key],
+                            sort_keys=True)
+    if len(key_json) > MAX_KEY_JSON_LENGTH:
+      return self._CompactKeyJson(key_json)
+    return key_json
+
+  def _CompactKeyJson(self, key_json):
+    """Replaces a key JSON string that's too long with a fixed-length digest."""
+    compact = json.dumps([CACHE_ENTRY_VERSION, self.name,
+                          {'sha1': hashlib.sha1(key_json).hexdigest()}])
+    _AddStats(self.name, 'long_keys')
+    if not LONG_KEYS.Get(compact):
+      logging.debug('Using digest key %s for %s', compact, key_json)
+      LONG_KEYS.Set(compact, key_json)
+    return compact
+
+  def _GetGenerations(self, tags):
+    """Gets the current generation numbers of a list of tags."""
+    now = time.time()
+    ull = self.ttl * 0.8 if self.ull is None else self.ull
+    generation_keys = map(_GenerationKey, tags)
+    generations = {}
+    for generation_key in generation_keys:
+      # Generations in the local cache are shared by all caches, so each
+      # cache decides whether they are fresh enough according to its own ULL.
+      local = LOCAL_CACHE.Get(generation_key)
+      if local and now < local[1] + ull:
+        generations[generation_key] = local[0]
+    missing = [k for k in generation_keys if k not in generations]
+    if missing:
+      # Adding 0 reads the counters, creating the ones that don't exist yet.
+      fetched = raw_memcache.offset_multi(
+          dict.fromkeys(missing, 0), initial_value=_NewGeneration()) or {}
+      for generation_key in missing:
+        generation = fetched.get(generation_key)
+        generations[generation_key] = generation
+        if generation is not None:
+          LOCAL_CACHE.Set(generation_key, (generation, now),
+                          expiry=now + self.ttl)
+    return [generations[k] for k in generation_keys]
+
+  def Get(self, key, make_value=None, tags=None):
     """Gets a key's value, using make_value() if it's not in the cache.
 
     If you don't supply a make_value function and do use a lock_timeout, you
@@ -275,65 +580,251 @@ class Cache(object):
       make_value: An optional function to produce the value if it's not
         found in the cache.  The value must be picklable. Alternatively you can
         return a CacheEntry with the value and ttl already set if you want a
-        non-default ttl for just this value.
+        non-default ttl for just this value.  Defaults to calling the
+        cache's refresh_factory, if it has one.
+      tags: The tags that the value was stored with, if any; see
+        InvalidateTags().  Pass the same tags to Get(), Set(), and Delete().
     Returns:
       The cached value, or the newly made value if it wasn't already
       cached, or None if make_value was not provided.
     Raises:
       RuntimeError: If there is a timeout on retries to make_value
+      Other exceptions: Whatever make_value raised, either just now or (if
+        failure_ttl is set) within the last failure_ttl seconds.
     """
-    key_json = self.KeyToJson(key)
+    key_json = self.KeyToJson(key, tags)
+    if not make_value and self.refresh_factory:
+      make_value = lambda: self.refresh_factory(key)
+    if make_value:
+      return _Unwrap(self._GetSingleFlight(key, key_json, make_value, tags))
+    return _Unwrap(self._Get(key, key_json, None, tags=tags))
 
+  def Peek(self, key, tags=None):
+    """Gets a key's current value, even if it is due to be refreshed.
+
+    Unlike Get(), this never calls make_value or waits for the make_value
+    lock.  It's meant for make_value functions that can reuse the old value,
+    e.g. by revalidating it with a conditional HTTP request.
+
+    Args:
+      key: The cache key.  Can be any JSON-serializable value.
+      tags: The tags that the value was stored with, if any.
+    Returns:
+      The stored value, or None if there is no unexpired value (a cached
+      failure counts as no value).
+    """
+    key_json = self.KeyToJson(key, tags)
+    entry = LOCAL_CACHE.Get(key_json) or memcache.get(key_json)
+    if (entry and time.time() < entry.hard_expiry and
+        not isinstance(entry.value, _Failure)):
+      return entry.value
+    return None
+
+  def GetOrLock(self, key, tags=None):
+    """Gets a key's value or the make_value lock, without waiting.
+
+    This is a single attempt at Get() without make_value, for callers that
+    want to start making several values at once.  When it returns the lock,
+    store the value with Make() (which makes it, and remembers failures,
+    just as Get() would).  When another thread holds the lock and there's no
+    old value to serve, call Get() later to wait for its value.
+
+    Args:
+      key: The cache key.  Can be any JSON-serializable value.
+      tags: The tags that the value was stored with, if any.
+    Returns:
+      A pair (value, locked).  value is the cached value, or None if there is
+      none to use yet; locked is True if the caller got the make_value lock.
+    Raises:
+      Exception: A failure remembered because of failure_ttl.
+    """
+    value = self._Get(key, self.KeyToJson(key, tags), None, tags=tags,
+                      wait=False)
+    if value is _BUSY:
+      return None, False
+    return _Unwrap(value), value is None
+
+  def _GetSingleFlight(self, key, key_json, make_value, tags=None):
+    """Like _Get, but coalesces concurrent lookups of a key in this process.
+
+    The first thread to miss the local cache for a key becomes the leader:
+    only it consults memcache and (subject to the usual memcache lock, which
+    coordinates between instances) calls make_value.  Other threads in this
+    process that want the same key in the meantime wait for the leader's
+    result instead of sleeping and polling memcache.
+
+    Args:
+      key: The cache key.
+      key_json: The result of self.KeyToJson(key).
+      make_value: A function to produce the value, as for Get().
+      tags: The tags for the key, as for Get().
+    Returns:
+      The value, as for Get().
+    Raises:
+      RuntimeError: If there is a timeout waiting for the value.
+      Other exceptions: Whatever the leader's make_value raised, if it failed
+          and there was no stale value to fall back to.
+    """
+    entry = LOCAL_CACHE.Get(key_json)
+    if entry:
+      _AddStats(self.name, 'local_hits')
+      return entry.value
+
+    with _FLIGHTS_LOCK:
+      flight = _FLIGHTS.get(key_json)
+      is_leader = flight is None
+      if is_leader:
+        flight = _FLIGHTS[key_json] = _Flight()
+      else:
+        flight.waiters += 1
+
+    if is_leader:
+      # Waiters must always be released, even by errors that aren't
+      # Exceptions (e.g. DeadlineExceededError) or by a failed copy.
+      try:
+        try:
+          value = self._Get(key, key_json, make_value, tags=tags)
+        finally:
+          with _FLIGHTS_LOCK:
+            del _FLIGHTS[key_json]  # after this, flight.waiters can't change
+        if flight.waiters:
+          # The caller may mutate value, so give the waiters a pristine copy.
+          flight.value = copy.deepcopy(value)
+      except BaseException:  # pylint:disable=broad-except
+        flight.exc_info = sys.exc_info()
+        raise
+      finally:
+        flight.done.set()
+      return value
+
+    if not flight.done.wait(self.get_timeout):
+      raise RuntimeError('Timed out waiting for another thread to get a value '
+                         'from cache or make_value: %s: %s' % (self.name, key))
+    if flight.exc_info:
+      raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+    entry = LOCAL_CACHE.Get(key_json)  # the leader has usually stored it here
+    return entry.value if entry else copy.deepcopy(flight.value)
+
+  def GetMulti(self, keys):
+    """Gets the values for several keys with at most one memcache round trip.
+
+    Keys found in the local cache are served from there; all the remaining
+    keys are fetched from memcache in a single get_multi call.  Each key then
+    gets the same treatment as in Get() (without a make_value function):
+    expired or missing entries are subject to the make_value lock, and stale
+    values are served while another thread holds the lock.
+
+    Args:
+      keys: A list of cache keys.  Each can be any JSON-serializable value.
+    Returns:
+      A list of the cached values (None for each cache miss or cached
+      failure), in the same order as keys.
+    Raises:
+      RuntimeError: If there is a timeout waiting for the lock on some key.
+    """
+    key_jsons = [self.KeyToJson(key) for key in keys]
+    values = [None] * len(keys)
+    missing = []  # indices of keys that weren't found in the local cache
+    for i, key_json in enumerate(key_jsons):
+      entry = LOCAL_CACHE.Get(key_json)
+      if entry:
+        _AddStats(self.name, 'local_hits')
+        values[i] = entry.value
+      else:
+        missing.append(i)
+    if missing:
+      entries = memcache.get_multi([key_jsons[i] for i in missing])
+      for i in missing:
+        values[i] = self._Get(keys[i], key_jsons[i], None,
+                              entries.get(key_jsons[i]))
+    return [None if isinstance(value, _Failure) else value for value in values]
+
+  def _Get(self, key, key_json, make_value, prefetched_entry=_NOT_FETCHED,
+           tags=None, wait=True):
+    """Implements Get() for a key whose canonical JSON is already known.
+
+    Args:
+      key: The cache key.
+      key_json: The result of self.KeyToJson(key).
+      make_value: An optional function to produce the value, as for Get().
+      prefetched_entry: If given, the entry (or None) just fetched from
+          memcache for this key; the first lookup will use this instead of
+          consulting the local cache and memcache.
+      tags: The tags for the key, as for Get().
+      wait: If False, return _BUSY instead of waiting for another thread to
+          make the value.
+    Returns:
+      The value, as for Get().
+    Raises:
+      RuntimeError: If there is a timeout on retries to make_value
+    """
     deadline = time.time() + self.get_timeout
 
     while True:
       now = time.time()
 
-      # Look for the key in the local cache (handles its own expiry)
-      entry = LOCAL_CACHE.Get(key_json)
-      if entry:
-        return entry.value
+      if prefetched_entry is _NOT_FETCHED:
+        # Look for the key in the local cache (handles its own expiry)
+        entry = LOCAL_CACHE.Get(key_json)
+        if entry:
+          _AddStats(self.name, 'local_hits')
+          return entry.value
+
+        # Key not found in the local cache, so look for the key in memcache
+        entry = memcache.get(key_json)
+      else:
+        entry, prefetched_entry = prefetched_entry, _NOT_FETCHED
 
-      # Key not found in the local cache, so look for the key in memcache
-      entry = memcache.get(key_json)
       if entry and now < entry.refresh_time:
         # Found in memcache and still valid, save it locally
+        _AddStats(self.name, 'memcache_hits')
         self._SetLocalCache(key_json, entry)
         return entry.value
 
       # Entity either not in memcache or ready to be refreshed.
       if self._AcquireMakeLock(key_json, entry):
         # I got the lock (or none needed)!
+        if (entry and now < entry.hard_expiry and
+            self._QueueRefresh(key, key_json, entry, tags)):
+          # A task will regenerate the value; meanwhile, the old one is valid.
+          _AddStats(self.name, 'stale_serves')
+          return entry.value
         if make_value:
           # Generate and save a new value, returning the old value on failure.
-          return self._Make(key, make_value, entry)
+          return self._Make(key, key_json, make_value, entry)
         else:
           # Return a cache miss so the caller can generate and set a value,
           # letting the other threads continue using the old value or waiting
           # for this one to generate the value.
+          _AddStats(self.name, 'misses')
           return None
       elif entry and now < entry.hard_expiry:
         # I'm not the chosen thread to refresh the value, but still have an old
         # value to use. Save it locally. It'll get refreshed/replaced soon, but
         # better to use a bit stale version than stampede on memcache.
+        _AddStats(self.name, 'stale_serves')
         self._SetLocalCache(key_json, entry)
         return entry.value
+      elif not wait:
+        return _BUSY
       elif time.time() + RETRY_INTERVAL_SEC < deadline:
         # I don't have a valid entry to use, nor permission to generate one,
         # so spin and wait for one to arrive.
         time.sleep(RETRY_INTERVAL_SEC)
+        _AddStats(self.name, 'spin_ms', RETRY_INTERVAL_SEC * 1000)
       else:
         raise RuntimeError('Timed out waiting for a value from cache or '
                            'the lock to generate my own: %s: %s' %
                            (self.name, key))
 
-  def _Make(self, key, make_value, old_entry):
+  def _Make(self, key, key_json, make_value, old_entry):
     """Try to generate a new value with make_value and set it in cache.
 
     This assumes you already have the lock.
 
     Args:
       key: Key that we're updating a value for
+      key_json: The result of self.KeyToJson(key, tags).
       make_value: A function to produce the value.
       old_entry: The current entry in memcache. Return this value if make_value
         fails and it's still valid.
@@ -341,24 +832,105 @@ class Cache(object):
       The newly generated value or an old version if it's still valid and there
       was an error.
     """
+    start_time = time.time()
     try:
       result = make_value()
-      self.Set(key, result)
+      self._Set(memcache.set, key_json, result, None)
       return result.value if isinstance(result, CacheEntry) else result
-    except Exception:  # pylint:disable=broad-except
-      if old_entry and time.time() < old_entry.hard_expiry:
-        # There is a stale value we can return, so just log a warning
+    except Exception, e:  # pylint:disable=broad-except
+      exc_info = sys.exc_info()
+      _AddStats(self.name, 'make_errors')
+      if (old_entry and time.time() < old_entry.hard_expiry and
+          not isinstance(old_entry.value, _Failure)):
+        # There is a stale value (not a cached failure) we can return, so just
+        # log a warning
         logging.exception(
             'Error on make_value for key %s in %s. '
             'Falling back to the old value and ignoring the error.',
-            self.KeyToJson(key), self.name)
+            key_json, self.name)
         return old_entry.value
       else:
         logging.exception(
             'Error on make_value for key %s in %s. '
             'No stale data to fallback to, so re-raising.',
-            self.KeyToJson(key), self.name)
-        raise
+            key_json, self.name)
+        if self.failure_ttl and isinstance(e, self.failure_types):
+          self._Set(memcache.set, key_json, _Failure(e), self.failure_ttl)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+      _AddStats(self.name, 'makes')
+      _AddStats(self.name, 'make_ms', (time.time() - start_time) * 1000)
+
+  def Make(self, key, make_value, tags=None):
+    """Makes and stores a key's value after Get() returned a cache miss.
+
+    When Get() without make_value returns None, the caller holds the
+    make_value lock and is expected to store a new value.  This does that
+    with make_value, just as Get() would have, so the caller can start the
+    work (e.g. an RPC) in between.  If make_value fails, the old value is
+    used if it's still valid; otherwise the failure is remembered (if
+    failure_ttl is set) and re-raised.
+
+    Args:
+      key: The cache key.
+      make_value: A function to produce the value, as for Get().
+      tags: The tags for the key, as for Get().
+    Returns:
+      The newly made value, or the old value if make_value failed.
+    """
+    key_json = self.KeyToJson(key, tags)
+    return self._Make(key, key_json, make_value, memcache.get(key_json))
+
+  def Refresh(self, key, tags=None):
+    """Regenerates a key's value with the refresh_factory and stores it.
+
+    This is run by the task that _QueueRefresh queues.  If the refresh_factory
+    fails, the old value is left in place until it expires.
+
+    Args:
+      key: The cache key.
+      tags: The tags for the key, as for Get().
+    """
+    key_json = self.KeyToJson(key, tags)
+    self._Make(key, key_json, lambda: self.refresh_factory(key),
+               memcache.get(key_json))
+
+  def _QueueRefresh(self, key, key_json, old_entry, tags=None):
+    """Queues a task to regenerate a stale entry, if refresh-ahead is enabled.
+
+    Assumes the caller holds the make_value lock for the key.  Also pushes
+    the entry's refresh_time forward so that other threads keep serving it
+    while the task is pending, rather than queueing more tasks.
+
+    Args:
+      key: The cache key.
+      key_json: The result of self.KeyToJson(key).
+      old_entry: The stale entry, which will be served in the meantime.
+      tags: The tags for the key, as for Get().
+    Returns:
+      True if a task was queued.
+    """
+    if not self.refresh_factory:
+      return False
+    # config imports this module, so import it here.
+    import config  # pylint: disable=g-import-not-at-top
+    params = {'name': self.name, 'key': json.dumps(key)}
+    if tags:
+      params['tags'] = json.dumps(tags)
+    try:
+      taskqueue.add(
+          queue_name=REFRESH_QUEUE_NAME, method='GET',
+          url=(config.Get('root_path') or '') + REFRESH_TASK_PATH,
+          params=params)
+    except taskqueue.Error:
+      logging.exception('Failed to queue a refresh task for key %s in %s; '
+                        'refreshing inline.', key_json, self.name)
+      return False
+
+    old_entry.refresh_time = time.time() + REFRESH_TASK_TIMEOUT_SEC
+    self._SetLocalCache(key_json, old_entry)
+    memcache.set(key_json, old_entry, time=old_entry.hard_expiry)
+    return True
 
   def _AcquireMakeLock(self, key_json, old_entry):
     """Tries to acquire a lock for make_value for a given key.
@@ -385,6 +957,8 @@ class Cache(object):
     lock_key_json = 'cache.make_lock' + key_json
     lock_timeout = now + self.lock_timeout
     acquired = memcache.add(lock_key_json, lock_timeout, time=self.lock_timeout)
+    if not acquired:
+      _AddStats(self.name, 'lock_contention')
 
     if acquired and old_entry:
       # Push the refresh time forward so other threads don't try to acquire the
@@ -395,19 +969,20 @@ class Cache(object):
 
     return acquired
 
-  def Set(self, key, value, ttl=None):
+  def Set(self, key, value, ttl=None, tags=None):
     """Sets a key's value in the cache.
 
     Args:
       key: The cache key.  Can be any JSON-serializable value.
       value: The value to store in the cache.  Must be picklable.
       ttl: How long this value should last. None means use the cache default.
+      tags: Optional tags to store the value with; see InvalidateTags().
     Returns:
       True if this key was set successfully.
     """
-    return self._Set(memcache.set, key, value, ttl)
+    return self._Set(memcache.set, self.KeyToJson(key, tags), value, ttl)
 
-  def Add(self, key, value, ttl=None):
+  def Add(self, key, value, ttl=None, tags=None):
     """Atomically sets a key's value only if it's not already set.
 
     To ensure atomicity, this method always queries memcache directly.
@@ -416,51 +991,111 @@ class Cache(object):
       key: The cache key.  Can be any JSON-serializable value.
       value: The value to store in the cache.  Must be picklable.
       ttl: How long this value should last. None means use the cache default.
+      tags: Optional tags to store the value with; see InvalidateTags().
     Returns:
       True if this key was not previously set and was updated.
     """
-    return self._Set(memcache.add, key, value, ttl)
+    return self._Set(memcache.add, self.KeyToJson(key, tags), value, ttl)
+
+  def SetMulti(self, items, ttl=None):
+    """Sets the values of several keys in a single memcache round trip.
 
-  def _Set(self, memcache_func, key, value, ttl):
+    Args:
+      items: A list of (key, value) pairs, as would be passed to Set().
+      ttl: How long these values should last. None means use the cache default.
+    Returns:
+      A list of booleans, in the same order as items, indicating which keys
+      were set successfully.
+    """
+    return self._SetMulti(memcache.set_multi, items, ttl)
+
+  def AddMulti(self, items, ttl=None):
+    """Atomically sets each of several keys only if it's not already set.
+
+    Args:
+      items: A list of (key, value) pairs, as would be passed to Add().
+      ttl: How long these values should last. None means use the cache default.
+    Returns:
+      A list of booleans, in the same order as items, indicating which keys
+      were not previously set and were updated.
+    """
+    return self._SetMulti(memcache.add_multi, items, ttl)
+
+  def _Set(self, memcache_func, key_json, value, ttl):
     """Set/Add a key's value in the cache.
 
     Args:
       memcache_func: Either memcache.set or memcache.add
-      key: The cache key.  Can be any JSON-serializable value.
+      key_json: The result of self.KeyToJson(key, tags).
       value: The value to store in the cache.  Must be picklable.
       ttl: How long this value should last. None means use the cache default.
     Returns:
       True if this key was set successfully.
     """
-    key_json = self.KeyToJson(key)
+    entry = self._MakeEntry(value, ttl)
 
+    if memcache_func(key_json, entry, time=entry.hard_expiry):
+      self._SetLocalCache(key_json, entry)
+      return True
+    if memcache_func == memcache.set:  # Don't log add as failure is common
+      logging.warn('Failed to set a value in memcache: %s', key_json)
+    return False
+
+  def _SetMulti(self, memcache_multi_func, items, ttl):
+    """Set/Add the values of several keys in the cache.
+
+    Args:
+      memcache_multi_func: Either memcache.set_multi or memcache.add_multi
+      items: A list of (key, value) pairs.
+      ttl: How long these values should last. None means use the cache default.
+    Returns:
+      A list of booleans indicating which keys were set successfully.
+    """
+    now = time.time()
+    entries = [(self.KeyToJson(key), self._MakeEntry(value, ttl, now))
+               for key, value in items]
+
+    # memcache takes a single expiry time per call, so group the entries by
+    # expiry.  Entries that share a ttl were created at the same instant above,
+    # so in the usual case this makes just one call.
+    by_expiry = {}
+    for key_json, entry in entries:
+      by_expiry.setdefault(entry.hard_expiry, {})[key_json] = entry
+    failed = set()
+    for expiry, mapping in by_expiry.items():
+      failed.update(memcache_multi_func(mapping, time=expiry))
+
+    for key_json, entry in entries:
+      if key_json not in failed:
+        self._SetLocalCache(key_json, entry)
+    if failed and memcache_multi_func == memcache.set_multi:
+      logging.warn('Failed to set values in memcache: %s', sorted(failed))
+    return [key_json not in failed for key_json, _ in entries]
+
+  def _MakeEntry(self, value, ttl, creation_time=None):
+    """Wraps a value in a CacheEntry (if it isn't one already) for storage."""
     if isinstance(value, CacheEntry):
       entry = value
     else:
       # IMPORTANT: If you change the cache entry or how it functions, you must
       # also update CACHE_ENTRY_VERSION.
-      entry = CacheEntry(value, ttl or self.ttl)
+      entry = CacheEntry(value, ttl or self.ttl, creation_time=creation_time)
 
     # Pick a value for ttc less than tll, so that there is enough time
     # to attempt and rewarm the entities with make_value.
     if self.lock_timeout > 0 and entry._ttc is None:  # pylint:disable=protected-access
       entry.ttc = 0.8 * entry.ttl
     # else leave the default of ttc = ttl
+    return entry
 
-    if memcache_func(key_json, entry, time=entry.hard_expiry):
-      self._SetLocalCache(key_json, entry)
-      return True
-    if memcache_func == memcache.set:  # Don't log add as failure is common
-      logging.warn('Failed to set a value in memcache: %s', key_json)
-    return False
-
-  def Delete(self, key):
+  def Delete(self, key, tags=None):
     """Deletes a key from the cache.
 
     Args:
       key: The cache key.  Can be any JSON-serializable value.
+      tags: The tags that the value was stored with, if any.
     """
-    key_json = self.KeyToJson(key)
+    key_json = self.KeyToJson(key, tags)
     memcache.delete(key_json)
     LOCAL_CACHE.Delete(key_json)
 
@@ -484,4 +1119,4 @@ class Cache(object):
         min(expiry, entry.refresh_time),
         min(expiry, entry.hard_expiry))
 
-    LOCAL_CACHE.Set(key_json, entry, expiry=expiry)
+    LOCAL_CACHE.Set(key_json, entry, expiry=expiry, mode=self.local_mode)
@@ -0,0 +1,37 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Task that regenerates stale entries in refresh-ahead caches.
+
+Cache.Get() queues this task (see cache.Cache._QueueRefresh) for caches that
+were created with a refresh_factory.  The modules that define such caches must
+be imported here, so that their caches are registered by name.
+"""
+
+import json
+
+import base_handler
+import cache
+import card  # pylint: disable=unused-import
+
+
+class CacheRefresh(base_handler.BaseHandler):
+  """Regenerates the value of one key in a refresh-ahead cache."""
+
+  def Get(self):
+    """Calls the cache's refresh_factory and stores the result."""
+    # App Engine strips this header from external requests, so only the task
+    # queue can make the app fetch and cache things on demand.
+    if not self.request.headers.get('X-AppEngine-QueueName'):
+      raise base_handler.Error(403, 'Only the task queue can refresh caches.')
+    cache.Refresh(self.request.get('name'), json.loads(self.request.get('key')),
+                  json.loads(self.request.get('tags') or 'null'))
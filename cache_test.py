@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Tests for cache.py."""
+
+import threading
+import time
+
+import cache
+import memcache_big
+import test_utils
+
+
+class CacheTest(test_utils.BaseTest):
+  """Tests the two-level cache."""
+
+  def testGetMulti(self):
+    c = cache.Cache('test', 60)
+    c.Set('a', 1)
+    c.Set(['b', 2], {'x': 'y'})
+    self.assertEquals([1, None, {'x': 'y'}, 1],
+                      c.GetMulti(['a', 'missing', ['b', 2], 'a']))
+
+  def testGetMultiMakesOneMemcacheCall(self):
+    c = cache.Cache('test', 60)
+    c.SetMulti([('a', 1), ('b', 2)])
+    cache.LOCAL_CACHE.Clear()
+
+    calls = []
+    get_multi = memcache_big.get_multi
+    def CountingGetMulti(keys):
+      calls.append(keys)
+      return get_multi(keys)
+    self.SetForTest(memcache_big, 'get_multi', CountingGetMulti)
+    self.assertEquals([1, 2], c.GetMulti(['a', 'b']))
+    self.assertEquals(1, len(calls))
+
+    # Now both values are in the local cache, so memcache isn't consulted.
+    self.assertEquals([1, 2], c.GetMulti(['a', 'b']))
+    self.assertEquals(1, len(calls))
+
+  def testGetMultiServesStaleValueWhileLocked(self):
+    self.SetTime(1400000000)
+    c = cache.Cache('test', 60, 0)
+    c.Set('a', 1)
+
+    # Past refresh_time, the first caller gets the lock and a cache miss;
+    # the next caller gets the stale value.
+    self.SetTime(1400000055)
+    self.assertEquals([None], c.GetMulti(['a']))
+    self.assertEquals([1], c.GetMulti(['a']))
+
+  def testSetMultiAndAddMulti(self):
+    c = cache.Cache('test', 60)
+    self.assertEquals([True, True], c.SetMulti([('a', 1), ('b', 2)]))
+    self.assertEquals([False, True], c.AddMulti([('a', 3), ('c', 4)]))
+    self.assertEquals([1, 2, 4], c.GetMulti(['a', 'b', 'c']))
+    self.assertEquals([], c.SetMulti([]))
+
+  def testConcurrentGetsShareOneMakeValue(self):
+    c = cache.Cache('test', 60)
+    calls = []
+    release = threading.Event()
+    def MakeValue():
+      calls.append(1)
+      release.wait()
+      return {'x': [1]}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        c.Get('a', MakeValue))) for _ in range(4)]
+    threads[0].start()
+    while not cache._FLIGHTS:  # wait for the first thread to become leader
+      release.wait(0.01)
+    for thread in threads[1:]:
+      thread.start()
+    while cache._FLIGHTS[c.KeyToJson('a')].waiters < 3:
+      release.wait(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+
+    self.assertEquals(1, len(calls))
+    self.assertEquals([{'x': [1]}] * 4, results)
+    results[0]['x'].append(2)  # each caller gets its own copy
+    self.assertEquals({'x': [1]}, results[1])
+    self.assertEquals({}, cache._FLIGHTS)
+
+  def testWaitersGetLeadersBaseException(self):
+    c = cache.Cache('test', 60)
+    class Deadline(BaseException):
+      pass
+    release = threading.Event()
+    def MakeValue():
+      release.wait()
+      raise Deadline()
+
+    errors = []
+    def GetAndRecordError():
+      try:
+        c.Get('a', MakeValue)
+      except Deadline as e:
+        errors.append(e)
+    threads = [threading.Thread(target=GetAndRecordError) for _ in range(2)]
+    threads[0].start()
+    while not cache._FLIGHTS:  # wait for the first thread to become leader
+      release.wait(0.01)
+    threads[1].start()
+    while cache._FLIGHTS[c.KeyToJson('a')].waiters < 1:
+      release.wait(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+
+    self.assertEquals(2, len(errors))
+    self.assertEquals({}, cache._FLIGHTS)
+
+  def testFailedMakeValueLeavesNoFlight(self):
+    c = cache.Cache('test', 60)
+    def MakeValue():
+      raise ValueError('oops')
+    self.assertRaises(ValueError, c.Get, 'a', MakeValue)
+    self.assertEquals({}, cache._FLIGHTS)
+
+  def testRefreshAhead(self):
+    values = ['old', 'new']
+    c = cache.Cache('test', 60, 0,
+                    refresh_factory=lambda key: values.pop(0) + key)
+    self.SetTime(1400000000)
+    self.assertEquals('olda', c.Get('a'))  # a miss calls the factory inline
+
+    # Past refresh_time, the stale value is served and a task is queued.
+    self.SetTime(1400000055)
+    self.assertEquals('olda', c.Get('a'))
+    self.assertEquals('olda', c.Get('a'))
+    tasks = self.PopTasks(cache.REFRESH_QUEUE_NAME)
+    self.assertEquals(1, len(tasks))
+    self.assertEquals(['new'], values)
+
+    # The task handler only accepts requests from the task queue.
+    self.DoGet(tasks[0]['url'][len(test_utils.ROOT_PATH):], 403)
+    self.assertEquals(['new'], values)
+
+    self.ExecuteTask(tasks[0])
+    self.assertEquals('newa', c.Get('a'))
+    self.assertEquals([], self.PopTasks(cache.REFRESH_QUEUE_NAME))
+
+  def testPeek(self):
+    self.SetTime(1400000000)
+    c = cache.Cache('test', 60, 0)
+    c.Set('a', 1)
+    self.assertEquals(1, c.Peek('a'))
+    self.assertEquals(None, c.Peek('b'))
+
+    # Past refresh_time, make_value can still see the old value.
+    self.SetTime(1400000055)
+    self.assertEquals(2, c.Get('a', lambda: c.Peek('a') + 1))
+
+    self.SetTime(1400000200)
+    self.assertEquals(None, c.Peek('a'))
+
+  def testInvalidateTags(self):
+    c = cache.Cache('test', 60)
+    d = cache.Cache('test2', 60)
+    c.Set('a', 1, tags=['x'])
+    c.Set('b', 2, tags=['x', 'y'])
+    d.Set('c', 3, tags=['y'])
+    c.Set('d', 4)
+    self.assertEquals(1, c.Get('a', tags=['x']))
+    self.assertEquals(None, c.Get('a'))  # tags are part of the key
+
+    cache.InvalidateTags(['unused'])
+    self.assertEquals(2, c.Get('b', tags=['x', 'y']))
+
+    cache.InvalidateTags('y')
+    self.assertEquals(1, c.Get('a', tags=['x']))
+    self.assertEquals(None, c.Get('b', tags=['x', 'y']))
+    self.assertEquals(None, d.Get('c', tags=['y']))
+    self.assertEquals(4, c.Get('d'))
+    d.Set('c', 5, tags=['y'])
+    self.assertEquals(5, d.Get('c', tags=['y']))
+
+  def testLongKeysAreHashed(self):
+    c = cache.Cache('test', 60)
+    long_key = ['http://example.com/?q=' + 'x' * 300, '$name']
+    key_json = c.KeyToJson(long_key)
+    self.assertLessEqual(len(key_json), cache.MAX_KEY_JSON_LENGTH)
+    self.assertEquals(key_json, c.KeyToJson(long_key))
+    self.assertNotEquals(key_json, c.KeyToJson(long_key + ['y']))
+    self.assertTrue('x' * 300 in cache.GetOriginalKeyJson(key_json))
+    self.assertEquals(3, cache.GetStats()['test']['long_keys'])
+
+    c.Set(long_key, 1)
+    cache.LOCAL_CACHE.Clear()
+    self.assertEquals(1, c.Get(long_key))
+    self.assertEquals('["v3", "test", "a"]', c.KeyToJson('a'))
+
+  def testStats(self):
+    c = cache.Cache('test', 60, 0)
+    d = cache.Cache('test2', 60)
+    c.Get('a', lambda: 1)  # miss, make
+    c.Get('a', lambda: 2)  # memcache hit (no local cache because ull is 0)
+    c.Get('b')  # miss
+    d.Set('a', 1)
+    d.Get('a')  # local hit
+
+    stats = cache.GetStats()
+    self.assertEquals(['test', 'test2'], sorted(stats))
+    self.assertEquals(1, stats['test']['makes'])
+    self.assertEquals(1, stats['test']['memcache_hits'])
+    self.assertEquals(1, stats['test']['misses'])
+    self.assertEquals(0, stats['test']['local_hits'])
+    self.assertEquals(0, stats['test']['make_errors'])
+    self.assertEquals(1, stats['test2']['local_hits'])
+
+  def testFailureTtl(self):
+    self.SetTime(1400000000)
+    c = cache.Cache('test', 60, lock_timeout=0, failure_ttl=10,
+                    failure_types=(ValueError,))
+    calls = []
+    def Fail():
+      calls.append(1)
+      raise ValueError('down')
+    self.assertRaises(ValueError, c.Get, 'a', Fail)
+    self.assertRaises(ValueError, c.Get, 'a', Fail)  # remembered; no call
+    self.assertRaises(ValueError, c.Get, 'a')
+    self.assertEquals([None], c.GetMulti(['a']))
+    self.assertEquals(1, len(calls))
+
+    # Other exception types aren't remembered.
+    def FailDifferently():
+      calls.append(1)
+      raise KeyError('b')
+    self.assertRaises(KeyError, c.Get, 'b', FailDifferently)
+    self.assertRaises(KeyError, c.Get, 'b', FailDifferently)
+    self.assertEquals(3, len(calls))
+
+    # After the failure_ttl, make_value is tried again.
+    self.SetTime(1400000011)
+    self.assertEquals(5, c.Get('a', lambda: 5))
+
+  def testMake(self):
+    self.SetTime(1400000000)
+    c = cache.Cache('test', 60, failure_ttl=10, failure_types=(ValueError,))
+    self.assertEquals(None, c.Get('a'))  # a miss; we have the lock
+    self.assertEquals(5, c.Make('a', lambda: 5))
+    self.assertEquals(5, c.Get('a'))
+
+    # A failure falls back to the old value while it's still valid...
+    def Fail():
+      raise ValueError('down')
+    self.assertEquals(5, c.Make('a', Fail))
+
+    # ...and is otherwise remembered, like a failure in Get().
+    self.assertEquals(None, c.Get('b'))
+    self.assertRaises(ValueError, c.Make, 'b', Fail)
+    self.assertRaises(ValueError, c.Get, 'b')
+
+  def testGetOrLock(self):
+    self.SetTime(1400000000)
+    c = cache.Cache('test', 60, failure_ttl=10, failure_types=(ValueError,))
+    self.assertEquals((None, True), c.GetOrLock('a'))
+
+    # Someone else has the lock now, so we shouldn't wait for it.
+    self.StubTimeSleep()
+    self.assertEquals((None, False), c.GetOrLock('a'))
+    self.assertEquals(1400000000, time.time())
+
+    c.Make('a', lambda: 5)
+    self.assertEquals((5, False), c.GetOrLock('a'))
+    def Fail():
+      raise ValueError('down')
+    c.GetOrLock('b')
+    self.assertRaises(ValueError, c.Make, 'b', Fail)
+    self.assertRaises(ValueError, c.GetOrLock, 'b')
+
+
+if __name__ == '__main__':
+  test_utils.main()
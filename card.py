@@ -12,7 +12,10 @@
 
 """Displays a card containing a list of nearby features for a given topic."""
 
+import array
+import copy
 import datetime
+import heapq
 import json
 import logging
 import math
@@ -23,6 +26,7 @@ import base_handler
 import cache
 import config
 import kmlify
+import local_cache
 import maproot
 import model
 import spherical
@@ -31,24 +35,53 @@ import utils
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb  # just for GeoPt
 
-# A cache of Feature list representing points from XML, keyed by
-# [url, map_id, map_version_id, layer_id]
-XML_FEATURES_CACHE = cache.Cache('card_features.xml', 300)
+# How long to remember that a layer's source was unreachable or unparseable,
+# so that cards don't wait on a dead server for every request.
+FAILURE_TTL_SECONDS = 30
+
+# The errors that leave a layer out of a card, instead of failing the card.
+LAYER_ERRORS = (SyntaxError, ValueError, RuntimeError, urlfetch.Error)
+
+# The fetches for all the layers of a topic are started at once, and each one
+# has this deadline.  A layer whose fetch takes longer is left out of the card
+# (and counts as failed for FAILURE_TTL_SECONDS), so that one slow source
+# can't hold up the others.
+LAYER_TIMEOUT_SECONDS = 5
+
+# A cache of FeatureIndex objects for the points from XML or from kmlify's
+# GeoJSON output, keyed by [url, map_id, map_version_id, layer_id].  Local
+# hits are shared; FeatureIndex.GetFeaturesNear copies only the Features it
+# returns, so callers can set distances on them.
+XML_FEATURES_CACHE = cache.Cache('card.feature_index', 300,
+                                 local_mode=local_cache.FROZEN,
+                                 failure_ttl=FAILURE_TTL_SECONDS,
+                                 failure_types=(SyntaxError, ValueError,
+                                                urlfetch.DownloadError))
 
 # Fetched strings of Google Places API JSON results, keyed by request URL.
-JSON_PLACES_API_CACHE = cache.Cache('card.places_json', 300)
+# Stale results are served while a task fetches fresh ones in the background.
+JSON_PLACES_API_CACHE = cache.Cache(
+    'card.places_json', 300, refresh_factory=lambda url: FetchPlacesJson(url))
 
 # Lists of Feature objects, keyed by [map_id, map_version_id, topic_id,
 # geolocation_rounded_to_10m, radius, max_count].
 FILTERED_FEATURES_CACHE = cache.Cache('card.filtered_features', 60)
 
-# Key: [map_id, map_version_id, topic_id, geolocation_rounded_to_10m, radius].
+# Lists that are missing a layer, because its source failed or timed out, are
+# cached for only this long, so the layer comes back soon after its source
+# does.
+INCOMPLETE_FEATURES_TTL_SECONDS = 5
+
+# Key: [map_id, topic_id, geolocation_rounded_to_10m, radius].
+# Tags: [model.GetCrowdReportTag(map_id + '.' + topic_id)], so that all the
+# entries for a topic are invalidated when a report is posted (see
+# InvalidateReportCache) or hidden or unhidden by votes.
 # Value: 3-tuple of (latest_answers, answer_times, report_dicts) where
 #   - latest_answers is a dictionary {qid: latest_answer_to_that_question}
 #   - answer_times is a dictionary {qid: effective_time_of_latest_answer}
 #   - report_dicts contains the last REPORTS_PER_FEATURE reports, as a list
 #     of dicts [{qid: answer, '_effective': time, '_id': report_id}]
-REPORT_CACHE = cache.Cache('card.reports', 15)
+REPORT_CACHE = cache.Cache('card.reports', 300, 1)
 
 # Number of crowd reports to cache and return per feature.
 REPORTS_PER_FEATURE = 5
@@ -57,6 +90,7 @@ MAX_ANSWER_AGE = datetime.timedelta(days=7)  # ignore answers older than 7 days
 GOOGLE_SPREADSHEET_CSV_URL = (
     'https://docs.google.com/spreadsheet/pub?key=$key&output=csv')
 DEGREES = 3.14159265358979/180
+EARTH_RADIUS = 6378000  # metres
 DEADLINE = 10
 PLACES_API_SEARCH_URL = (
     'https://maps.googleapis.com/maps/api/place/nearbysearch/json?')
@@ -98,17 +132,46 @@ class Feature(object):
   distance_mi = property(lambda self: self.distance and self.distance/1609.344)
 
 
-def EarthDistance(a, b):
-  """Great circle distance in metres between two points on the Earth."""
-  lat1, lon1 = a.lat*DEGREES, a.lon*DEGREES
-  lat2, lon2 = b.lat*DEGREES, b.lon*DEGREES
-  dlon = lon2 - lon1
+class FeatureIndex(object):
+  """A list of Features with a spatial index, for finding the nearby ones."""
+
+  def __init__(self, features):
+    self.features = features
+    # Contiguous coordinates, to pass to spherical.GetEarthDistances.
+    self.lats = array.array('d', [f.location.lat for f in features])
+    self.lons = array.array('d', [f.location.lon for f in features])
+    self.grid = kmlify.GridIndex(zip(self.lats, self.lons))
 
-  atan2, cos, sin, sqrt = math.atan2, math.cos, math.sin, math.sqrt
-  y = sqrt(pow(cos(lat2)*sin(dlon), 2) +
-           pow(cos(lat1)*sin(lat2) - sin(lat1)*cos(lat2)*cos(dlon), 2))
-  x = sin(lat1)*sin(lat2) + cos(lat1)*cos(lat2)*cos(dlon)
-  return 6378000*atan2(y, x)
+  def GetFeaturesNear(self, center, radius):
+    """Gets copies of the Features within a circle, with distances set.
+
+    Args:
+      center: The center of the circle, as an ndb.GeoPt.
+      radius: The radius of the circle, in metres.
+    Returns:
+      New copies of the Features less than radius from center, in their
+      original order, with their distance attributes set.
+    """
+    angle = radius / float(EARTH_RADIUS)
+    south, north = center.lat - angle/DEGREES, center.lat + angle/DEGREES
+    west, east = -180, 180
+    if -90 < south and north < 90:
+      # The box has to reach the meridians that the circle touches, which
+      # are farther apart than the circle is wide at its center.
+      dlon = math.asin(math.sin(angle) / math.cos(center.lat*DEGREES))/DEGREES
+      west, east = center.lon - dlon, center.lon + dlon
+      west += 360 if west < -180 else 0
+      east -= 360 if east > 180 else 0
+    indexes = self.grid.Query(max(south, -90), west, min(north, 90), east)
+    distances = spherical.GetEarthDistances(
+        center, [self.lats[i] for i in indexes],
+        [self.lons[i] for i in indexes], EARTH_RADIUS)
+    features = []
+    for i, distance in zip(indexes, distances):
+      if distance < radius:
+        features.append(copy.copy(self.features[i]))
+        features[-1].distance = distance
+    return features
 
 
 def GetText(element):
@@ -147,6 +210,42 @@ def GetFeaturesFromXml(xml_content, layer=None):
   return features
 
 
+def GetFeaturesFromGeoJson(json_content, layer=None):
+  """Extracts a list of Feature objects from kmlify's GeoJSON output."""
+  layer_attr = layer and layer.get('attribution')
+  features = []
+  for feature in json.loads(json_content).get('features', []):
+    location = GetLocationFromGeoJsonGeometry(feature.get('geometry'))
+    if not location:
+      continue
+    properties = feature.get('properties') or {}
+    # Sanitize the description just as GetFeaturesFromXml does.
+    description_escaped = utils.StripHtmlTags(
+        properties.get('description') or '',
+        tag_whitelist=['b', 'u', 'i', 'br', 'div'])
+    features.append(Feature(
+        properties.get('name') or '',
+        description_escaped,
+        location,
+        layer and layer.get('id'),
+        layer and layer.get('type'),
+        html_attrs=(layer_attr and [layer_attr] or [])))
+  return features
+
+
+def GetLocationFromGeoJsonGeometry(geometry):
+  """Gets the first point of a GeoJSON geometry, like GetLocationFromXmlItem."""
+  try:
+    while geometry['type'] == 'GeometryCollection':
+      geometry = geometry['geometries'][0]
+    position = geometry['coordinates']
+    while isinstance(position[0], list):
+      position = position[0]
+    return ndb.GeoPt(float(position[1]), float(position[0]))
+  except (KeyError, IndexError, TypeError, ValueError):
+    return None
+
+
 def GetLocationFromXmlItem(item):
   lat = lon = ''
   try:
@@ -207,6 +306,16 @@ def GetKmlUrl(root_url, layer):
             urllib.urlencode([(k, v) for k, v in params if v]))
 
 
+def GetGeoJsonUrl(root_url, layer):
+  """Forms the URL that gets GeoJSON from kmlify for a layer, if it can."""
+  if layer.get('type') in [maproot.LayerType.GOOGLE_SPREADSHEET,
+                           maproot.LayerType.GEOJSON,
+                           maproot.LayerType.CSV]:
+    url = GetKmlUrl(root_url, layer)
+    return url and url + '&output=geojson'
+  return None
+
+
 def GetGeoPt(place):
   """Returns a geo location of a given place.
 
@@ -220,15 +329,17 @@ def GetGeoPt(place):
   return ndb.GeoPt(location['lat'], location['lng'])
 
 
-def GetFeaturesFromPlacesLayer(layer, location, radius):
-  """Builds a list of Feature objects for the Places layer near given location.
+def StartGetFeaturesFromPlacesLayer(layer, location, radius, deadline):
+  """Starts getting Feature objects for the Places layer near given location.
 
   Args:
     layer: Places layer that defines the criteria for places query
     location: db.GeoPt around which to retrieve places
     radius: Radius (in m) around location for searching features
+    deadline: Deadline (in s) for the Places API request, if one is needed
   Returns:
-    A list of Feature objects representing Google Places.
+    A function that waits for the request, if any, and returns a list of
+    Feature objects representing Google Places.
   """
   # Fetch JSON from the Places API nearby search
   places_layer = layer.get('source').get('google_places')
@@ -239,19 +350,21 @@ def GetFeaturesFromPlacesLayer(layer, location, radius):
       ('keyword', places_layer.get('keyword')),
       ('name', places_layer.get('name')),
       ('types', places_layer.get('types'))]
-  place_results = GetPlacesApiResults(PLACES_API_SEARCH_URL, request_params,
-                                      'results')
-
-  # Convert Places API results to Feature objects
-  features = []
-  for place in place_results:
-    # Delay building description_html until after features list was trimmed.
-    # Otherwise, we'd be doing wasteful calls to Places API
-    # to get address/phone number that will never get displayed.
-    features.append(Feature(place['name'], None, GetGeoPt(place),
-                            layer.get('id'), layer_type=layer.get('type'),
-                            gplace_id=place['place_id']))
-  return features
+  get_place_results = StartGetPlacesApiResults(
+      PLACES_API_SEARCH_URL, request_params, 'results', deadline)
+
+  def GetFeatures():
+    # Convert Places API results to Feature objects
+    features = []
+    for place in get_place_results():
+      # Delay building description_html until after features list was trimmed.
+      # Otherwise, we'd be doing wasteful calls to Places API
+      # to get address/phone number that will never get displayed.
+      features.append(Feature(place['name'], None, GetGeoPt(place),
+                              layer.get('id'), layer_type=layer.get('type'),
+                              gplace_id=place['place_id']))
+    return features
+  return GetFeatures
 
 
 def GetGooglePlaceDetails(place_id):
@@ -282,6 +395,18 @@ def GetPlacesApiResults(base_url, request_params, result_key_name=None):
     Value for the result_key_name in the Places API response or all of the
     response if result_key_name is None
   """
+  return StartGetPlacesApiResults(
+      base_url, request_params, result_key_name, DEADLINE)()
+
+
+def StartGetPlacesApiResults(base_url, request_params, result_key_name,
+                             deadline):
+  """Starts getting results from Places API; see GetPlacesApiResults.
+
+  Returns:
+    A function that waits for the request, if one was needed, and returns the
+    results.
+  """
   google_api_server_key = config.Get('google_api_server_key')
   if not google_api_server_key:
     raise base_handler.Error(
@@ -289,20 +414,39 @@ def GetPlacesApiResults(base_url, request_params, result_key_name=None):
   request_params += [('key', google_api_server_key)]
   url = base_url + urllib.urlencode([(k, v) for k, v in request_params if v])
 
-  # Call Places API if cache doesn't have a corresponding entry for the url
-  def GetPlacesJson():
-    response = urlfetch.fetch(url=url, deadline=DEADLINE)
-    return json.loads(response.content)
-  response_content = JSON_PLACES_API_CACHE.Get(url, GetPlacesJson)
+  # Call Places API if cache doesn't have a corresponding entry for the url.
+  # If it does, Get() takes care of refreshing it in the background.
+  if JSON_PLACES_API_CACHE.Peek(url) is None:
+    finish = StartFetchPlacesJson(url, deadline)
+    get_response = lambda: JSON_PLACES_API_CACHE.Get(url, finish)
+  else:
+    get_response = lambda: JSON_PLACES_API_CACHE.Get(url)
+
+  def GetResults():
+    response_content = get_response()
+
+    # Parse results
+    status = response_content.get('status')
+    if status != 'OK' and status != 'ZERO_RESULTS':
+      # Something went wrong with the request, log the error
+      logging.error('Places API request [%s] failed with error %s', url,
+                    status)
+      return []
+    return (response_content.get(result_key_name) if result_key_name
+            else response_content)
+  return GetResults
+
+
+def FetchPlacesJson(url):
+  """Fetches and parses a Places API response, for JSON_PLACES_API_CACHE."""
+  return StartFetchPlacesJson(url, DEADLINE)()
 
-  # Parse results
-  status = response_content.get('status')
-  if status != 'OK' and status != 'ZERO_RESULTS':
-    # Something went wrong with the request, log the error
-    logging.error('Places API request [%s] failed with error %s', url, status)
-    return []
-  return (response_content.get(result_key_name) if result_key_name
-          else response_content)
+
+def StartFetchPlacesJson(url, deadline):
+  """Starts a Places API request; returns a function that parses the result."""
+  rpc = urlfetch.create_rpc(deadline=deadline)
+  urlfetch.make_fetch_call(rpc, url)
+  return lambda: json.loads(rpc.get_result().content)
 
 
 def GetTopic(root, topic_id):
@@ -317,72 +461,165 @@ def GetFeatures(map_root, map_version_id, topic_id, request, location_center,
                 radius):
   """Gets a list of Feature objects for a given topic.
 
+  The fetches for all the layers are started at once, each with a deadline of
+  LAYER_TIMEOUT_SECONDS.  A layer whose source fails or times out is left out.
+
   Args:
     map_root: A dictionary with all the topics and layers information
     map_version_id: ID of the map version
     topic_id: ID of the crowd report topic; features are retrieved from the
         layers associated with this topic
     request: Original card request
-    location_center: db.GeoPt around which to retrieve features. So far only
-        Places layer uses this to narrow results according to the
-        distance from this location. All other layers ignore this for now
-        and just return all features. Note that Places layer doesn't have a set
-        radius around location_center, it just tries to find features
-        as close as possible to location_center.
+    location_center: db.GeoPt around which to retrieve features, or None to
+        get all the features of layers other than Places layers.  Places
+        layers use this to narrow results according to the distance from
+        this location; all other layers return only the features within
+        the given radius, with their distances set.  Note that Places layer
+        doesn't have a set radius around location_center, it just tries to
+        find features as close as possible to location_center.
     radius: Radius (in m) around location_center for searching features. This
-        can be  used for layers that can do prefiltering based on the radius.
-        Otherwise, features will be sorted and filtered by radius later on in
-        the flow.
+        is used by layers that can do prefiltering based on the radius.
+        Features will still be sorted and filtered by radius later on in the
+        flow.
 
   Returns:
-    A list of Feature objects associated with layers of a given topic in a given
-    map.
+    A pair (features, complete), where features is a list of Feature objects
+    associated with layers of a given topic in a given map, and complete is
+    False if any of the layers was left out.
   """
   topic = GetTopic(map_root, topic_id) or {}
-  features = []
-  for layer_id in topic.get('layer_ids', []):
-    layer = GetLayer(map_root, layer_id)
+  getters = [StartGetLayerFeatures(map_root, map_version_id, layer_id,
+                                   request, location_center, radius)
+             for layer_id in topic.get('layer_ids', [])]
+  features, complete = [], True
+  for get_layer_features in getters:
+    layer_features = get_layer_features()
+    if layer_features is None:
+      complete = False
+    else:
+      features += layer_features
+  return features, complete
+
+
+def StartGetLayerFeatures(map_root, map_version_id, layer_id, request,
+                          location_center, radius):
+  """Starts getting the Feature objects for one layer; see GetFeatures.
+
+  Returns:
+    A function that waits for the layer's fetch, if one was needed, and
+    returns a list of Feature objects, or None if the layer's source failed.
+  """
+  def LeaveOut(error):
+    logging.warning('Leaving out layer %r: %r', layer_id, error)
+
+  layer = GetLayer(map_root, layer_id)
+  try:
     if layer.get('type') == maproot.LayerType.GOOGLE_PLACES:
-      features += GetFeaturesFromPlacesLayer(layer, location_center, radius)
+      get_features = StartGetFeaturesFromPlacesLayer(
+          layer, location_center, radius, LAYER_TIMEOUT_SECONDS)
     else:
-      url = GetKmlUrl(request.root_url, layer or {})
-      if url:
-        try:
-          def GetXmlFeatures():
-            content = kmlify.FetchData(url, request.host)
-            return GetFeaturesFromXml(content, layer)
-          features += XML_FEATURES_CACHE.Get(
-              [url, map_root['id'], map_version_id, layer_id], GetXmlFeatures)
-        except (SyntaxError, urlfetch.DownloadError):
-          pass
-  return features
+      get_features = StartGetFeaturesFromUrl(
+          map_root, map_version_id, layer, request, location_center, radius)
+  except LAYER_ERRORS, e:
+    LeaveOut(e)
+    return lambda: None
+
+  def GetLayerFeatures():
+    try:
+      return get_features()
+    except LAYER_ERRORS, e:
+      LeaveOut(e)
+      return None
+  return GetLayerFeatures
+
+
+def StartGetFeaturesFromUrl(map_root, map_version_id, layer, request,
+                            location_center, radius):
+  """Starts getting the Features for a KML, GeoRSS, or kmlified layer.
+
+  The FeatureIndex for the layer is cached in XML_FEATURES_CACHE.  Nothing
+  here waits: if the index has to be fetched, the fetch is left running, and
+  if another thread is already making it, the wait is left to the returned
+  function, so that the other layers can be fetched at the same time.
+
+  Returns:
+    A function that returns the list of Features, waiting for the fetch if
+    necessary, and raises an error if the fetch or parse failed.
+  """
+  # Layers that go through kmlify are read as GeoJSON, which is much
+  # cheaper to produce and parse than KML.
+  geojson_url = GetGeoJsonUrl(request.root_url, layer or {})
+  url = geojson_url or GetKmlUrl(request.root_url, layer or {})
+  if not url:
+    return lambda: []
+
+  def StartFetch():
+    return kmlify.StartFetchData(url, request.host,
+                                 deadline=LAYER_TIMEOUT_SECONDS)
+
+  def MakeIndex(get_content):
+    if geojson_url:
+      return FeatureIndex(GetFeaturesFromGeoJson(get_content(), layer))
+    return FeatureIndex(GetFeaturesFromXml(get_content(), layer))
+
+  def GetFeaturesNear(index):
+    if location_center:
+      return index.GetFeaturesNear(location_center, radius)
+    return map(copy.copy, index.features)
+
+  key = [url, map_root['id'], map_version_id, layer['id']]
+  index, locked = XML_FEATURES_CACHE.GetOrLock(key)
+  if index is not None:
+    return lambda: GetFeaturesNear(index)
+  if not locked:
+    # Another thread is making the index; wait for it later.
+    return lambda: GetFeaturesNear(
+        XML_FEATURES_CACHE.Get(key, lambda: MakeIndex(StartFetch())))
+
+  # We have the lock, so we must store an index or a failure.
+  try:
+    get_content = StartFetch()
+  except urlfetch.Error, e:
+    def Fail():
+      raise e
+    index = XML_FEATURES_CACHE.Make(key, Fail)  # the old index, if any
+    return lambda: GetFeaturesNear(index)
+  return lambda: GetFeaturesNear(
+      XML_FEATURES_CACHE.Make(key, lambda: MakeIndex(get_content)))
 
 
 def SetDistanceOnFeatures(features, center):
-  for f in features:
-    f.distance = EarthDistance(center, f.location)
+  distances = spherical.GetEarthDistances(
+      center, [f.location.lat for f in features],
+      [f.location.lon for f in features], EARTH_RADIUS)
+  for f, distance in zip(features, distances):
+    f.distance = distance
 
 
 def FilterFeatures(features, radius, max_count):
-  # TODO(kpy): A top-k selection algorithm could be faster than O(n log n)
-  # sort.  It seems likely to me that the gain would be small enough that it's
-  # not worth the code complexity, but it wouldn't hurt to check my hunch.
-  features.sort()  # sorts by distance; see Feature.__cmp__
-  features[:] = [f for f in features[:max_count] if f.distance < radius]
+  # Selecting the nearest max_count with a heap is O(n log max_count), and
+  # gives the same order as a stable sort by distance.
+  features[:] = heapq.nsmallest(
+      max_count, [f for f in features if f.distance < radius],
+      key=lambda f: f.distance)
 
 
 def GetFilteredFeatures(map_root, map_version_id, topic_id, request,
                         center, radius, max_count):
   """Gets a list of the Feature objects for a topic within the given circle."""
   def GetFromDatastore():
-    features = GetFeatures(map_root, map_version_id, topic_id, request, center,
-                           radius)
+    features, complete = GetFeatures(map_root, map_version_id, topic_id,
+                                     request, center, radius)
     if center:
-      SetDistanceOnFeatures(features, center)
+      # Only the Places features still need their distances.
+      SetDistanceOnFeatures([f for f in features if f.distance is None],
+                            center)
     FilterFeatures(features, radius, max_count)
     # For the features that were selected for display, fetch additional details
     # that we avoid retrieving for unfiltered results due to latency concerns
     SetDetailsOnFilteredFeatures(features)
+    if not complete:
+      return cache.CacheEntry(features, INCOMPLETE_FEATURES_TTL_SECONDS)
     return features
 
   return FILTERED_FEATURES_CACHE.Get(
@@ -516,18 +753,12 @@ def SetAnswersAndReportsOnFeatures(features, map_root, topic_id, qids):
       return choice and choice.get('color')
 
   if topic.get('crowd_enabled') and qids:
+    tags = [model.GetCrowdReportTag(map_id + '.' + topic_id)]
     for f in features:
-      # Even though we use the radius to get the latest answers, the cache key
-      # omits radius so that InvalidateReportCache can quickly delete cache
-      # entries without fetching from the datastore.  So, when a cluster radius
-      # is changed and its map is republished, affected entries in the answer
-      # cache will be stale until they expire.  This seems like a good tradeoff
-      # because (a) changing a cluster radius in a published map is rare (less
-      # than once per map); (b) the answer cache has a short TTL (15 s); and
-      # (c) posting crowd reports is frequent (many times per day).
       answers, answer_times, report_dicts = REPORT_CACHE.Get(
-          [map_id, topic_id, RoundGeoPt(f.location)],
-          lambda: GetAnswersAndReports(map_id, topic_id, f.location, radius))
+          [map_id, topic_id, RoundGeoPt(f.location), radius],
+          lambda: GetAnswersAndReports(map_id, topic_id, f.location, radius),
+          tags=tags)
       f.answers = answers
       f.answer_text = FormatAnswers(answers)
       if answer_times:
@@ -558,12 +789,12 @@ def _GetAgeInMinutes(dt):
   return int(seconds / 60 + 0.5)
 
 
-def InvalidateReportCache(full_topic_ids, location):
-  """Deletes cached answers affected by a new report at a given location."""
-  for full_topic_id in full_topic_ids:
-    if '.' in full_topic_id:
-      map_id, topic_id = full_topic_id.split('.')
-      REPORT_CACHE.Delete([map_id, topic_id, RoundGeoPt(location)])
+def InvalidateReportCache(full_topic_ids):
+  """Invalidates all cached answers for the topics of a new report."""
+  tags = [model.GetCrowdReportTag(full_topic_id)
+          for full_topic_id in full_topic_ids if '.' in full_topic_id]
+  if tags:
+    cache.InvalidateTags(*tags)
 
 
 def GetGeoJson(features, include_descriptions):
@@ -19,6 +19,7 @@ import card
 import config
 import kmlify
 import model
+import spherical
 import test_utils
 import utils
 
@@ -43,6 +44,25 @@ KML_DATA = '''<?xml version="1.0" encoding="UTF-8" ?>
 </kml>
 '''
 
+GEOJSON_DATA = json.dumps({
+    'type': 'FeatureCollection',
+    'features': [{
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [25, 60]},
+        'properties': {'name': 'Helsinki', 'description': 'description1'}
+    }, {
+        'type': 'Feature',
+        'geometry': {'type': 'LineString',
+                     'coordinates': [[-83, 40, 1], [-80, 41, 1]]},
+        'properties': {'name': 'Columbus',
+                       'description': '<a>description</a><2>two'}
+    }, {
+        'type': 'Feature',
+        'geometry': None,
+        'properties': {'name': 'Nowhere'}
+    }]
+})
+
 GEORSS_DATA = '''
 <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
     xmlns="http://purl.org/rss/1.0/"
@@ -190,6 +210,11 @@ MAP_ROOT = {
 }
 
 
+def UrlResponse(content):
+  """Makes a fake urlfetch response with the given content."""
+  return utils.Struct(status_code=200, content=content)
+
+
 class CardTest(test_utils.BaseTest):
   """Tests for functions in card.py."""
 
@@ -214,13 +239,43 @@ class CardTest(test_utils.BaseTest):
 
   def testEarthDistance(self):
     def Distance(lat1, lon1, lat2, lon2):
-      return card.EarthDistance(ndb.GeoPt(lat1, lon1), ndb.GeoPt(lat2, lon2))
+      return spherical.GetEarthDistances(
+          ndb.GeoPt(lat1, lon1), [lat2], [lon2], card.EARTH_RADIUS)[0]
 
     self.assertEquals(0, Distance(5, 5, 5, 5))
     self.assertTrue(abs(Distance(0, 0, 90, 0) - 10018538) < 1)
     self.assertTrue(abs(Distance(0, 0, 0, 90) - 10018538) < 1)
     self.assertTrue(abs(Distance(45, 0, 45, 90) - 6679025) < 1)
 
+  def testFeatureIndex(self):
+    features = [card.Feature(str(i), '', ndb.GeoPt(lat, lon))
+                for i, (lat, lon) in enumerate([
+                    (20, 50), (20.5, 50.5), (21, 50), (30, 50),
+                    (0, 179.9), (0, -179.9), (0, 178), (89.5, 0), (89.5, 90),
+                    (20.85, 50.9)])]
+    index = card.FeatureIndex(features)
+    def GetNames(lat, lon, radius):
+      center = ndb.GeoPt(lat, lon)
+      return [f.name for f in index.GetFeaturesNear(center, radius)]
+
+    # Only the features inside the circle are returned, even though '9' is
+    # in the box around the circle for the first query.
+    self.assertEquals(['0', '1'], GetNames(20, 50, 100000))
+    self.assertEquals(['0', '1', '2', '9'], GetNames(20, 50, 150000))
+    self.assertEquals([], GetNames(-20, 50, 100000))
+
+    # Boxes can cross the 180-degree meridian and include the poles.
+    self.assertEquals(['4', '5'], GetNames(0, 180, 100000))
+    self.assertEquals(['4', '5', '6'], GetNames(0, -179.5, 300000))
+    self.assertEquals(['7', '8'], GetNames(89, -90, 200000))
+
+    # The results are copies with their distances set.
+    result = index.GetFeaturesNear(ndb.GeoPt(21, 50), 200000)
+    self.assertEquals(['0', '1', '2', '9'], [f.name for f in result])
+    self.assertTrue(abs(result[0].distance - 111317) < 1)
+    self.assertEquals(0, result[2].distance)
+    self.assertEquals(None, features[0].distance)
+
   def testInvalidContent(self):
     self.assertEquals([], card.GetFeaturesFromXml('xyz'))
 
@@ -259,6 +314,11 @@ class CardTest(test_utils.BaseTest):
                       for f in card.GetFeaturesFromXml(ATOM_DATA)]
     self.assertEquals(FEATURE_FIELDS, feature_fields)
 
+  def testGetFeaturesFromGeoJson(self):
+    feature_fields = [(f.name, f.description_html, f.location)
+                      for f in card.GetFeaturesFromGeoJson(GEOJSON_DATA)]
+    self.assertEquals(FEATURE_FIELDS, feature_fields)
+
   def testGetKmlUrl(self):
     self.assertEquals('http://example.com/foo.kml', card.GetKmlUrl(ROOT_URL, {
         'type': 'KML',
@@ -378,12 +438,12 @@ class CardTest(test_utils.BaseTest):
 
     # Try the same request again and make sure the result comes from cache
     # (i.e. there are no calls to the urlfetch)
-    self.mox.StubOutWithMock(urlfetch, 'fetch')
+    self.mox.StubOutWithMock(urlfetch, 'create_rpc')
     self.mox.ReplayAll()
     self.assertEquals(
         PLACES_FEATURES,
-        card.GetFeaturesFromPlacesLayer(MAP_ROOT.get('layers')[3],
-                                        ndb.GeoPt(20, 50), 100000))
+        card.StartGetFeaturesFromPlacesLayer(MAP_ROOT.get('layers')[3],
+                                             ndb.GeoPt(20, 50), 100000, 10)())
 
   def testGetFeaturesFromPlacesLayer_WithBadResponseStatus(self):
     self.AssertGetFeaturesFromPlacesLayer(
@@ -398,7 +458,7 @@ class CardTest(test_utils.BaseTest):
   def AssertGetFeaturesFromPlacesLayer(self,
                                        api_response_content,
                                        expected_results):
-    """Verifies GetFeaturesFromPlacesLayer with given input and output.
+    """Verifies StartGetFeaturesFromPlacesLayer with given input and output.
 
     Prepares a mock for urlfetch to return given api_response_content on a call
     to the Places API. Verifies that GetJsonFromGooglePlacesApi returns
@@ -420,14 +480,13 @@ class CardTest(test_utils.BaseTest):
            '&types=pharmacy'
            '&key=someFakeApiKey')
     url_responses = {url: utils.Struct(content=api_response_content)}
-    self.mox.stubs.Set(
-        urlfetch, 'fetch', lambda url, **kwargs: url_responses[url])
+    self.StubFetch(lambda url, **kwargs: url_responses[url])
 
     # Get Features based on Google Places API results for the layer
     self.assertEquals(
         expected_results,
-        card.GetFeaturesFromPlacesLayer(MAP_ROOT.get('layers')[3],
-                                        ndb.GeoPt(20, 50), 100000))
+        card.StartGetFeaturesFromPlacesLayer(MAP_ROOT.get('layers')[3],
+                                             ndb.GeoPt(20, 50), 100000, 10)())
     self.mox.UnsetStubs()
 
   def testSetDetailsOnFilteredFeatures(self):
@@ -457,8 +516,7 @@ class CardTest(test_utils.BaseTest):
     })
     url = card.PLACES_API_DETAILS_URL + 'placeid=placeId2&key=someFakeApiKey'
     url_responses[url] = utils.Struct(content=api_response_content)
-    self.mox.stubs.Set(
-        urlfetch, 'fetch', lambda url, **kwargs: url_responses[url])
+    self.StubFetch(lambda url, **kwargs: url_responses[url])
 
     exp_features = [
         ('Helsinki', '<div>Street1</div><div>111-111-1111</div>',
@@ -499,28 +557,74 @@ class CardTest(test_utils.BaseTest):
 
   def testGetFeatures(self):
     # Try getting features for a topic with two layers.
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: 'data from ' + url)
+    self.StubFetch(lambda url, **kwargs: UrlResponse('data from ' + url))
     self.SetForTest(
         card, 'GetFeaturesFromXml',
-        lambda data, layer: ['parsed ' + data + ' for ' + layer.get('id')])
+        lambda data, layer: [card.Feature('parsed ' + data + ' for ' +
+                                          layer.get('id'), '',
+                                          ndb.GeoPt(20, 50))])
+    features, complete = card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50), 100000)
     self.assertEquals(
         ['parsed data from http://example.com/one.kml for layer1',
          'parsed data from http://example.com/three.kml for layer3'],
-        card.GetFeatures(MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50),
-                         100000))
+        [f.name for f in features])
+    self.assertTrue(complete)
+
+  def testGetFeaturesNearCenter(self):
+    # Only the features near the center should be returned, and all of them
+    # without a center.
+    self.StubFetch(lambda url, **kwargs: UrlResponse('data from ' + url))
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature('near', '', ndb.GeoPt(20, 50)),
+        card.Feature('far', '', ndb.GeoPt(-20, 50))])
+    self.assertEquals(['near', 'near'], [f.name for f in card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20.1, 50), 100000)[0]])
+    self.assertEquals(['near', 'far', 'near', 'far'], [
+        f.name for f in card.GetFeatures(
+            MAP_ROOT, 'm1', 't1', self.request, None, 100000)[0]])
+
+  def testGetFeaturesFromKmlifiedLayer(self):
+    # Layers that go through kmlify should be fetched as GeoJSON.
+    map_root = {
+        'id': 'm1',
+        'topics': [{'id': 't1', 'layer_ids': ['layer1', 'csv']}],
+        'layers': MAP_ROOT['layers'][:1] + [{
+            'id': 'csv',
+            'type': 'CSV',
+            'source': {'csv': {'url': 'http://example.com/data.csv',
+                               'latitude_field': 'lat',
+                               'longitude_field': 'lon'}}
+        }]
+    }
+    urls = []
+    def Fetch(url, **unused_kwargs):
+      urls.append(url)
+      return UrlResponse(url.endswith('.kml') and KML_DATA or GEOJSON_DATA)
+    self.StubFetch(Fetch)
+    features, _ = card.GetFeatures(map_root, 'm1', 't1', self.request,
+                                   ndb.GeoPt(20, 50), 100000)
+    self.assertEquals(FEATURE_FIELDS * 2, [(f.name, f.description_html,
+                                            f.location) for f in features])
+    self.assertEquals('http://example.com/one.kml', urls[0])
+    self.assertTrue(urls[1].startswith('http://app.com/root/.kmlify?'))
+    self.assertTrue(urls[1].endswith('&output=geojson'))
+    self.assertEquals(None, card.GetGeoJsonUrl(ROOT_URL, MAP_ROOT['layers'][0]))
 
   def testGetFeaturesWithFailedFetches(self):
     # Even if some fetches fail, we should get features from the others.
-    def FetchButSometimesFail(url, unused_host):
+    def FetchButSometimesFail(url, **unused_kwargs):
       if 'one.kml' in url:
         raise urlfetch.DownloadError
-      return 'data from ' + url
-    self.SetForTest(kmlify, 'FetchData', FetchButSometimesFail)
-    self.SetForTest(card, 'GetFeaturesFromXml',
-                    lambda data, layer: ['parsed ' + data])
+      return UrlResponse('data from ' + url)
+    self.StubFetch(FetchButSometimesFail)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature('parsed ' + data, '', ndb.GeoPt(20, 50))])
+    features, complete = card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50), 100000)
     self.assertEquals(['parsed data from http://example.com/three.kml'],
-                      card.GetFeatures(MAP_ROOT, 'm1', 't1', self.request,
-                                       ndb.GeoPt(20, 50), 100000))
+                      [f.name for f in features])
+    self.assertFalse(complete)
 
   def testGetFeaturesWithFailedParsing(self):
     # Even if some files don't parse, we should get features from the others.
@@ -529,17 +633,70 @@ class CardTest(test_utils.BaseTest):
         return
       if 'three.kml' in data:
         raise SyntaxError
-      return ['parsed ' + data]
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: 'data from ' + url)
+      return [card.Feature('parsed ' + data, '', ndb.GeoPt(20, 50))]
+    self.StubFetch(lambda url, **kwargs: UrlResponse('data from ' + url))
     self.SetForTest(card, 'GetFeaturesFromXml', ParseButSometimesFail)
+    features, complete = card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50), 100000)
     self.assertEquals(['parsed data from http://example.com/one.kml'],
-                      card.GetFeatures(MAP_ROOT, 'm1', 't1', self.request,
-                                       ndb.GeoPt(20, 50), 100000))
+                      [f.name for f in features])
+    self.assertFalse(complete)
+
+  def testGetFeaturesFetchesLayersConcurrently(self):
+    # All the fetches should start before any of them is waited for, and each
+    # should have its own deadline.
+    events = []
+    def StartFetchData(url, unused_referer, deadline):
+      events.append(('start', url, deadline))
+      def GetData():
+        events.append(('finish', url))
+        return url
+      return GetData
+    self.SetForTest(kmlify, 'StartFetchData', StartFetchData)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature(data, '', ndb.GeoPt(20, 50))])
+    features, _ = card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50), 100000)
+    one, three = 'http://example.com/one.kml', 'http://example.com/three.kml'
+    self.assertEquals([one, three], [f.name for f in features])
+    self.assertEquals([('start', one, card.LAYER_TIMEOUT_SECONDS),
+                       ('start', three, card.LAYER_TIMEOUT_SECONDS),
+                       ('finish', one), ('finish', three)], events)
+
+  def testGetFeaturesWithSlowLayer(self):
+    # A layer whose fetch runs past its deadline should be left out.
+    def FetchButSometimesTimeOut(url, **unused_kwargs):
+      if 'one.kml' in url:
+        raise urlfetch.DeadlineExceededError
+      return UrlResponse(url)
+    self.StubFetch(FetchButSometimesTimeOut)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature(data, '', ndb.GeoPt(20, 50))])
+    features, complete = card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50), 100000)
+    self.assertEquals(['http://example.com/three.kml'],
+                      [f.name for f in features])
+    self.assertFalse(complete)
+
+  def testGetFeaturesWithFetchThatCannotStart(self):
+    # A layer whose fetch fails to start should be left out too.
+    def StartFetchData(url, unused_referer, deadline):
+      if 'one.kml' in url:
+        raise urlfetch.InvalidURLError
+      return lambda: url
+    self.SetForTest(kmlify, 'StartFetchData', StartFetchData)
+    self.SetForTest(card, 'GetFeaturesFromXml', lambda data, layer: [
+        card.Feature(data, '', ndb.GeoPt(20, 50))])
+    features, complete = card.GetFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(20, 50), 100000)
+    self.assertEquals(['http://example.com/three.kml'],
+                      [f.name for f in features])
+    self.assertFalse(complete)
 
   def testGetFeaturesWithInvalidTopicId(self):
     # GetFeatures should accept a nonexistent topic without raising exceptions.
-    self.assertEquals([], card.GetFeatures(MAP_ROOT, 'm1', 'xyz', self.request,
-                                           ndb.GeoPt(20, 50), 100000))
+    self.assertEquals(([], True), card.GetFeatures(
+        MAP_ROOT, 'm1', 'xyz', self.request, ndb.GeoPt(20, 50), 100000))
 
   def testGetAnswersAndReports(self):
     now = datetime.datetime.utcnow()
@@ -619,6 +776,12 @@ class CardTest(test_utils.BaseTest):
     self.assertEquals(0, features[0].distance)
     self.assertTrue(abs(features[1].distance - 157398) < 1)
 
+    # The results should be the same without NumPy.
+    self.SetForTest(spherical, 'numpy', None)
+    card.SetDistanceOnFeatures(features, ndb.GeoPt(1, 1))
+    self.assertEquals(0, features[0].distance)
+    self.assertTrue(abs(features[1].distance - 157398) < 1)
+
   def testFilterFeatures(self):
     all_features = [card.Feature('name3', 'desc3', ndb.GeoPt(3, 3)),
                     card.Feature('name2', 'desc2', ndb.GeoPt(2, 2)),
@@ -642,6 +805,23 @@ class CardTest(test_utils.BaseTest):
     card.FilterFeatures(features, 100, 1)
     self.assertEquals(['name1'], [f.name for f in features])
 
+  def testGetFilteredFeaturesWithMissingLayer(self):
+    # A list that is missing a layer should be cached only briefly.
+    feature = card.Feature('name1', 'desc1', ndb.GeoPt(1, 1))
+    complete = [True]
+    self.SetForTest(card, 'GetFeatures',
+                    lambda *args: ([feature], complete[0]))
+    self.SetForTest(card, 'FILTERED_FEATURES_CACHE',
+                    utils.Struct(Get=lambda key, make_value: make_value()))
+    self.assertEquals([feature], card.GetFilteredFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(1, 1), 100, 10))
+
+    complete[0] = False
+    entry = card.GetFilteredFeatures(
+        MAP_ROOT, 'm1', 't1', self.request, ndb.GeoPt(1, 1), 100, 10)
+    self.assertEquals([feature], entry.value)
+    self.assertEquals(card.INCOMPLETE_FEATURES_TTL_SECONDS, entry.ttl)
+
   def testGetGeoJson(self):
     html_attrs = ['<a href="google.com">attr1</a>', 'attr2']
     features = [card.Feature('title1', 'description1', ndb.GeoPt(20, -40),
@@ -681,7 +861,7 @@ class CardHandlerTest(test_utils.BaseTest):
       model.CatalogEntry.Create('xyz.com', 'foo', map_object)
 
   def testGetCardByIdAndTopic(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(KML_DATA))
     with test_utils.RootLogin():
       geojson = self._GetGeoJson('/.card/%s.t1' % self.map_id)
     self.assertEquals('Topic 1', geojson['properties']['topic']['title'])
@@ -689,7 +869,7 @@ class CardHandlerTest(test_utils.BaseTest):
     self.assertTrue(self._FeatureInResponse(geojson, 'Columbus'))
 
   def testGetCardByLabelAndTopic(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(KML_DATA))
     geojson = self._GetGeoJson('/xyz.com/.card/foo/t2')
     self.assertEquals('FeatureCollection', geojson['type'])
     self.assertEquals('Topic 2', geojson['properties']['topic']['title'])
@@ -715,7 +895,7 @@ class CardHandlerTest(test_utils.BaseTest):
     ]
     self.SetForTest(model.CrowdReport, 'GetByLocation',
                     staticmethod(lambda *args, **kwargs: reports))
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(KML_DATA))
 
     # Verify there are reports with show_reports=1 param in the request
     geojson = self._GetGeoJson('/xyz.com/.card/foo/t2?qids=q1&show_reports=1')
@@ -730,7 +910,7 @@ class CardHandlerTest(test_utils.BaseTest):
     self.assertEquals(0, len(geojson['features'][0]['properties']['reports']))
 
   def testGetCardByLabelAndTopicWithDescriptionsEnabled(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(KML_DATA))
     # Enable descriptions with show_desc=1 param in the request
     geojson = self._GetGeoJson('/xyz.com/.card/foo/t2?show_desc=1')
     self.assertEquals('Topic 2', geojson['properties']['topic']['title'])
@@ -755,7 +935,7 @@ class CardHandlerTest(test_utils.BaseTest):
           </Document>
         </kml>
         '''
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: kml_data_with_xss)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(kml_data_with_xss))
     # Enable descriptions with show_desc=1 param in the request
     geojson = self._GetGeoJson('/xyz.com/.card/foo/t2?show_desc=1')
     self.assertTrue(self._FeatureInResponse(geojson, 'Paris'))
@@ -764,7 +944,7 @@ class CardHandlerTest(test_utils.BaseTest):
                       geojson['features'][0]['properties']['description_html'])
 
   def testPostByLabelAndTopic(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(KML_DATA))
     response = self.DoPost('/xyz.com/.card/foo/t2', 'll=60,25&n=1&r=100')
     geojson = json.loads(response.body)
     self.assertEquals('Topic 2', geojson['properties']['topic']['title'])
@@ -776,7 +956,7 @@ class CardHandlerTest(test_utils.BaseTest):
     self.assertEquals('foo/t1', response.headers['Location'])
 
   def testFeatureDistanceUnits(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(KML_DATA))
 
     def AssertUnitsInResponseTo(expected_unit, url, country_header=None):
       headers = ({'X-AppEngine-Country': country_header} if country_header
@@ -798,7 +978,7 @@ class CardHandlerTest(test_utils.BaseTest):
                             country_header='US')
 
   def testMapLink(self):
-    self.SetForTest(kmlify, 'FetchData', lambda url, host: KML_DATA)
+    self.StubFetch(lambda url, **kwargs: UrlResponse(KML_DATA))
 
     def AssertMapLinkInResponseTo(expected_link, url):
       response = self.DoGet(url)
@@ -26,8 +26,17 @@ import cache
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 
+
+class FetchError(base_handler.Error):
+  """The remote server responded to a fetch with an error status."""
+  pass
+
+
 CACHE_TTL_SECONDS = 60
-CACHE = cache.Cache('jsonp', CACHE_TTL_SECONDS)
+FAILURE_TTL_SECONDS = 10  # how long to remember that a fetch failed
+CACHE = cache.Cache('jsonp', CACHE_TTL_SECONDS,
+                    failure_ttl=FAILURE_TTL_SECONDS,
+                    failure_types=(urlfetch.Error, FetchError))
 QPM_CACHE = cache.Cache('jsonp.qpm', 0)  # used only for making cache keys
 MAX_OUTBOUND_QPM_PER_IP = 30  # maximum outbound HTTP fetches/min per client IP
 HTTP_TOO_MANY_REQUESTS = 429  # this HTTP status code is not defined in httplib
@@ -96,7 +105,10 @@ def FetchJson(url, post_json, use_cache, client_ip, referrer=None):
     A dictionary or list parsed from the fetched JSON.
 
   Raises:
-    base_handler.Error: The request failed or exceeded the rate limit.
+    base_handler.Error: The request failed or exceeded the rate limit.  If
+        use_cache is true, failed requests are remembered for
+        FAILURE_TTL_SECONDS, during which the same error is raised again
+        without performing the fetch.
   """
   url = SanitizeUrl(url)
 
@@ -111,7 +123,7 @@ def FetchJson(url, post_json, use_cache, client_ip, referrer=None):
     if result.status_code != httplib.OK:
       logging.warn('Request for url=%r post_json=%r returned status %r: %r',
                    url, post_json, result.status_code, result.content)
-      raise base_handler.Error(result.status_code, 'Request failed.')
+      raise FetchError(result.status_code, 'Request failed.')
     return ParseJson(result.content)
 
   return CACHE.Get(url, Fetch) if use_cache and not post_json else Fetch()
@@ -10,7 +10,7 @@
 # OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
 # specific language governing permissions and limitations under the License.
 
-"""Gets records from CSV, GeoJSON, or XML and emits them as KML placemarks."""
+"""Gets records from CSV, GeoJSON, or XML and emits them as KML or GeoJSON."""
 
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
@@ -18,22 +18,29 @@ __author__ = 'kpy@google.com (Ka-Ping Yee)'
 import base_handler
 
 import StringIO
-import collections
 import csv
+import hashlib
 import json
 import logging
+import math
 import re
 import string
+import time
 import urllib
 import xml_utils
 import zipfile
+import zlib
 
 import cache
+import local_cache
+import maproot
+import metadata_fetch
 
 from google.appengine.api import urlfetch
 
 KMZ_CONTENT_TYPE = 'application/vnd.google-earth.kmz'
 KML_CONTENT_TYPE = 'application/vnd.google-earth.kml+xml'
+GEOJSON_CONTENT_TYPE = 'application/json'
 KML_DOCUMENT_TEMPLATE = """\
 <?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
@@ -52,7 +59,43 @@ OPERATORS = {
     '>=': lambda x, y: x >= y,
 }
 CACHE_TTL_SECONDS = 60
-CACHE = cache.Cache('kmlify', CACHE_TTL_SECONDS)
+# Entries are revalidated every CACHE_TTL_SECONDS, but are kept this long so
+# that a source that hasn't changed can be reused without being parsed or
+# rendered again.  Most feeds change much less often than they are polled.
+MAX_AGE_SECONDS = 6 * 3600
+# If a source can't be fetched, output made from the last good copy of it is
+# served instead of an error, until that copy is this old.  A flaky server
+# shouldn't blank a layer for everyone, but a dead one shouldn't show old
+# data forever.
+MAX_STALE_SECONDS = 3600
+# Values are (content, source_hashes, fetch_time) triples, where content is
+# the KMZ or GeoJSON string, source_hashes identifies the source data it was
+# made from, and fetch_time is when the oldest of that data was fetched.
+# Strings are immutable, so local hits can share them.
+CACHE = cache.Cache('kmlify.kmz', MAX_AGE_SECONDS, CACHE_TTL_SECONDS,
+                    local_mode=local_cache.FROZEN)
+# Parsed source data, as dictionaries from StartFetchSource, so that requests
+# that render the same source differently fetch and parse it only once.
+# Readers unpack the tables into new records, so they can share.
+SOURCE_CACHE = cache.Cache('kmlify.source', MAX_AGE_SECONDS, CACHE_TTL_SECONDS,
+                           local_mode=local_cache.FROZEN)
+# The MapRoot layer types under which metadata_fetch may have fetched a source
+# of each data type; see GetSourceMetadata.
+METADATA_LAYER_TYPES = {
+    'xml': [maproot.LayerType.KML, maproot.LayerType.GEORSS],
+    'csv': [maproot.LayerType.CSV],
+    'geojson': [maproot.LayerType.GEOJSON],
+}
+# Size of the cells of the spatial index used to select records by bbox.
+GRID_CELL_DEGREES = 0.5
+# With a zoom level, records are thinned to at most one per square cell of
+# about this many pixels, so that low zoom levels get an even sample.
+THINNING_CELL_PIXELS = 8
+# Encodes output=geojson compactly.  Encoding a whole document in one call
+# lets the json module use its C encoder.
+GEOJSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+# Record fields that hold KML elements, which are serialized in packed tables.
+ELEMENT_FIELDS = ['__geometry__', '__style__']
 
 
 def Stringify(text, html=False):
@@ -86,6 +129,19 @@ def UrlQuote(text):
   return urllib.quote(Stringify(text))
 
 
+def LogXmlSyntaxError(xml, error):
+  """Logs a SyntaxError from parsing XML, with the input around the error."""
+  xml = xml.replace('\r', '\n')  # simplify line numbering of SyntaxErrors
+  logging.error('syntax error in XML input (%s)', error)
+  logging.info('beginning of input: %r', xml[:200])
+  match = re.search(r'line (\d+), column (\d+)', error.message)
+  if match:
+    lineno, column = int(match.group(1)), int(match.group(2))
+    offset = len('\n'.join(xml.split('\n')[:lineno - 1])) + 1 + column - 1
+    logging.info('before the error: %r', xml[:offset][-100:])
+    logging.info('after the error: %r', xml[offset:][:100])
+
+
 def ParseXml(xml):
   """Tries to parse some XML, logging informative errors if parsing fails."""
   xml = xml.replace('\r', '\n')  # simplify line numbering of SyntaxErrors
@@ -95,14 +151,29 @@ def ParseXml(xml):
     try:  # in case there's no root element, try adding one
       return xml_utils.Parse('<_>' + xml + '</_>')
     except SyntaxError:  # report the original error in a more informative way
-      logging.error('syntax error in XML input (%s)', e)
-      logging.info('beginning of input: %r', xml[:200])
-      match = re.search(r'line (\d+), column (\d+)', e.message)
-      if match:
-        lineno, column = int(match.group(1)), int(match.group(2))
-        offset = len('\n'.join(xml.split('\n')[:lineno - 1])) + 1 + column - 1
-        logging.info('before the error: %r', xml[:offset][-100:])
-        logging.info('after the error: %r', xml[offset:][:100])
+      LogXmlSyntaxError(xml, e)
+      raise e
+
+
+def ScanXml(xml, scanner):
+  """Parses XML incrementally, with the same fallbacks and logging as ParseXml.
+
+  Args:
+    xml: A string of XML to parse.
+    scanner: A function that consumes an iterator of ('start', element) and
+        ('end', element) pairs and returns a result.  If the XML has no root
+        element, the scanner is called a second time with a new iterator.
+  Returns:
+    The result of the scanner.
+  """
+  try:
+    return scanner(xml_utils.IterParse(xml, ('start', 'end')))
+  except SyntaxError, e:
+    try:  # in case there's no root element, try adding one
+      return scanner(
+          xml_utils.IterParse('<_>' + xml + '</_>', ('start', 'end')))
+    except SyntaxError:  # report the original error in a more informative way
+      LogXmlSyntaxError(xml, e)
       raise e
 
 
@@ -131,16 +202,134 @@ def UnzipData(data, preferred_filename_regex='.*'):
   return ''  # zip archive contains no entries, return ''
 
 
-def MakeKmz(kml):
-  """Packs a KML document into a KMZ file."""
-  output_buffer = StringIO.StringIO()
-  archive = zipfile.ZipFile(output_buffer, 'w')
-  info = zipfile.ZipInfo('doc.kml')
-  info.external_attr = 0644 << 16L  # Unix permission bits
-  info.compress_type = zipfile.ZIP_DEFLATED
-  archive.writestr(info, kml)
-  archive.close()
-  return output_buffer.getvalue()
+def SerializeChildren(elements):
+  """Serializes elements as they would appear within a serialized Document."""
+  if not elements:
+    return ''
+  document = xml_utils.Serialize(xml_utils.Xml('Document', *elements))
+  return document[len('<Document>'):-len('\n</Document>')]
+
+
+def Crc32Combine(crc1, crc2, length2):
+  """Gets the CRC-32 of a + b from crc32(a), crc32(b), and len(b).
+
+  This is zlib's crc32_combine, which Python's zlib module doesn't expose.
+  It works by applying length2 zero bytes' worth of CRC steps to crc1, as a
+  linear operator over GF(2) that is squared log2(length2) times.
+  """
+  def Times(matrix, vector):
+    total, i = 0, 0
+    while vector:
+      if vector & 1:
+        total ^= matrix[i]
+      vector >>= 1
+      i += 1
+    return total
+
+  def Square(matrix):
+    return [Times(matrix, row) for row in matrix]
+
+  crc1 &= 0xffffffff
+  if length2 <= 0:
+    return crc1
+  # The operator for one zero bit, then for two bits and for four bits.
+  odd = [0xedb88320] + [1 << n for n in range(31)]
+  even = Square(odd)
+  odd = Square(even)
+  while True:
+    even = Square(odd)  # the operator for the next power of two zero bytes
+    if length2 & 1:
+      crc1 = Times(even, crc1)
+    length2 >>= 1
+    if not length2:
+      break
+    odd = Square(even)
+    if length2 & 1:
+      crc1 = Times(odd, crc1)
+    length2 >>= 1
+    if not length2:
+      break
+  return crc1 ^ (crc2 & 0xffffffff)
+
+
+class KmzWriter(object):
+  """Packs a KML Document into a KMZ file, a few child elements at a time.
+
+  Elements are serialized and compressed in small batches as they are
+  written, so the whole Document never has to be held in memory, as a tree or
+  as text.  The result is the same as filling in KML_DOCUMENT_TEMPLATE with
+  the complete Document, serialized by xml_utils.Serialize.
+  """
+  BATCH_SIZE = 100
+
+  def __init__(self):
+    self.compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self.chunks = []  # compressed data
+    self.size = 0  # uncompressed size of the data in self.chunks
+    self.crc = 0  # CRC-32 of the data in self.chunks
+    self.batch = []  # elements not yet serialized
+    self.num_children = 0
+
+  def _Compress(self, data):
+    self.chunks.append(self.compressor.compress(data))
+    self.size += len(data)
+    self.crc = zlib.crc32(data, self.crc)
+
+  def Write(self, element):
+    """Appends an element to the Document."""
+    self.batch.append(element)
+    self.num_children += 1
+    if len(self.batch) >= self.BATCH_SIZE:
+      self._Compress(SerializeChildren(self.batch))
+      self.batch = []
+
+  def Close(self, leading_elements=()):
+    """Finishes the KMZ file.
+
+    Args:
+      leading_elements: Elements to place before all the written elements in
+          the Document, such as shared styles that weren't known until all
+          the other elements were written.
+    Returns:
+      The KMZ file, as a string.
+    """
+    head, tail = KML_DOCUMENT_TEMPLATE.split('%s')
+    leading = SerializeChildren(leading_elements)
+    if leading or self.num_children:
+      head += '<Document>' + leading
+      self._Compress(SerializeChildren(self.batch) + '\n</Document>' + tail)
+    else:
+      head += '<Document />'
+      self._Compress(tail)
+    self.chunks.append(self.compressor.flush())
+
+    # The head is compressed as a separate deflate stream that ends on a byte
+    # boundary without a final block, so it can go in front of the rest.  The
+    # CRC must cover the head first, so it's combined with the rest's CRC.
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self.chunks.insert(
+        0, compressor.compress(head) + compressor.flush(zlib.Z_SYNC_FLUSH))
+    crc = Crc32Combine(zlib.crc32(head), self.crc, self.size)
+
+    # zipfile can only compress whole strings, so we write the member's local
+    # header and data ourselves and let zipfile write the central directory.
+    info = zipfile.ZipInfo('doc.kml')
+    info.external_attr = 0644 << 16L  # Unix permission bits
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.header_offset = 0
+    info.CRC = crc & 0xffffffff
+    info.file_size = len(head) + self.size
+    info.compress_size = sum(len(chunk) for chunk in self.chunks)
+    output_buffer = StringIO.StringIO()
+    archive = zipfile.ZipFile(output_buffer, 'w')
+    output_buffer.write(info.FileHeader())
+    output_buffer.writelines(self.chunks)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive.close()
+    return output_buffer.getvalue()
 
 
 def Compare(op, lhs, rhs):
@@ -178,18 +367,309 @@ def DecodeRecord(record, encoding):
           for key, value in record.items()}
 
 
+def PackRecords(records):
+  """Packs a list of records into a compact table that can be pickled.
+
+  Args:
+    records: A list of records, as dictionaries.
+  Returns:
+    A table, as a dictionary.  'shapes' is a list of tuples of field names;
+    records with the same fields share a shape.  'rows' is a list of (shape
+    index, tuple of values) pairs, one for each record.  KML elements in
+    ELEMENT_FIELDS are serialized; elements shared by several records (such
+    as shared styles) are serialized once.  Pass the table to
+    Kmlifier.UnpackRecords to get the records back.
+  """
+  shapes, shape_indexes, rows, serialized = [], {}, [], {}
+  for record in records:
+    fields = tuple(record)
+    if fields not in shape_indexes:
+      shape_indexes[fields] = len(shapes)
+      shapes.append(fields)
+    values = []
+    for field in fields:
+      value = record[field]
+      if field in ELEMENT_FIELDS and value is not None:
+        if id(value) not in serialized:
+          serialized[id(value)] = value, xml_utils.ElementTree.tostring(value)
+        value = serialized[id(value)][1]
+      values.append(value)
+    rows.append((shape_indexes[fields], tuple(values)))
+  return {'shapes': shapes, 'rows': rows}
+
+
 def GetText(element):
   return (element.text or '') + ''.join(
       GetText(child) + (child.tail or '') for child in element.getchildren())
 
 
-def FetchData(url, referer=None):
-  headers = referer and {'Referer': referer} or {}
+def GetGeometryCenter(geometry):
+  """Gets the center of the bounding box around a KML geometry's points.
+
+  This approximates the center of a polyline, polygon, etc.  (It totally fails
+  for polygons that cross the 180-degree meridian.)
+
+  Args:
+    geometry: A KML Geometry element.
+  Returns:
+    A (latitude, longitude) pair.
+  Raises:
+    AttributeError, ValueError: The geometry has no valid coordinates.
+  """
+  coords = geometry.find('.//coordinates').text
+  lons, lats = zip(*[map(float, xyz.split(',')[:2]) for xyz in coords.split()])
+  return (min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2
+
+
+def MakePoint(lat, lon):
+  """Makes a KML Point element."""
+  coords = '%.6f,%.6f,0' % (lon, lat)
+  return xml_utils.Xml('Point', xml_utils.Xml('coordinates', coords))
+
+
+class GridIndex(object):
+  """A spatial index of points on a grid of latitude-longitude cells."""
+
+  def __init__(self, points, cell_degrees=GRID_CELL_DEGREES):
+    """Indexes a list of points.
+
+    Args:
+      points: A list of (latitude, longitude) pairs, or None for items that
+          have no location.
+      cell_degrees: The size of each grid cell, in degrees.
+    """
+    self.points = points
+    self.cell_degrees = cell_degrees
+    self.cells = {}  # (row, column) -> list of indexes into points
+    for i, point in enumerate(points):
+      if point:
+        self.cells.setdefault(self.GetCell(point, cell_degrees), []).append(i)
+
+  @staticmethod
+  def GetCell(point, cell_degrees):
+    lat, lon = point
+    return (int(math.floor(lat / cell_degrees)),
+            int(math.floor(lon / cell_degrees)))
+
+  def Query(self, south, west, north, east):
+    """Finds the points inside a bounding box.
+
+    Args:
+      south, west, north, east: The edges of the box, in degrees.  If west >
+          east, the box crosses the 180-degree meridian.
+    Returns:
+      The indexes of the points in the box, in ascending order.
+    """
+    if west > east:
+      return sorted(self.Query(south, west, north, 180) +
+                    self.Query(south, -180, north, east))
+    (r0, c0), (r1, c1) = [self.GetCell(point, self.cell_degrees)
+                          for point in [(south, west), (north, east)]]
+    if (r1 - r0 + 1) * (c1 - c0 + 1) < len(self.cells):
+      cells = [((r, c), self.cells.get((r, c), []))
+               for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)]
+    else:
+      cells = [((r, c), indexes) for (r, c), indexes in self.cells.iteritems()
+               if r0 <= r <= r1 and c0 <= c <= c1]
+    result = []
+    for (r, c), indexes in cells:
+      if r0 < r < r1 and c0 < c < c1:  # the cell is entirely inside the box
+        result += indexes
+      else:
+        result += [i for i in indexes
+                   if south <= self.points[i][0] <= north and
+                   west <= self.points[i][1] <= east]
+    return sorted(result)
+
+  def Thin(self, indexes, cell_degrees):
+    """Keeps the first of the given points in each cell of a coarser grid.
+
+    Args:
+      indexes: A list of indexes into the points.
+      cell_degrees: The size of each cell of the coarser grid, in degrees.
+    Returns:
+      The indexes of the points that were kept, in the same order.  Items
+      with no location are dropped.
+    """
+    cells = set()
+    kept = []
+    for i in indexes:
+      if self.points[i]:
+        cell = self.GetCell(self.points[i], cell_degrees)
+        if cell not in cells:
+          cells.add(cell)
+          kept.append(i)
+    return kept
+
+
+def StartGetSource(kmlifier, url, data_type, referer=None, **kwargs):
+  """Starts getting parsed source data from a URL, caching it in SOURCE_CACHE.
+
+  If the source has to be fetched, the fetch is left running, so that several
+  sources can be fetched at once.  If the fetch or parse fails, the last good
+  source is used instead, as long as it was fetched within MAX_STALE_SECONDS.
+
+  Args:
+    kmlifier: The Kmlifier that will use the records.
+    url: The URL of the source data.
+    data_type: 'xml', 'csv', or 'geojson'.
+    referer: The Referer header to send if the data has to be fetched.
+    **kwargs: Other arguments to pass to kmlifier.ParseSource.
+  Returns:
+    A function that returns a source dictionary (see StartFetchSource),
+    waiting for the fetch if necessary.  Get the records from it with
+    kmlifier.UnpackRecords(source['table']).
+  """
+  key = [url, data_type] + kmlifier.GetSourceKey(data_type, **kwargs)
+  source = SOURCE_CACHE.Get(key)
+  if source is not None:
+    return lambda: source
+
+  # SOURCE_CACHE.Get returned None, so we are the ones to make the value.
+  old_source = SOURCE_CACHE.Peek(key)
+  finish = StartFetchSource(kmlifier, url, data_type, referer, old_source,
+                            **kwargs)
+
+  def GetSource():
+    try:
+      new_source = finish()
+    except Exception, e:  # pylint:disable=broad-except
+      if not (old_source and time.time() <
+              old_source.get('fetch_time', 0) + MAX_STALE_SECONDS):
+        raise
+      logging.warning('failed to get %s (%r); using the copy fetched at %s',
+                      url, e, time.ctime(old_source['fetch_time']))
+      new_source = old_source
+    SOURCE_CACHE.Set(key, cache.CacheEntry(
+        new_source, MAX_AGE_SECONDS, CACHE_TTL_SECONDS))
+    return new_source
+  return GetSource
+
+
+def StartFetchSource(kmlifier, url, data_type, referer=None, old_source=None,
+                     **kwargs):
+  """Starts fetching source data, to be parsed unless old_source is unchanged.
+
+  If there is an old source, the fetch is conditional on its validators, or
+  on those that metadata_fetch recorded for the same content.  If
+  metadata_fetch has found the content unchanged within the last
+  CACHE_TTL_SECONDS, there's no fetch at all.
+
+  Args:
+    kmlifier: The Kmlifier that will use the records.
+    url: The URL of the source data.
+    data_type: 'xml', 'csv', or 'geojson'.
+    referer: The Referer header to send.
+    old_source: A source previously made by this function with the same
+        arguments, or None.
+    **kwargs: Other arguments to pass to kmlifier.ParseSource.
+  Returns:
+    A function that waits for the fetch and returns a dictionary with keys
+    'table' (the table from kmlifier.ParseSource), 'md5_hash' (the MD5 hash of
+    the fetched content), 'validators' (headers for a conditional request for
+    the same content), and 'fetch_time' (when the content was last fetched or
+    found unchanged).  The function raises urlfetch.Error if the fetch fails.
+  """
+  validators = {}
+  if old_source:
+    metadata = GetSourceMetadata(url, data_type, old_source['md5_hash'])
+    if time.time() < metadata.get('fetch_time', 0) + CACHE_TTL_SECONDS:
+      logging.info('metadata_fetch recently found %s unchanged', url)
+      return lambda: dict(old_source, fetch_time=metadata['fetch_time'])
+    validators = old_source['validators'] or MakeValidators(
+        metadata.get('fetch_etag'), metadata.get('fetch_last_modified'))
+  rpc = StartFetch(url, referer, validators)
+
+  def FinishFetchSource():
+    response = FinishFetch(rpc, url)
+    fetch_time = time.time()
+    if response.status_code == 304 and old_source:
+      logging.info('%s is not modified', url)
+      return dict(old_source, fetch_time=fetch_time)
+
+    md5_hash = hashlib.md5(response.content).hexdigest()
+    if old_source and md5_hash == old_source['md5_hash']:
+      logging.info('%s is unchanged', url)
+      table = old_source['table']
+    else:
+      table = kmlifier.ParseSource(UnzipData(response.content, r'.*\.[kx]ml'),
+                                   data_type, **kwargs)
+    # response.headers treats dictionary keys as case-insensitive.
+    return {'table': table, 'md5_hash': md5_hash,
+            'validators': MakeValidators(response.headers.get('Etag'),
+                                         response.headers.get('Last-modified')),
+            'fetch_time': fetch_time}
+  return FinishFetchSource
+
+
+def GetSourceMetadata(url, data_type, md5_hash):
+  """Gets metadata_fetch's metadata for a URL, if its content hash matches.
+
+  Args:
+    url: The URL of the source data.
+    data_type: 'xml', 'csv', or 'geojson'.
+    md5_hash: The MD5 hash of the content we have for the URL.
+  Returns:
+    The metadata dictionary from the last time metadata_fetch fetched this
+    URL and got the same content, or {} if there is no such metadata.
+  """
+  addresses = ['%s:%s' % (layer_type, url)
+               for layer_type in METADATA_LAYER_TYPES.get(data_type, [])]
+  for metadata in metadata_fetch.METADATA_CACHE.GetMulti(addresses):
+    if metadata and metadata.get('md5_hash') == md5_hash:
+      return metadata
+  return {}
+
+
+def MakeValidators(etag, last_modified):
+  """Makes the headers for a conditional request, preferring the ETag."""
+  if etag:
+    return {'If-none-match': etag}
+  if last_modified:
+    return {'If-modified-since': last_modified}
+  return {}
+
+
+def StartFetch(url, referer=None, headers=None, deadline=10):
+  """Starts fetching a URL, returning the urlfetch RPC (see FinishFetch)."""
+  headers = dict(headers or {})
+  if referer:
+    headers['Referer'] = referer
   logging.info('fetching %s', url)
-  data = urlfetch.fetch(
-      url, headers=headers, validate_certificate=False, deadline=10).content
-  logging.info('retrieved %d bytes', len(data))
-  return UnzipData(data, r'.*\.[kx]ml')
+  rpc = urlfetch.create_rpc(deadline=deadline)
+  urlfetch.make_fetch_call(
+      rpc, url, headers=headers, validate_certificate=False)
+  return rpc
+
+
+def FinishFetch(rpc, url):
+  """Waits for a fetch from StartFetch, returning the urlfetch response.
+
+  Args:
+    rpc: The urlfetch RPC from StartFetch.
+    url: The URL that is being fetched.
+  Returns:
+    The urlfetch response.
+  Raises:
+    urlfetch.Error: The fetch failed or got an HTTP error status.
+  """
+  response = rpc.get_result()
+  logging.info('HTTP status %d, retrieved %d bytes from %s',
+               response.status_code, len(response.content), url)
+  if response.status_code >= 400:
+    raise urlfetch.DownloadError(
+        'HTTP status %d from %s' % (response.status_code, url))
+  return response
+
+
+def StartFetchData(url, referer=None, deadline=10):
+  """Starts fetching a URL, returning a function that waits for its data.
+
+  The function unzips KMZ data and raises urlfetch.Error if the fetch fails
+  or doesn't finish within the deadline (in seconds).
+  """
+  rpc = StartFetch(url, referer, deadline=deadline)
+  return lambda: UnzipData(FinishFetch(rpc, url).content, r'.*\.[kx]ml')
 
 
 def CreateHotspotElement(spec):
@@ -214,6 +694,24 @@ def CreateHotspotElement(spec):
   return xml_utils.Xml('hotSpot', x=x, y=y, xunits=units, yunits=units)
 
 
+def MakeSharedStyles(style_ids):
+  """Makes the shared Style elements collected by RecordsToPlacemarks."""
+  # Styles that serialize identically are shared, and are listed in order of
+  # their serialized form.
+  return [xml_utils.Xml('Style', *style.getchildren(), id=style_id)
+          for _, (style_id, style) in sorted(style_ids.items())]
+
+
+def ElementKey(element):
+  """Gets a hashable value such that elements with equal keys serialize equally.
+
+  The tail of the given element itself is not included, as it is not part of
+  what xml_utils.Serialize produces.
+  """
+  return (element.tag, tuple(sorted(element.items())), element.text,
+          tuple((ElementKey(child), child.tail) for child in element))
+
+
 def KmlCoordinatesFromJson(coords):
   if isinstance(coords[0], (int, float)):
     coords = [coords]
@@ -244,6 +742,35 @@ def KmlGeometryFromJson(geom):
     ))
 
 
+def JsonCoordinatesFromKml(element):
+  return [map(float, xyz.split(','))
+          for xyz in element.findtext('coordinates', '').split()]
+
+
+def JsonGeometryFromKml(geometry):
+  """Converts a KML Geometry element to a GeoJSON Geometry object.
+
+  Args:
+    geometry: A KML Point, LineString, Polygon, or MultiGeometry element.
+  Returns:
+    The GeoJSON Geometry, as a dictionary, or None for other elements.
+  Raises:
+    IndexError, ValueError: The geometry has invalid coordinates.
+  """
+  t = geometry.tag
+  if t == 'Point':
+    return {'type': t, 'coordinates': JsonCoordinatesFromKml(geometry)[0]}
+  if t == 'LineString':
+    return {'type': t, 'coordinates': JsonCoordinatesFromKml(geometry)}
+  if t == 'Polygon':
+    rings = (geometry.findall('outerBoundaryIs/LinearRing') +
+             geometry.findall('innerBoundaryIs/LinearRing'))
+    return {'type': t, 'coordinates': map(JsonCoordinatesFromKml, rings)}
+  if t == 'MultiGeometry':
+    return {'type': 'GeometryCollection',
+            'geometries': filter(None, map(JsonGeometryFromKml, geometry))}
+
+
 def KmlStyleFromJson(props, root_url):
   """Converts a dictionary of GeoJSON properties to a KML Style element."""
   # See https://github.com/mapbox/simplestyle-spec/tree/master/1.1.0
@@ -276,8 +803,43 @@ def KmlColorFromJson(color, opacity=1):
 
 
 class Template(string.Template):
+  """A string.Template that is parsed once, for fast repeated rendering."""
   idpattern = r'/?\w[\w.@#]*'
 
+  def __init__(self, template):
+    super(Template, self).__init__(template)
+    matches = list(self.pattern.finditer(template))
+    self.placeholders = set(match.group('named') or match.group('braced')
+                            for match in matches) - set([None])
+
+    # Literal text alternates with placeholder names in self.parts.  If there
+    # are invalid placeholders, self.parts is None and Render() falls back to
+    # substitute(), which raises the usual ValueError.
+    self.parts = []
+    literal, position = '', 0
+    for match in matches:
+      literal += template[position:match.start()]
+      position = match.end()
+      if match.group('escaped') is not None:
+        literal += self.delimiter
+      elif match.group('invalid') is not None:
+        self.parts = None
+        break
+      else:
+        self.parts += [literal, match.group('named') or match.group('braced')]
+        literal = ''
+    else:
+      self.parts.append(literal + template[position:])
+
+  def Render(self, values):
+    """Like substitute(), but values must have a key for every placeholder."""
+    if self.parts is None:
+      return self.substitute(values)
+    parts = self.parts[:]
+    for i in range(1, len(parts), 2):
+      parts[i] = '%s' % (values[parts[i]],)
+    return ''.join(parts)
+
 
 class Kmlifier(object):
   """A converter for CSV/XML/GeoJSON to KML."""
@@ -339,20 +901,13 @@ class Kmlifier(object):
     self.hotspot_template = Template(hotspot_template or 'mc')
     self.join_field = join_field or ''
     self.join_records = {}
-    if join_data:
-      self.join_records = {
-          record[join_field]: record
-          for record in self.RecordsFromCsv(join_data, header_fields_hint=[])}
 
     # Gather the set of all fields mentioned in templates or conditions.
     self.fields = set()
-    def Gather(match):
-      name = match.group('named') or match.group('braced')
-      if name:
-        self.fields.add(str(name).lstrip('_'))
-    self.name_template.pattern.sub(Gather, name_template)
-    self.description_template.pattern.sub(Gather, description_template)
-    self.id_template.pattern.sub(Gather, id_template)
+    for template in [self.name_template, self.description_template,
+                     self.id_template]:
+      self.fields.update(
+          str(name).lstrip('_') for name in template.placeholders)
     for field in location_fields:
       if field.startswith('^'):
         field = field[1:]
@@ -377,6 +932,193 @@ class Kmlifier(object):
           self.conditions.append((field, op, value))
           self.fields.add(field)
 
+    # Work out which values each record must supply to the templates.  In the
+    # description, $foo is HTML-escaped, $_foo is raw, and $__foo is URL-quoted.
+    # If a placeholder can be read more than one way (e.g. $__foo when there
+    # are fields "foo" and "_foo"), the reading with the most underscores
+    # stripped wins.
+    self.raw_placeholders = set().union(*[
+        template.placeholders for template in [
+            self.name_template, self.id_template, self.icon_url_template,
+            self.color_template, self.hotspot_template]])
+    self.description_variants = []
+    for name in sorted(self.description_template.placeholders):
+      variants = [(name, HtmlEscape)]
+      if name.startswith('_'):
+        variants.insert(0, (name[1:], lambda value: value))
+      if name.startswith('__'):
+        variants.insert(0, (name[2:], UrlQuote))
+      self.description_variants.append((name, variants))
+
+    if join_data:
+      self.SetJoinRecords(self.RecordsFromCsv(join_data, header_fields_hint=[]))
+
+  def SetJoinRecords(self, records):
+    """Sets the records to join with, matched on the join_field."""
+    self.join_records = {record[self.join_field]: record for record in records}
+
+  def GetSourceKey(self, data_type, record_tag=None, xml_wrapper_tag=None,
+                   header_fields_hint=None):
+    """Gets the parameters on which the table from ParseSource depends."""
+    if data_type == 'xml':
+      return [record_tag, xml_wrapper_tag, sorted(self.fields)]
+    elif data_type == 'csv':
+      if header_fields_hint is None:
+        header_fields_hint = self.location_fields_cleaned
+      return [header_fields_hint]
+    elif data_type == 'geojson':
+      return [self.root_url]
+    return []
+
+  def ParseSource(self, data, data_type, record_tag=None,
+                  xml_wrapper_tag=None, header_fields_hint=None):
+    """Parses source data of any supported type into a table of records.
+
+    Args:
+      data: The source data, as a string.
+      data_type: 'xml', 'csv', or 'geojson'.
+      record_tag: For XML, the tag of the records (see RecordsFromXml).
+      xml_wrapper_tag: For XML, the wrapper tag, if any (see RecordsFromXml).
+      header_fields_hint: For CSV, the fields to find in the header row (see
+          RecordsFromCsv).
+    Returns:
+      A table of the records, to be unpacked with UnpackRecords.
+    """
+    if data_type == 'xml':
+      return PackRecords(self.RecordsFromXml(data, record_tag, xml_wrapper_tag))
+    elif data_type == 'csv':
+      return self.TableFromCsv(data, header_fields_hint=header_fields_hint)
+    elif data_type == 'geojson':
+      return PackRecords(self.RecordsFromGeoJson(data))
+    raise ValueError(
+        'type is %r, but should be "xml", "csv", or "geojson"' % data_type)
+
+  def GetShapes(self, table):
+    """Gets the field names for each shape in a table made by ParseSource."""
+    if table.get('aliases'):
+      # Columns whose header spans two rows get the name from the second row
+      # if that name is used by this Kmlifier.  (Only CSV tables have aliases,
+      # and they have just one shape.)
+      return [tuple(alias in self.fields and alias or field
+                    for field, alias in zip(table['shapes'][0],
+                                            table['aliases']))]
+    return table['shapes']
+
+  def UnpackRecords(self, table, indexes=None):
+    """Gets a new list of records from a table made by ParseSource.
+
+    Args:
+      table: The table.
+      indexes: The indexes of the rows to unpack.  Default: all the rows.
+    Returns:
+      The records, as a list of dictionaries.
+    """
+    shapes = self.GetShapes(table)
+    rows = table['rows']
+    if indexes is not None:
+      rows = [rows[i] for i in indexes]
+    elements = {}
+    records = []
+    for shape, values in rows:
+      record = dict(zip(shapes[shape], values))
+      for field in ELEMENT_FIELDS:
+        if record.get(field) is not None:
+          if record[field] not in elements:
+            elements[record[field]] = xml_utils.Parse(record[field])
+          record[field] = elements[record[field]]
+      records.append(record)
+    return records
+
+  def SelectRecords(self, table, skip, limit):
+    """Gets the records in a table that meet the conditions, from skip on.
+
+    This gives the same result as
+    self.FilterRecords(self.UnpackRecords(table))[skip:skip + limit], but it
+    evaluates the conditions a column at a time, converting each distinct
+    value only once, and makes records only for the rows it returns.
+
+    Args:
+      table: A table made by ParseSource.
+      skip: The number of matching records to skip.
+      limit: The maximum number of records to return.
+    Returns:
+      The records, as a list of dictionaries.
+    """
+    return self.UnpackRecords(table, self.FilterRows(table)[skip:skip + limit])
+
+  def FilterRows(self, table, indexes=None):
+    """Finds the rows of a table that meet the conditions (see SelectRecords).
+
+    Args:
+      table: A table made by ParseSource.
+      indexes: A list of the indexes of the rows to consider.  Default: all.
+    Returns:
+      A list of the indexes of the rows that meet the conditions, in the
+      same order.
+    """
+    rows = table['rows']
+    selected = range(len(rows)) if indexes is None else indexes
+    if any(field in ELEMENT_FIELDS for field, _, _ in self.conditions):
+      records = self.UnpackRecords(table, selected)
+      return [i for i, record in zip(selected, records)
+              if self.FilterRecords([record])]
+
+    shapes = self.GetShapes(table)
+    for field, op, rhs in self.conditions:
+      # Like dict(zip(shape, values)), take the last column with the name.
+      positions = [dict(zip(shape, range(len(shape)))).get(field)
+                   for shape in shapes]
+      outcomes = {}  # string value -> result of Compare
+      kept = []
+      for i in selected:
+        shape, values = rows[i]
+        position = positions[shape]
+        value = None if position is None else values[position]
+        if isinstance(value, basestring):
+          if value not in outcomes:
+            outcomes[value] = Compare(op, value, rhs)
+          if outcomes[value]:
+            kept.append(i)
+        elif Compare(op, value, rhs):
+          kept.append(i)
+      selected = kept
+    logging.info('conditions were met by %d of %d records',
+                 len(selected), len(rows))
+    return selected
+
+  def IndexTable(self, table):
+    """Makes a GridIndex of the locations of the records in a table."""
+    return GridIndex(map(self.LocateRecord, self.UnpackRecords(table)))
+
+  def LocateRecord(self, record):
+    """Gets the (latitude, longitude) of a record, or None if it has none."""
+    geometry = record.get('__geometry__')
+    if not geometry:
+      return self.GetLatLon(record)
+    try:
+      return GetGeometryCenter(geometry)
+    except (AttributeError, ValueError):
+      return None
+
+  def GetLatLon(self, record):
+    """Gets a (latitude, longitude) pair from a record's location_fields."""
+    # Take the first field specification that gets us to a valid latitude
+    # and longitude.  This is handy because, if the location might appear
+    # in one of two different fields, you can specify both and you'll get
+    # whichever field is populated.
+    for field in self.location_fields:
+      try:
+        if ',' in field:
+          [lat, lon] = map(record.get, field.split(',')[:2])
+        elif field.startswith('^'):
+          lon, lat = record[field[1:]].replace(',', ' ').split()[:2]
+        else:
+          lat, lon = record[field].replace(',', ' ').split()[:2]
+        return float(lat), float(lon)
+      except (KeyError, ValueError, TypeError):
+        continue
+    return None
+
   def RecordsFromGeoJson(self, geojson_data):
     """Extracts records from a GeoJSON string.
 
@@ -413,13 +1155,40 @@ class Kmlifier(object):
     Returns:
       The records, as a list of dictionaries.
     """
+    return self.UnpackRecords(
+        self.TableFromCsv(csv_data, encoding, header_fields_hint))
+
+  def TableFromCsv(self, csv_data, encoding='utf-8', header_fields_hint=None):
+    """Extracts a table of records from a string of CSV data.
+
+    The table has the same form as one made by PackRecords, except that it can
+    also have 'aliases', the second header row (see FindCsvFieldnames).  Which
+    name each column gets depends on self.fields, so that is decided by
+    UnpackRecords; the table itself depends only on the arguments.
+
+    Args:
+      csv_data: The CSV data, as a string (see RecordsFromCsv).
+      encoding: The string encoding of csv_data, e.g. 'utf-8'.
+      header_fields_hint: A list of fields required to be in the header row
+          (see RecordsFromCsv).
+    Returns:
+      The table, as a dictionary.
+    """
     csv_file = StringIO.StringIO(csv_data)
     if header_fields_hint is None:
       header_fields_hint = self.location_fields_cleaned
-    fieldnames = self.FindCsvFieldnames(csv_file, encoding, header_fields_hint)
+    fieldnames, aliases = self.FindCsvFieldnames(
+        csv_file, encoding, header_fields_hint)
     logging.info('CSV fieldnames: %s', fieldnames)
-    return [NormalizeRecord(DecodeRecord(record, encoding))
-            for record in csv.DictReader(csv_file, fieldnames=fieldnames)]
+    rows = []
+    for row in csv.reader(csv_file):
+      if row:  # like csv.DictReader, skip blank lines
+        if len(row) != len(fieldnames):
+          raise ValueError('CSV row %d has %d cells, but the header has %d' %
+                           (len(rows) + 1, len(row), len(fieldnames)))
+        rows.append((0, tuple(Decode(value, encoding).strip()
+                              for value in row)))
+    return {'shapes': [tuple(fieldnames)], 'aliases': aliases, 'rows': rows}
 
   def FindCsvFieldnames(self, csv_file, encoding, header_fields_hint):
     """Finds a suitable set of fieldnames to map fields to CSV columns.
@@ -439,7 +1208,10 @@ class Kmlifier(object):
       header_fields_hint: A list of fields required to be in the header row.
           Pass an empty list to use the first row as the header.
     Returns:
-      An array suitable for passing to fieldnames in csv.DictReader
+      A pair (fieldnames, aliases).  fieldnames is a list of the names in the
+      header row.  If the header spans two rows, aliases is a list of the
+      names in the second row, and a column should take its alias as its
+      name if the alias is in self.fields; otherwise aliases is None.
     """
     fieldnames = []
     csv_reader = csv.reader(csv_file)
@@ -461,11 +1233,9 @@ class Kmlifier(object):
       # if we need to refer to Address or City_State in self.fields
       first_header_row_pos = csv_file.tell()
       row = [NormalizeFieldName(Decode(f, encoding)) for f in csv_reader.next()]
-      for index in range(len(fieldnames)):
-        if row[index] in self.fields:
-          fieldnames[index] = row[index]
       csv_file.seek(first_header_row_pos)
-    return fieldnames
+      return fieldnames, [row[index] for index in range(len(fieldnames))]
+    return fieldnames, None
 
   def RecordsFromXml(self, xml_data, record_tag=None, xml_wrapper_tag=None):
     """Extracts records from a string of XML data.
@@ -488,61 +1258,123 @@ class Kmlifier(object):
     Returns:
       The records, as a list of dictionaries.
     """
+    # The XML is scanned incrementally, detaching each element from the tree
+    # once nothing else needs it, so that memory use doesn't grow with the
+    # number of records.  Results must match a walk over the whole tree in
+    # document order, so values are tagged with each element's position in
+    # that order and the last one wins.
     if xml_wrapper_tag:
-      root = ParseXml(xml_data)
-      xml_data = ''.join(element.text for element in root.getiterator()
-                         if element.tag.split('}')[-1] == xml_wrapper_tag)
-    root = ParseXml(xml_data)
-    for element in root.getiterator():
-      element.tag = element.tag.split('}')[-1]  # remove XML namespaces
-
-    styles = {element.get('id'): element
-              for element in root.findall('.//Style')}
+      def ScanWrappers(events):
+        texts = []
+        positions = {}
+        for event, element in events:
+          if element.tag.split('}')[-1] == xml_wrapper_tag:
+            if event == 'start':
+              positions[element] = len(positions)
+            else:
+              texts.append((positions.pop(element), element.text))
+              element.clear()
+        return ''.join(text for _, text in sorted(texts))
+      xml_data = ScanXml(xml_data, ScanWrappers)
+
+    prefix_matches = {}
+    def HasFields(field_prefix, separators='@.#'):
+      """Returns True if any of self.fields could come from the given prefix."""
+      key = (field_prefix, separators)
+      if key not in prefix_matches:
+        starts = [field_prefix + separator for separator in separators]
+        prefix_matches[key] = any(
+            field == field_prefix or field[:len(field_prefix) + 1] in starts
+            for field in self.fields)
+      return prefix_matches[key]
 
     def ExtractFields(field_prefix, element, record):
       """Copies field values from an element into the given dictionary."""
-      def ExtractField(field, value):
+      if not HasFields(field_prefix):
+        return
+      texts = []  # GetText is costly, so call it at most once, if at all
+      def ExtractField(field, value=None):
         if field in self.fields:
+          if value is None:  # the field gets the text of the element
+            texts[:] = texts or [GetText(element)]
+            value = texts[0]
           record[field] = value
-      text = GetText(element)
-      ExtractField(field_prefix, text)
+      ExtractField(field_prefix)
       for attr in element.keys():
         ExtractField(field_prefix + '@' + attr, element.get(attr))
-      ExtractField(field_prefix + '.' + element.get('class', '').strip(), text)
-      ExtractField(field_prefix + '#' + element.get('id', '').strip(), text)
-      ExtractField(field_prefix + '#' + element.get('name', '').strip(), text)
+      ExtractField(field_prefix + '.' + element.get('class', '').strip())
+      ExtractField(field_prefix + '#' + element.get('id', '').strip())
+      ExtractField(field_prefix + '#' + element.get('name', '').strip())
+
+    # We scan the whole document looking for the record_tag XML tag; for each
+    # record tag, we scan all elements and attributes within, pulling out
+    # their values into records only if they are specified in self.fields.
+    def ScanRecords(events):
+      records = []  # (position, record) pairs
+      # global_fields collects fields outside of record tags, so that if, for
+      # example, there is a single <title> for the whole XML document, it can
+      # be referenced in templates as $/title.
+      global_fields = {}  # field name -> (position, value)
+      styles = {}  # style ID -> (position, Style element)
+      style_urls = []  # (record, style ID) pairs to resolve at the end
+      open_elements = []  # (element, position, keep subtree) triples
+      num_kept = 0  # number of open elements that need their subtrees
+      next_position = 0
+      for event, element in events:
+        if event == 'start':
+          element.tag = element.tag.split('}')[-1]  # remove XML namespaces
+          keep = (element.tag in [record_tag, 'Style'] or
+                  HasFields('/' + element.tag, '.#'))
+          open_elements.append((element, next_position, keep))
+          next_position += 1
+          num_kept += keep
+          continue
 
-    # We walk over the the whole document looking for the record_tag XML tag;
-    # for each record tag, we scan all elements and attributes within, pulling
-    # out their values into records only if they are specified in self.fields.
-    records = []
-    # global_fields collects fields outside of record tags, so that if, for
-    # example, there is a single <title> for the whole XML document, it can
-    # be referenced in templates as $/title.
-    global_fields = {}
-    for element in root.getiterator():
-      if element.tag == record_tag:
-        record = {}
-        for child in element.getiterator():
-          ExtractFields(child.tag, child, record)
-          if (child.tag in 'Point LineString Polygon MultiGeometry'.split() and
-              child.find('.//coordinates') is not None):
-            record['__geometry__'] = child  # preserve KML geometry
-        style = element.find('.//Style')
-        style_url = element.find('.//styleUrl')
-        if style is not None:
-          record['__style__'] = style  # preserve KML style
-        elif style_url is not None and style_url.text.startswith('#'):
-          record['__style__'] = styles.get(style_url.text.lstrip('#'))
-        records.append(record)
-      else:
-        ExtractFields('/' + element.tag, element, global_fields)
+        element, position, keep = open_elements.pop()
+        num_kept -= keep
+        if element.tag == record_tag:
+          record = {}
+          for child in element.getiterator():
+            ExtractFields(child.tag, child, record)
+            if (child.tag in ['Point', 'LineString', 'Polygon', 'MultiGeometry']
+                and child.find('.//coordinates') is not None):
+              record['__geometry__'] = child  # preserve KML geometry
+          style = element.find('.//Style')
+          style_url = element.find('.//styleUrl')
+          if style is not None:
+            record['__style__'] = style  # preserve KML style
+          elif style_url is not None and style_url.text.startswith('#'):
+            style_urls.append((record, style_url.text.lstrip('#')))
+          records.append((position, record))
+        else:
+          fields = {}
+          ExtractFields('/' + element.tag, element, fields)
+          for field, value in fields.items():
+            if position > global_fields.get(field, (-1, None))[0]:
+              global_fields[field] = (position, value)
+        if element.tag == 'Style':
+          if position > styles.get(element.get('id'), (-1, None))[0]:
+            styles[element.get('id')] = (position, element)
+
+        # Detach the element once no open ancestor needs its subtree.
+        if not num_kept and open_elements:
+          parent = open_elements[-1][0]
+          if len(parent) and parent[-1] is element:
+            del parent[-1]
+
+      for record, style_id in style_urls:
+        record['__style__'] = styles.get(style_id, (None, None))[1]
+      records.sort(key=lambda (position, record): position)
+      global_fields = {field: value for field, (_, value)
+                       in global_fields.items()}
+      return [OverlayDictionaries(global_fields, record)
+              for _, record in records]
 
     def OverlayDictionaries(base, overlay):
       result = base.copy()
       result.update(overlay)
       return result
-    return [OverlayDictionaries(global_fields, record) for record in records]
+    return ScanXml(xml_data, ScanRecords)
 
   def FilterRecords(self, records):
     """Filters the given a list of records by the specified conditions."""
@@ -552,10 +1384,25 @@ class Kmlifier(object):
 
   def RecordsToKmlDocument(self, records):
     """Turns a list of records into a KML Document element of placemarks."""
-    xml = xml_utils.Xml
-    placemarks = []
-    styles = []
     style_ids = {}
+    placemarks = list(self.RecordsToPlacemarks(records, style_ids))
+    return xml_utils.Xml('Document',
+                         *(MakeSharedStyles(style_ids) + placemarks))
+
+  def RenderRecords(self, records):
+    """Fills in the templates for records, one at a time.
+
+    Args:
+      records: An iterable of records.
+    Yields:
+      A tuple (geometry, center, style, name, id_value, description,
+      template_style) for each record.  geometry is the record's own KML
+      Geometry element or None; center is the (latitude, longitude) of the
+      geometry or of the location_fields, or None if the record has no
+      location; style is the record's own KML Style element or None; and
+      template_style is the (color, icon_url, hotspot) from the templates.
+      Records whose geometry has no valid coordinates are skipped.
+    """
     for record in records:
       geometry = record.pop('__geometry__', None)
       style = record.pop('__style__', None)
@@ -567,80 +1414,179 @@ class Kmlifier(object):
           record.update(join_record)
 
       # Substitute raw values into templates.
-      values = collections.defaultdict(lambda: '', record)
-      name = self.name_template.substitute(values)
-      id_value = self.id_template.substitute(values)
-      icon_url = self.icon_url_template.substitute(values)
-      color = self.color_template.substitute(values)
-      hotspot = self.hotspot_template.substitute(values)
+      values = {name: record.get(name, '') for name in self.raw_placeholders}
+      name = self.name_template.Render(values)
+      id_value = self.id_template.Render(values)
+      template_style = (self.color_template.Render(values),
+                        self.icon_url_template.Render(values),
+                        self.hotspot_template.Render(values))
 
       # Substitute escaped or quoted values into the description template.
-      values.update({key: HtmlEscape(record[key]) for key in record})
-      values.update({'_' + key: record[key] for key in record})
-      values.update({'__' + key: UrlQuote(record[key]) for key in record})
-      description = self.description_template.substitute(values)
-
-      # Get geometry information.
-      if not geometry:
-        # Take the first field specification that gets us to a valid latitude
-        # and longitude.  This is handy because, if the location might appear
-        # in one of two different fields, you can specify both and you'll get
-        # whichever field is populated.
-        for field in self.location_fields:
-          try:
-            if ',' in field:
-              [lat, lon] = map(record.get, field.split(',')[:2])
-            elif field.startswith('^'):
-              lon, lat = record[field[1:]].replace(',', ' ').split()[:2]
-            else:
-              lat, lon = record[field].replace(',', ' ').split()[:2]
-            coords = '%.6f,%.6f,0' % (float(lon), float(lat))
-            geometry = xml('Point', xml('coordinates', coords))
+      values = {}
+      for placeholder, variants in self.description_variants:
+        values[placeholder] = ''
+        for field, convert in variants:
+          if field in record:
+            values[placeholder] = convert(record[field])
             break
-          except (KeyError, ValueError, TypeError):
-            continue
+      description = self.description_template.Render(values)
 
+      # Get geometry information.
       if geometry:
+        try:
+          center = GetGeometryCenter(geometry)
+        except (AttributeError, ValueError):
+          continue
+      else:
+        geometry, center = None, self.GetLatLon(record)
+
+      yield (geometry, center, style, name, id_value, description,
+             template_style)
+
+  def RecordsToPlacemarks(self, records, style_ids):
+    """Generates KML placemarks for records, one at a time.
+
+    Args:
+      records: An iterable of records.
+      style_ids: A dictionary into which the shared styles that the placemarks
+          refer to are collected, for use with MakeSharedStyles().  The keys
+          are serialized Style elements; the values are (style ID, Style)
+          pairs.  The styles are complete once the generator is exhausted.
+    Yields:
+      KML Placemark elements, one for each record that has a location.
+    """
+    xml = xml_utils.Xml
+    serialized_styles = {}  # ElementKey or template values -> (XML, Style)
+    for (geometry, center, style, name, id_value, description,
+         template_style) in self.RenderRecords(records):
+      # Get style information.  Serializing a Style is costly, so it is done
+      # only once for each distinct style structure.
+      key = style and ElementKey(style) or template_style
+      if key not in serialized_styles:
+        if not style:
+          color, icon_url, hotspot = template_style
+          style = xml('Style',
+                      xml('IconStyle',
+                          xml('color', color),
+                          xml('Icon', xml('href', icon_url)),
+                          CreateHotspotElement(hotspot)))
+        serialized_styles[key] = xml_utils.Serialize(style), style
+      serialized, style = serialized_styles[key]
+      if serialized not in style_ids:
+        style_ids[serialized] = 'style%d' % (len(style_ids) + 1), style
+      style_id = style_ids[serialized][0]
+
+      # Emit a placemark.
+      if center:
         # When the Maps API gives us click events on a KmlLayer, it conveys
         # the name and description but not the coordinates of the item.  :(
         # So we have to pass along the coordinates inside the description.
+        description += (
+            '<input type="hidden" name="kmlify-location" value="%.6f,%.6f">' %
+            center)
+        yield xml('Placemark',
+                  id_value and {'id': id_value} or None,
+                  xml('name', name),
+                  xml('description', description),
+                  geometry or MakePoint(*center),
+                  xml('styleUrl', '#' + style_id))
+
+  def RecordsToGeoJsonFeatures(self, records):
+    """Generates GeoJSON features for records, one at a time.
+
+    The features have the same names, descriptions, and geometries as the
+    placemarks made by RecordsToPlacemarks.  Each feature's 'icon' and 'color'
+    properties give the icon URL and KML color (aabbggrr) of its style.
+
+    Args:
+      records: An iterable of records.
+    Yields:
+      GeoJSON Feature objects, as dictionaries, one for each record that has
+      a location.
+    """
+    for (geometry, center, style, name, id_value, description,
+         (color, icon_url, _)) in self.RenderRecords(records):
+      if not center:
+        continue
+      if geometry is None:
+        json_geometry = {'type': 'Point', 'coordinates': [center[1], center[0]]}
+      else:
         try:
-          coords = geometry.find('.//coordinates').text
-          # Take the center of the bounding box around all the points, which
-          # approximates the center of a polyline, polygon, etc.  (This totally
-          # fails for polygons that cross the 180-degree meridian.)
-          lons, lats = zip(*[map(float, xyz.split(',')[:2])
-                             for xyz in coords.split()])
-          description += (
-              '<input type="hidden" name="kmlify-location" value="%.6f,%.6f">' %
-              ((min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2))
-        except (AttributeError, ValueError):
+          json_geometry = JsonGeometryFromKml(geometry)
+        except (IndexError, ValueError):
           continue
+      if style:
+        color = style.findtext('IconStyle/color') or ''
+        icon_url = style.findtext('IconStyle/Icon/href') or ''
+      feature = {'type': 'Feature', 'geometry': json_geometry,
+                 'properties': {'name': name, 'description': description,
+                                'icon': icon_url, 'color': color}}
+      if id_value:
+        feature['id'] = id_value
+      yield feature
 
-      # Get style information.
-      if not style:
-        style = xml('Style',
-                    xml('IconStyle',
-                        xml('color', color),
-                        xml('Icon', xml('href', icon_url)),
-                        CreateHotspotElement(hotspot)))
-      key = xml_utils.Serialize(style)
-      if key not in style_ids:
-        style_ids[key] = 'style%d' % (len(style_ids) + 1)
-
-      # Add a placemark.
-      if geometry:
-        placemarks.append(
-            xml('Placemark',
-                id_value and {'id': id_value} or None,
-                xml('name', name),
-                xml('description', description),
-                geometry,
-                xml('styleUrl', '#' + style_ids[key])))
 
-    styles = [xml('Style', *xml_utils.Parse(key).getchildren(), id=style_id)
-              for key, style_id in sorted(style_ids.items())]
-    return xml('Document', *(styles + placemarks))
+def GetSourceIndex(kmlifier, source, data_type, **kwargs):
+  """Gets a GridIndex of a source's records, caching it in SOURCE_CACHE.
+
+  Args:
+    kmlifier: The Kmlifier that will use the records.
+    source: A source dictionary from StartGetSource.
+    data_type: 'xml', 'csv', or 'geojson'.
+    **kwargs: The other arguments that were passed to StartGetSource.
+  Returns:
+    The GridIndex.  Its points are in the same order as the table rows.
+  """
+  table = source['table']
+  # Two-row CSV headers make the column names depend on kmlifier.fields.
+  key = ['index', source['md5_hash'], data_type,
+         kmlifier.GetSourceKey(data_type, **kwargs), kmlifier.location_fields,
+         table.get('aliases') and sorted(kmlifier.fields)]
+  return SOURCE_CACHE.Get(key, lambda: kmlifier.IndexTable(table))
+
+
+def GetRecords(kmlifier, source, join_source, skip, limit, index=None,
+               bbox=None, zoom=None):
+  """Selects the records to render from a source.
+
+  Args:
+    kmlifier: The Kmlifier to render the records with.
+    source: A source dictionary from StartGetSource.
+    join_source: A source dictionary for the join data, or None.
+    skip: The number of matching records to skip.
+    limit: The maximum number of records to render.
+    index: A GridIndex of the source from GetSourceIndex.  Required if bbox
+        or zoom is given.
+    bbox: Optional [south, west, north, east] bounds of the records to render.
+    zoom: Optional map zoom level, at which to thin out the records.
+  Returns:
+    The records, as a list of dictionaries.
+  """
+  table = source['table']
+  rows = kmlifier.FilterRows(table, bbox and index.Query(*bbox))
+  if zoom is not None:
+    rows = index.Thin(rows, 360.0 / 2**zoom * THINNING_CELL_PIXELS / 256)
+  if join_source:
+    kmlifier.SetJoinRecords(kmlifier.UnpackRecords(join_source['table']))
+  return kmlifier.UnpackRecords(table, rows[skip:skip + limit])
+
+
+def MakeKmz(kmlifier, records):
+  """Renders records from GetRecords as a KMZ file."""
+  # Serialize and compress the placemarks as they are generated.
+  writer = KmzWriter()
+  style_ids = {}
+  for placemark in kmlifier.RecordsToPlacemarks(records, style_ids):
+    writer.Write(placemark)
+  return writer.Close(MakeSharedStyles(style_ids))
+
+
+def MakeGeoJson(kmlifier, records):
+  """Renders records from GetRecords as a GeoJSON FeatureCollection string."""
+  return GEOJSON_ENCODER.encode({
+      'type': 'FeatureCollection',
+      'features': list(kmlifier.RecordsToGeoJsonFeatures(records))
+  })
 
 
 class Kmlify(base_handler.BaseHandler):
@@ -662,6 +1608,7 @@ class Kmlify(base_handler.BaseHandler):
     join = str(self.request.get('join', ''))
     conditions = map(str, self.request.get_all('cond') or [])
     conditions = ','.join(conditions).split(',')
+    output = self.request.get('output') == 'geojson' and 'geojson' or 'kmz'
     try:
       skip = int(self.request.get('skip', '0'))
     except ValueError:
@@ -670,59 +1617,98 @@ class Kmlify(base_handler.BaseHandler):
       limit = int(self.request.get('limit', '10000'))
     except ValueError:
       limit = 10000
+    try:  # the viewport, as west,south,east,north
+      west, south, east, north = map(float, self.request.get('bbox').split(','))
+      bbox = [south, west, north, east]
+      if not (-90 <= south <= north <= 90 and
+              -180 <= west <= 180 and -180 <= east <= 180):
+        bbox = None
+    except ValueError:
+      bbox = None
+    try:
+      zoom = max(0, min(int(self.request.get('zoom')), 30))
+    except ValueError:
+      zoom = None
 
     cache_key = [url, data_type, xml_wrapper_tag, record_tag, name_template,
                  description_template, location_fields, id_template,
                  icon_url_template, color_template, hotspot_template,
-                 join, conditions, skip, limit]
+                 join, conditions, skip, limit, bbox, zoom, output]
 
-    # TODO(kpy): Keep track of how much time the cache entry has left, and
-    # extend its lifetime if the remote server temporarily fails to respond.
-    kmz = CACHE.Get(cache_key)
-    if kmz is not None:
-      logging.info('got %d bytes from cache', len(kmz))
-      return self.RespondWithKmz(kmz)
+    cached = CACHE.Get(cache_key)
+    if cached is not None:
+      content = cached[0]
+      logging.info('got %d bytes from cache', len(content))
+      return self.Respond(content, output)
 
+    # If the sources haven't changed since the output was made, reuse it.
+    old_content, old_source_hashes, old_fetch_time = (
+        CACHE.Peek(cache_key) or (None, None, None))
     try:
-      # Fetch the source data.
-      data = FetchData(url, self.request.host)
-
-      join_field = join_data = None
+      join_field = join_url = None
       if join:
         join_field, join_url = join.split(',', 1)
-        join_data = FetchData(join_url)
-
-      # Perform the conversion.
       kmlifier = Kmlifier(
           self.request.root_url, name_template, description_template,
           location_fields, id_template, icon_url_template, color_template,
-          hotspot_template, join_field, join_data, conditions)
-      if data_type == 'xml':
-        records = kmlifier.RecordsFromXml(data, record_tag, xml_wrapper_tag)
-      elif data_type == 'csv':
-        records = kmlifier.RecordsFromCsv(data)
-      elif data_type == 'geojson':
-        records = kmlifier.RecordsFromGeoJson(data)
+          hotspot_template, join_field, None, conditions)
+
+      # Get the parsed source data, fetching it only if it isn't cached.  The
+      # source and the join data are fetched at the same time.
+      get_source = StartGetSource(
+          kmlifier, url, data_type, self.request.host,
+          record_tag=record_tag, xml_wrapper_tag=xml_wrapper_tag)
+      get_join_source = join_url and StartGetSource(
+          kmlifier, join_url, 'csv', header_fields_hint=[])
+      source = get_source()
+      join_source = get_join_source and get_join_source()
+      source_hashes = (source['md5_hash'],
+                       join_source and join_source['md5_hash'])
+      fetch_time = min(s.get('fetch_time', 0) for s in [source, join_source]
+                       if s)
+      if source_hashes == old_source_hashes:
+        logging.info('sources are unchanged; reusing %d bytes',
+                     len(old_content))
+        content = old_content
       else:
-        raise ValueError(
-            'type is %r, but should be "xml", "csv", or "geojson"' % data_type)
-      logging.info('extracted %d records', len(records))
-      records = kmlifier.FilterRecords(records)
-      logging.info('conditions were met by %d records', len(records))
-      records = records[skip:skip + limit]
-      document = kmlifier.RecordsToKmlDocument(records)
+        index = (bbox or zoom is not None) and GetSourceIndex(
+            kmlifier, source, data_type, record_tag=record_tag,
+            xml_wrapper_tag=xml_wrapper_tag)
+        records = GetRecords(kmlifier, source, join_source, skip, limit,
+                             index, bbox, zoom)
+        if output == 'geojson':
+          content = MakeGeoJson(kmlifier, records)
+        else:
+          content = MakeKmz(kmlifier, records)
+      ttl = MAX_AGE_SECONDS
     except Exception, e:  # pylint:disable=broad-except
       # Even if conversion fails, always cache something.  We don't want an
       # error to trigger a spike of urlfetch requests to the remote server.
-      document = xml_utils.Xml(
-          'Document', xml_utils.Xml('name', 'Conversion failed: %r' %  e))
       logging.exception(e)
-    kmz = MakeKmz(KML_DOCUMENT_TEMPLATE % xml_utils.Serialize(document))
-    CACHE.Set(cache_key, kmz)
-    self.RespondWithKmz(kmz)
-
-  def RespondWithKmz(self, kmz):
-    self.response.headers['Content-Type'] = KMZ_CONTENT_TYPE
+      if old_fetch_time and time.time() < old_fetch_time + MAX_STALE_SECONDS:
+        # Keep serving the last good output; it is retried after the TTL.
+        logging.warning('serving the output made from data fetched at %s',
+                        time.ctime(old_fetch_time))
+        content, source_hashes = old_content, old_source_hashes
+        fetch_time, ttl = old_fetch_time, MAX_AGE_SECONDS
+      else:
+        message = 'Conversion failed: %r' %  e
+        if output == 'geojson':
+          content = GEOJSON_ENCODER.encode(
+              {'type': 'FeatureCollection', 'features': [], 'name': message})
+        else:
+          writer = KmzWriter()
+          writer.Write(xml_utils.Xml('name', message))
+          content = writer.Close()
+        source_hashes = fetch_time = None
+        ttl = CACHE_TTL_SECONDS
+    CACHE.Set(cache_key, cache.CacheEntry(
+        (content, source_hashes, fetch_time), ttl, CACHE_TTL_SECONDS))
+    self.Respond(content, output)
+
+  def Respond(self, content, output):
+    self.response.headers['Content-Type'] = (
+        output == 'geojson' and GEOJSON_CONTENT_TYPE or KMZ_CONTENT_TYPE)
     self.response.headers['Cache-Control'] = (
         'public, max-age=%s, must-revalidate' % CACHE_TTL_SECONDS)
-    self.response.out.write(kmz)
+    self.response.out.write(content)
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Measures the throughput of kmlify on synthetic CSV, KML, and GeoJSON data.
+
+For each input format and size, the stages of a conversion (parsing, filtering
+by conditions, unpacking records, joining, and rendering KML, KMZ, and
+GeoJSON) are run offline, with no network or cache.  Each stage is run in a
+forked child process, so that its peak memory use can be measured apart from
+the other stages.  Run this on Linux with the App Engine SDK on the Python
+path.  Usage:
+
+    python kmlify_benchmark.py [max_records] [num_columns] [formats]
+
+The inputs have 1000, 10000, ... records, up to max_records (default 100000;
+pass 1000000 for the largest inputs), and num_columns extra columns (default
+20).  formats is a comma-separated subset of csv,xml,geojson.
+"""
+
+import json
+import os
+import sys
+import time
+import traceback
+import xml.sax.saxutils
+
+import kmlify
+
+FORMATS = ['csv', 'xml', 'geojson']
+NUM_KINDS = 20  # number of distinct values in the "kind" field and join table
+
+
+def MakeFields(row, num_columns):
+  """Makes the (name, value) pairs for one synthetic record."""
+  return ([('name', 'Place %d' % row),
+           ('lat', '%.5f' % (row * 0.37 % 170 - 85)),
+           ('lon', '%.5f' % (row * 0.73 % 350 - 175)),
+           ('kind', 'k%d' % (row % NUM_KINDS)),
+           ('size', str(row % 100))] +
+          [('c%d' % i, '<value %d.%d>' % (row, i)) for i in range(num_columns)])
+
+
+def MakeCsv(num_rows, num_columns):
+  """Makes CSV data with a header row and num_rows rows of MakeFields."""
+  lines = [','.join(name for name, _ in MakeFields(0, num_columns))]
+  for row in range(num_rows):
+    lines.append(','.join(value for _, value in MakeFields(row, num_columns)))
+  return '\n'.join(lines) + '\n'
+
+
+def MakeKml(num_records, num_columns):
+  """Makes a KML Document of Placemarks with other fields in ExtendedData."""
+  escape = xml.sax.saxutils.escape
+  parts = ['<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n']
+  for row in range(num_records):
+    fields = dict(MakeFields(row, num_columns))
+    parts.append('<Placemark><name>%s</name><Point><coordinates>%s,%s,0'
+                 '</coordinates></Point><ExtendedData>' %
+                 (escape(fields.pop('name')), fields.pop('lon'),
+                  fields.pop('lat')))
+    for name, value in sorted(fields.items()):
+      parts.append('<Data name="%s"><value>%s</value></Data>' %
+                   (name, escape(value)))
+    parts.append('</ExtendedData></Placemark>\n')
+  parts.append('</Document></kml>\n')
+  return ''.join(parts)
+
+
+def MakeGeoJson(num_features, num_columns):
+  """Makes a GeoJSON FeatureCollection of Points with the other fields."""
+  features = []
+  for row in range(num_features):
+    properties = dict(MakeFields(row, num_columns))
+    coordinates = [float(properties.pop('lon')), float(properties.pop('lat'))]
+    features.append({'type': 'Feature', 'properties': properties,
+                     'geometry': {'type': 'Point', 'coordinates': coordinates}})
+  return json.dumps({'type': 'FeatureCollection', 'features': features})
+
+
+def MakeJoinCsv(join_field):
+  """Makes CSV data that gives a label for each kind of record."""
+  return join_field + ',label\n' + ''.join(
+      'k%d,Kind %d\n' % (i, i) for i in range(NUM_KINDS))
+
+
+def MakeKmlifier(data_type, num_columns):
+  """Makes a Kmlifier with templates and conditions typical of a layer."""
+  # In KML, the fields other than the name are in <Data> elements.
+  prefix = {'xml': 'Data#'}.get(data_type, '')
+  description = '<b>$label</b> ($%skind)<br>Size: $%ssize<br>%s' % (
+      prefix, prefix, '<br>'.join('$%sc%d' % (prefix, i)
+                                  for i in range(num_columns)))
+  location_fields = {'csv': ['lat,lon']}.get(data_type, ['^coordinates'])
+  kmlifier = kmlify.Kmlifier(
+      'http://example.com/', '$name', description, location_fields, '$name',
+      'http://example.com/icons/$%skind.png' % prefix, 'ff0000ff',
+      join_field=prefix + 'kind', conditions=[prefix + 'size<50'])
+  kmlifier.SetJoinRecords(
+      kmlifier.RecordsFromCsv(MakeJoinCsv(prefix + 'kind'),
+                              header_fields_hint=[]))
+  return kmlifier
+
+
+def GetMemoryStatus(name):
+  """Gets a memory size, such as VmRSS or VmHWM, for this process in bytes."""
+  for line in open('/proc/self/status'):
+    if line.startswith(name + ':'):
+      return int(line.split()[1]) * 1024  # the sizes are in kB
+
+
+def RunStage(name, function, *args):
+  """Runs function(*args) in a child process and measures it.
+
+  Args:
+    name: The name of the stage, for reporting.
+    function: The function to run.
+    *args: The arguments to pass to it.
+  Returns:
+    A tuple (name, seconds, megabytes) of the stage name, the time taken, and
+    the growth in the child's peak resident set size while the function ran.
+    Memory that the parent had already allocated and freed can be reused
+    without growing the child, so the megabytes are a lower bound.
+  Raises:
+    RuntimeError: The function raised an exception in the child.
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if not pid:
+    # The child must never return into the caller's code; it would go on to
+    # run the rest of the program, and flush the parent's buffered output.
+    exit_status = 1
+    try:
+      os.close(read_fd)
+      # The child starts with the parent's peak RSS; writing 5 resets it.
+      with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+      start_rss = GetMemoryStatus('VmRSS')
+      start = time.time()
+      function(*args)
+      elapsed = time.time() - start
+      peak_rss = GetMemoryStatus('VmHWM')
+      os.write(write_fd, json.dumps([elapsed, (peak_rss - start_rss) / 1e6]))
+      exit_status = 0
+    except BaseException:  # pylint: disable=broad-except
+      os.write(write_fd, json.dumps({'error': traceback.format_exc()}))
+    finally:
+      os._exit(exit_status)  # pylint: disable=protected-access
+  os.close(write_fd)
+  chunks = []
+  chunk = os.read(read_fd, 65536)
+  while chunk:
+    chunks.append(chunk)
+    chunk = os.read(read_fd, 65536)
+  os.close(read_fd)
+  _, status = os.waitpid(pid, 0)
+  result = ''.join(chunks)
+  if status:
+    error = result and json.loads(result).get('error')
+    raise RuntimeError('The %s stage failed:\n%s' % (
+        name, error or 'The child process ended with wait status %d.' % status))
+  return (name,) + tuple(json.loads(result))
+
+
+def Benchmark(data_type, num_records, num_columns):
+  """Measures each stage of converting one input.
+
+  Args:
+    data_type: 'csv', 'xml', or 'geojson'.
+    num_records: The number of records in the input.
+    num_columns: The number of extra columns in each record.
+  Yields:
+    Tuples (stage name, seconds, megabytes, number of records in).
+  """
+  make_data = {'csv': MakeCsv, 'xml': MakeKml, 'geojson': MakeGeoJson}
+  data = make_data[data_type](num_records, num_columns)
+  kmlifier = MakeKmlifier(data_type, num_columns)
+  record_tag = {'xml': 'Placemark'}.get(data_type)
+
+  # Each stage's output is made again here for the next stage; the child
+  # processes can't pass it back.
+  yield RunStage('parse', kmlifier.ParseSource, data, data_type,
+                 record_tag) + (num_records,)
+  table = kmlifier.ParseSource(data, data_type, record_tag)
+  yield RunStage('filter', kmlifier.FilterRows, table) + (num_records,)
+  rows = kmlifier.FilterRows(table)
+  yield RunStage('unpack', kmlifier.UnpackRecords, table, rows) + (len(rows),)
+  records = kmlifier.UnpackRecords(table, rows)
+  for name, render in [('kml', kmlifier.RecordsToKmlDocument),
+                       ('kmz', lambda r: kmlify.MakeKmz(kmlifier, r)),
+                       ('geojson', lambda r: kmlify.MakeGeoJson(kmlifier, r))]:
+    # Rendering takes the KML elements out of the records, but only in the
+    # child, so each renderer gets the same records.
+    yield RunStage(name, render, records) + (len(records),)
+
+
+def main(argv):
+  max_records = int(argv[1]) if len(argv) > 1 else 100000
+  num_columns = int(argv[2]) if len(argv) > 2 else 20
+  formats = argv[3].split(',') if len(argv) > 3 else FORMATS
+  print '%d extra columns; stages run in child processes' % num_columns
+  print '%-8s %8s %-8s %10s %12s %10s' % (
+      'format', 'records', 'stage', 'time (s)', 'us/record', 'peak (MB)')
+  num_records = 1000
+  while num_records <= max_records:
+    for data_type in formats:
+      for stage, seconds, megabytes, num_in in Benchmark(
+          data_type, num_records, num_columns):
+        print '%-8s %8d %-8s %10.3f %12.1f %10.1f' % (
+            data_type, num_records, stage, seconds,
+            seconds / max(num_in, 1) * 1e6, megabytes)
+      sys.stdout.flush()
+    num_records *= 10
+
+
+if __name__ == '__main__':
+  main(sys.argv)
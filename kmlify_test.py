@@ -13,13 +13,16 @@
 
 __author__ = 'romano@google.com (Raquel Romano)'
 
+import json
 import os
 import StringIO
 import urllib
 import zipfile
+import zlib
 
 import kmlify
 import test_utils
+import xml_utils
 
 from google.appengine.api import urlfetch
 
@@ -27,8 +30,10 @@ from google.appengine.api import urlfetch
 class UrlResponse(object):
   """A fake urlfetch response object."""
 
-  def __init__(self, content):
+  def __init__(self, content, status_code=200, headers=None):
     self.content = content
+    self.status_code = status_code
+    self.headers = headers or {}
 
 
 def MaybeUpdateGoldenFile(file_name, generated_file_data):
@@ -59,6 +64,46 @@ class KmlifyTests(test_utils.BaseTest):
     self.assertEquals("<type 'list'>", kmlify.Stringify(list))
     self.assertEquals("&lt;type 'list'&gt;", kmlify.Stringify(list, True))
 
+  def testTemplate(self):
+    template = kmlify.Template('$a costs $$${b.c} ($_a)')
+    self.assertEquals(set(['a', 'b.c', '_a']), template.placeholders)
+    self.assertEquals('x costs $3 (y)',
+                      template.Render({'a': 'x', 'b.c': 3, '_a': 'y'}))
+    self.assertRaises(ValueError, kmlify.Template('$a $').Render, {'a': 1})
+
+  def testElementKey(self):
+    def Key(xml):
+      return kmlify.ElementKey(xml_utils.Parse(xml))
+    key = Key('<a x="1" y="2"><b>c</b> </a>')
+    self.assertEquals(key, Key('<a y="2" x="1"><b>c</b> </a>'))
+    self.assertNotEquals(key, Key('<a x="1" y="2"><b>c</b></a>'))
+    self.assertNotEquals(key, Key('<a x="1"><b>c</b> </a>'))
+
+  def testKmzWriter(self):
+    def ReadKml(kmz):
+      return zipfile.ZipFile(StringIO.StringIO(kmz)).read('doc.kml')
+    def ExpectedKml(*children):
+      return kmlify.KML_DOCUMENT_TEMPLATE % xml_utils.Serialize(
+          xml_utils.Xml('Document', *children))
+
+    self.assertEquals(ExpectedKml(), ReadKml(kmlify.KmzWriter().Close()))
+
+    style = xml_utils.Xml('Style', xml_utils.Xml('IconStyle'))
+    placemarks = [xml_utils.Xml('Placemark', xml_utils.Xml('name', str(i)))
+                  for i in range(250)]
+    writer = kmlify.KmzWriter()
+    for placemark in placemarks:
+      writer.Write(placemark)
+    self.assertEquals(ExpectedKml(style, *placemarks),
+                      ReadKml(writer.Close([style])))
+
+  def testCrc32Combine(self):
+    for a, b in [('', ''), ('abc', ''), ('', 'xyz'), ('a', 'b'),
+                 ('head', 'body' * 1000)]:
+      self.assertEquals(
+          zlib.crc32(a + b) & 0xffffffff,
+          kmlify.Crc32Combine(zlib.crc32(a), zlib.crc32(b), len(b)))
+
   def testSimpleCsv(self):
     self.DoGoldenFileTest('csv', 'input1.csv', 'output1.kml',
                           {'loc': 'Latitude,Longitude', 'name': '$Name',
@@ -101,6 +146,175 @@ class KmlifyTests(test_utils.BaseTest):
                                    'layers/traffic/other_large_8x.png'},
                           'waze_join1.csv')
 
+  def testRecordsFromXml(self):
+    kmlifier = kmlify.Kmlifier('', '$name $/title', '$/size', [], '')
+    records = kmlifier.RecordsFromXml('''
+<kml xmlns="http://www.opengis.net/kml/2.2"><Document><title>Shops</title>
+  <Placemark><name>A</name><styleUrl>#red</styleUrl></Placemark>
+  <Placemark><name>B</name><Style id="blue"/></Placemark>
+  <Style id="red"><IconStyle/></Style>
+  <size>2</size>
+</Document></kml>''', 'Placemark')
+    self.assertEquals([('A', 'Shops', '2', 'red'), ('B', 'Shops', '2', 'blue')],
+                      [(r['name'], r['/title'], r['/size'],
+                        r['__style__'].get('id')) for r in records])
+
+  def testSelectRecords(self):
+    kmlifier = kmlify.Kmlifier('', '$name', '', ['lat,lon'], '',
+                               conditions=['size>2', 'kind!=x', 'missing<a'])
+    table = kmlifier.TableFromCsv(
+        'name,lat,lon,size,kind\n' +
+        ''.join('p%d,1,2,%d,%s\n' % (i, i % 5, 'xy'[i % 2]) for i in range(20)))
+    records = kmlifier.FilterRecords(kmlifier.UnpackRecords(table))
+    self.assertEquals(['p3', 'p9', 'p13', 'p19'], [r['name'] for r in records])
+    self.assertEquals(records, kmlifier.SelectRecords(table, 0, 10))
+    self.assertEquals(records[1:3], kmlifier.SelectRecords(table, 1, 2))
+
+  def testGridIndex(self):
+    index = kmlify.GridIndex([(10, 20), None, (10.2, 20.1), (-5, 179.5),
+                              (10, -179.5), (-80, -100)], 0.5)
+    self.assertEquals([0, 2], index.Query(9.9, 19.9, 10.5, 20.5))
+    self.assertEquals([0, 2, 3, 4, 5], index.Query(-90, -180, 90, 180))
+    self.assertEquals([3, 4], index.Query(-10, 179, 10, -179))
+    self.assertEquals([0, 3, 4, 5], index.Thin(range(6), 10))
+
+  def testBboxAndZoom(self):
+    self.StubFetch(lambda url, **kwargs: UrlResponse(
+        'name,lat,lon\nA,10,20\nB,10.1,20.1\nC,-30,40\nD,,\n'))
+    def GetNames(**params):
+      response = self.DoGet('/.kmlify?' + urllib.urlencode(dict(
+          params, type='csv', url='http://example.com/data.csv',
+          loc='lat,lon')))
+      kml = zipfile.ZipFile(StringIO.StringIO(response.body)).read('doc.kml')
+      return [name for name in 'ABCD' if '<name>%s</name>' % name in kml]
+
+    self.assertEquals(['A', 'B', 'C'], GetNames())
+    self.assertEquals(['A', 'B'], GetNames(bbox='19,9,21,11'))
+    self.assertEquals(['B'], GetNames(bbox='19,9,21,11', skip='1'))
+    self.assertEquals(['A', 'C'], GetNames(zoom='3'))
+    self.assertEquals(['A', 'B'], GetNames(zoom='12', bbox='19,9,21,11'))
+    self.assertEquals(['A', 'B', 'C'], GetNames(bbox='19,9,21'))  # ignored
+
+  def testJsonGeometryFromKml(self):
+    point = {'type': 'Point', 'coordinates': [1, 2]}
+    line = {'type': 'LineString', 'coordinates': [[1, 2], [3, 4, 5]]}
+    polygon = {'type': 'Polygon', 'coordinates': [
+        [[0, 0], [0, 9], [9, 9], [0, 0]], [[1, 1], [1, 2], [2, 2], [1, 1]]]}
+    for geometry in [point, line, polygon]:
+      self.assertEquals(geometry, kmlify.JsonGeometryFromKml(
+          kmlify.KmlGeometryFromJson(geometry)))
+    self.assertEquals(
+        {'type': 'GeometryCollection', 'geometries': [point, point]},
+        kmlify.JsonGeometryFromKml(kmlify.KmlGeometryFromJson(
+            {'type': 'MultiPoint', 'coordinates': [[1, 2], [1, 2]]})))
+
+  def testGeoJsonOutput(self):
+    self.StubFetch(lambda url, **kwargs: UrlResponse(
+        'name,lat,lon,icon\nA,10,20,a.png\nB,,,b.png\n'))
+    response = self.DoGet('/.kmlify?' + urllib.urlencode({
+        'type': 'csv', 'url': 'http://example.com/data.csv', 'loc': 'lat,lon',
+        'id': '$name', 'desc': '<b>$name</b>', 'icon': '$icon',
+        'output': 'geojson'}))
+    self.assertEquals('application/json', response.headers['Content-Type'])
+    self.assertEquals({'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature',
+        'id': 'A',
+        'geometry': {'type': 'Point', 'coordinates': [20, 10]},
+        'properties': {'name': 'A', 'description': '<b>A</b>',
+                       'icon': 'a.png', 'color': 'ffffffff'}
+    }]}, json.loads(response.body))
+
+  def testSourceIsCachedSeparately(self):
+    urls = []
+    def Fetch(url, **unused_kwargs):
+      urls.append(url)
+      return UrlResponse('name,lat,lon\nA,1,2\nB,3,4\n')
+    self.StubFetch(Fetch)
+
+    # Requests that differ only in their templates or page share the source.
+    url = 'http://example.com/data.csv'
+    for params in [{'name': '$name'}, {'name': '$name!', 'skip': '1'}]:
+      response = self.DoGet('/.kmlify?' + urllib.urlencode(
+          dict(params, type='csv', url=url, loc='lat,lon')))
+      self.assertTrue(zipfile.ZipFile(StringIO.StringIO(response.body))
+                      .read('doc.kml').count('<Placemark'))
+    self.assertEquals([url], urls)
+
+  def testConditionalFetch(self):
+    requests = []
+    def Fetch(unused_url, headers=None, **unused_kwargs):
+      requests.append(headers)
+      if headers.get('If-none-match') == '"v1"':
+        return UrlResponse('', 304)
+      return UrlResponse('name,lat,lon\nA,1,2\n', 200, {'Etag': '"v1"'})
+    self.StubFetch(Fetch)
+
+    path = '/.kmlify?' + urllib.urlencode(
+        {'type': 'csv', 'url': 'http://example.com/data.csv', 'loc': 'lat,lon'})
+    self.SetTime(1400000000)
+    kmz = self.DoGet(path).body
+    self.assertEquals(1, len(requests))
+
+    # After the TTL, the source is revalidated; the 304 means the source and
+    # the KMZ are reused without being parsed or rendered again.
+    self.SetTime(1400000000 + kmlify.CACHE_TTL_SECONDS + 1)
+    self.mox.stubs.Set(kmlify, 'MakeKmz', None)
+    self.assertEquals(kmz, self.DoGet(path).body)
+    self.assertEquals(2, len(requests))
+    self.assertEquals('"v1"', requests[1]['If-none-match'])
+
+  def testSourceAndJoinAreFetchedConcurrently(self):
+    responses = {'http://example.com/data.csv': 'name,kind,lat,lon\nA,k,1,2\n',
+                 'http://example.com/join.csv': 'kind,label\nk,Kay\n'}
+    events = []
+    def Fetch(url, **unused_kwargs):
+      events.append('got ' + url)
+      return UrlResponse(responses[url])
+    self.StubFetch(Fetch)
+    make_fetch_call = urlfetch.make_fetch_call
+    def MakeFetchCall(rpc, url, **kwargs):
+      events.append('start ' + url)
+      make_fetch_call(rpc, url, **kwargs)
+    self.mox.stubs.Set(urlfetch, 'make_fetch_call', MakeFetchCall)
+
+    response = self.DoGet('/.kmlify?' + urllib.urlencode({
+        'type': 'csv', 'url': 'http://example.com/data.csv', 'loc': 'lat,lon',
+        'name': '$label', 'join': 'kind,http://example.com/join.csv'}))
+    self.assertEquals(['start http://example.com/data.csv',
+                       'start http://example.com/join.csv',
+                       'got http://example.com/data.csv',
+                       'got http://example.com/join.csv'], events)
+    self.assertTrue('<name>Kay</name>' in zipfile.ZipFile(
+        StringIO.StringIO(response.body)).read('doc.kml'))
+
+  def testStaleOnError(self):
+    status = [200]
+    def Fetch(unused_url, **unused_kwargs):
+      if not status[0]:
+        raise urlfetch.DownloadError('timed out')
+      return UrlResponse('name,lat,lon\nA,1,2\n', status[0])
+    self.StubFetch(Fetch)
+    # Let every request past the TTL refetch, without waiting for locks.
+    self.mox.stubs.Set(kmlify.CACHE, 'lock_timeout', 0)
+    self.mox.stubs.Set(kmlify.SOURCE_CACHE, 'lock_timeout', 0)
+
+    path = '/.kmlify?' + urllib.urlencode(
+        {'type': 'csv', 'url': 'http://example.com/data.csv', 'loc': 'lat,lon'})
+    self.SetTime(1400000000)
+    kmz = self.DoGet(path).body
+
+    # When the source fails, the last good KMZ is still served...
+    for i, fetch_status in enumerate([None, 500]):
+      status[0] = fetch_status
+      self.SetTime(1400000000 + (kmlify.CACHE_TTL_SECONDS + 1) * (i + 1))
+      self.assertEquals(kmz, self.DoGet(path).body)
+
+    # ...but only for a while.
+    self.SetTime(1400000000 + kmlify.MAX_STALE_SECONDS + 1)
+    kml = zipfile.ZipFile(StringIO.StringIO(self.DoGet(path).body)).read(
+        'doc.kml')
+    self.assertTrue('Conversion failed' in kml)
+
   def DoGoldenFileTest(self, input_type, input_name, output_name, url_params,
                        join_name=None):
     """Perform a test using input and output files in the 'goldentests' dir.
@@ -124,7 +338,7 @@ class KmlifyTests(test_utils.BaseTest):
       join_url = url_params['join'].split(',')[1]
       join_data = open(os.path.join(data_dir, join_name)).read()
       responses[join_url] = UrlResponse(join_data)
-    self.mox.stubs.Set(urlfetch, 'fetch', lambda url, **kwargs: responses[url])
+    self.StubFetch(lambda url, **kwargs: responses[url])
 
     # Perform the kmlify request and check the output.
     response = self.DoGet('/.kmlify?' + urllib.urlencode(
@@ -137,7 +351,7 @@ class KmlifyTests(test_utils.BaseTest):
 
     # The content should be cached now, so repeating the request should yield
     # the same result even with urlfetch disabled.
-    self.mox.stubs.Set(urlfetch, 'fetch', lambda url, **kwargs: UrlResponse(''))
+    self.StubFetch(lambda url, **kwargs: UrlResponse(''))
     response2 = self.DoGet('/.kmlify?' + urllib.urlencode(
         dict(url_params, type=input_type, url=url)))
     self.assertEquals(
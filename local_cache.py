@@ -15,22 +15,148 @@
 
 
 import copy
+import cPickle as pickle
+import itertools
+import sys
 import threading
 import time
+import types
 
 SWEEP_INTERVAL_SECONDS = 60
 
+# When a LocalCache exceeds its byte budget, entries are evicted until the
+# cache is down to this fraction of the budget, so that the cost of choosing
+# victims is amortized over many Sets.
+EVICTION_TARGET_FRACTION = 0.9
+
+# Ways of storing values; see LocalCache.__init__ for details.
+COPY = 'copy'
+PICKLE = 'pickle'
+FROZEN = 'frozen'
+
+# Types whose instances are immutable, and thus never need to be copied.
+_IMMUTABLE_TYPES = (types.NoneType, bool, int, long, float, complex,
+                    str, unicode, frozenset)
+
+# EstimateSize() only tracks the identity of strings at least this long, to
+# avoid counting big shared strings twice.  Short strings aren't worth it.
+_MIN_SHARED_STRING_LENGTH = 256
+
+
+def _Immutable(*unused_args, **unused_kwargs):
+  raise TypeError('Values stored in a FROZEN LocalCache cannot be modified')
+
+
+class FrozenDict(dict):
+  """A dict that cannot be modified.  Produced by Freeze()."""
+  __setitem__ = __delitem__ = clear = pop = popitem = _Immutable
+  setdefault = update = _Immutable
+
+  def __reduce__(self):
+    return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+  """A list that cannot be modified.  Produced by Freeze()."""
+  __setitem__ = __delitem__ = __setslice__ = __delslice__ = _Immutable
+  __iadd__ = __imul__ = append = extend = insert = pop = remove = _Immutable
+  reverse = sort = _Immutable
+
+  def __reduce__(self):
+    return FrozenList, (list(self),)
+
+
+def Freeze(value):
+  """Makes an immutable snapshot of a value that can be shared by all readers.
+
+  Dicts, lists, and sets are converted to FrozenDict, FrozenList, and frozenset
+  (which still compare equal to and serialize like the originals).  Other
+  objects with a __dict__ are shallow-copied and their attributes are frozen.
+  Anything else (e.g. strings, numbers, tuples of these) is assumed to be
+  immutable already and is returned as is.
+
+  Args:
+    value: The value to freeze.
+  Returns:
+    A frozen version of the value.
+  """
+  if isinstance(value, _IMMUTABLE_TYPES + (FrozenDict, FrozenList)):
+    return value
+  if isinstance(value, dict):
+    return FrozenDict((k, Freeze(v)) for k, v in value.iteritems())
+  if isinstance(value, list):
+    return FrozenList(Freeze(v) for v in value)
+  if type(value) is tuple:  # pylint: disable=unidiomatic-typecheck
+    return tuple(Freeze(v) for v in value)
+  if isinstance(value, set):
+    return frozenset(value)
+  if hasattr(value, '__dict__'):
+    value = copy.copy(value)
+    value.__dict__.update((k, Freeze(v)) for k, v in value.__dict__.items())
+  return value
+
+
+def EstimateSize(value):
+  """Estimates the RAM used by a value and everything it refers to, in bytes.
+
+  Containers, objects, and long strings reachable by more than one path are
+  only counted once.  The result is approximate (e.g. short strings shared
+  with other values are counted as if they were private), but is good enough
+  to enforce a memory budget.
+
+  Args:
+    value: Any value.
+  Returns:
+    The estimated size in bytes.
+  """
+  getsizeof = sys.getsizeof
+  size = 0
+  seen = set()
+  stack = [value]
+  while stack:
+    v = stack.pop()
+    if isinstance(v, _IMMUTABLE_TYPES) and not (
+        isinstance(v, basestring) and len(v) >= _MIN_SHARED_STRING_LENGTH):
+      size += getsizeof(v, 64)
+      continue
+    if id(v) in seen:
+      continue
+    seen.add(id(v))
+    size += getsizeof(v, 64)
+    if isinstance(v, dict):
+      stack.extend(v.iterkeys())
+      stack.extend(v.itervalues())
+    elif isinstance(v, (list, tuple, set, frozenset)):
+      stack.extend(v)
+    elif hasattr(v, '__dict__'):
+      stack.append(v.__dict__)
+  return size
+
 
 class _CacheEntry(object):
   """Entry to be stored in LocalCache."""
 
-  def __init__(self, value, expiry):
+  def __init__(self, value, expiry, mode=COPY):
     """Cache Entry."""
-    self._value = copy.deepcopy(value)
+    self._mode = mode
+    if mode == PICKLE:
+      self._value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+      self.size = sys.getsizeof(self._value)
+    elif mode == FROZEN:
+      self._value = Freeze(value)
+      self.size = EstimateSize(self._value)
+    else:
+      self._value = copy.deepcopy(value)
+      self.size = EstimateSize(self._value)
     self._expiry = expiry
+    self.last_used = 0  # updated with a LocalCache tick on every Set and Get
 
   @property
   def value(self):
+    if self._mode == PICKLE:
+      return pickle.loads(self._value)
+    if self._mode == FROZEN:
+      return self._value
     return copy.deepcopy(self._value)
 
   @property
@@ -55,22 +181,61 @@ class LocalCache(object):
     implement when it's needed.
   - it doesn't support Add. If you need Add you're probably trying to build a
     lock and are better off using a real python threading.Lock.
+
+  A LocalCache can be given a budget in bytes.  The size of each entry is
+  estimated when it is stored, and when the total exceeds the budget, expired
+  and least recently used entries are evicted.  GetStats() reports the
+  resident size and the number of evictions, for tuning the budget.
   """
 
-  def __init__(self, ttl=0):
+  def __init__(self, ttl=0, mode=COPY, max_bytes=0):
     """Constructor for LocalCache.
 
     Args:
       ttl: How long values should stay in cache. Default (0) is don't expire.
+      mode: How values are stored, which determines the cost of a cache hit.
+          COPY (the default) deep-copies values on every Set and every Get, so
+          callers can freely mutate what they get.  PICKLE pickles values on
+          Set and unpickles them on every Get, which is still safe to mutate
+          and is much cheaper than a deep copy for large values.  FROZEN makes
+          an immutable snapshot (see Freeze) on Set and returns that same
+          snapshot from every Get, so hits cost nothing; use it only for values
+          that callers never modify.  Set() can override this per entry.
+      max_bytes: The maximum estimated size of all the entries, in bytes.
+          Default (0) is unlimited.
     """
     self._cache = {}  # key => _CacheEntry
     self._ttl = ttl
+    self._mode = mode
+    self._max_bytes = max_bytes
+    self._bytes = 0  # total estimated size of the entries in _cache
+    self._evictions = 0
+    self._ticks = itertools.count(1)  # logical clock for recency of use
+    self._lock = threading.Lock()  # lock held while updating _cache and _bytes
     self._sweep_lock = threading.Lock()  # lock held while sweeping _cache
     self._next_sweep_time = 0
 
   def Clear(self):
     """Clear the state of this cache. For use in tests only."""
-    self._cache.clear()
+    with self._lock:
+      self._cache.clear()
+      self._bytes = 0
+      self._evictions = 0
+
+  def GetStats(self):
+    """Gets a dictionary of statistics about the contents of this cache."""
+    return {'entries': len(self._cache), 'bytes': self._bytes,
+            'max_bytes': self._max_bytes, 'evictions': self._evictions}
+
+  def _Remove(self, key, entry=None):
+    """Removes a key, but only if it still refers to entry (if specified)."""
+    with self._lock:
+      current = self._cache.get(key)
+      if current is not None and (entry is None or current is entry):
+        del self._cache[key]
+        self._bytes -= current.size
+        return True
+    return False
 
   def _Sweep(self):
     """Walk through all cache entries and delete any that are expired."""
@@ -84,20 +249,45 @@ class LocalCache(object):
           self._next_sweep_time = now + SWEEP_INTERVAL_SECONDS
           for key_json, entry in self._cache.items():
             if 0 < entry.expiry < now:
-              # Use pop() instead of del because the item can be concurrently
-              # removed by Cache.Delete(), which doesn't hold _sweep_lock.
-              self._cache.pop(key_json, None)
+              # The item can be concurrently replaced or removed by Set() or
+              # Delete(), which don't hold _sweep_lock, so remove it only if
+              # it's still the same entry.
+              self._Remove(key_json, entry)
       finally:
         self._sweep_lock.release()
 
+  def _Evict(self):
+    """Evicts entries until the cache is comfortably within its byte budget.
+
+    Expired entries go first, then the least recently used ones.  Sorting all
+    the entries is O(n log n), but since we evict down to a fraction of the
+    budget, this happens only once in many Sets.
+    """
+    if not self._sweep_lock.acquire(False):
+      return  # another thread is sweeping or evicting; it'll free up space
+    try:
+      target = self._max_bytes * EVICTION_TARGET_FRACTION
+      now = time.time()
+      victims = sorted(
+          self._cache.items(),
+          key=lambda (_, e): (not 0 < e.expiry < now, e.last_used))
+      for key, entry in victims:
+        if self._bytes <= target:
+          break
+        if self._Remove(key, entry):
+          self._evictions += 1
+    finally:
+      self._sweep_lock.release()
+
   def Get(self, key):
     """Get the value referenced by key. Returns None if it doesn't exist."""
     v = self._cache.get(key)
     if v and (v.expiry == 0 or time.time() < v.expiry):
+      v.last_used = self._ticks.next()
       return v.value
     return None
 
-  def Set(self, key, value, ttl=None, expiry=None):
+  def Set(self, key, value, ttl=None, expiry=None, mode=None):
     """Set the key/value pair with the specified expiry.
 
     The ttl and expiry are mutually exclusive. If you use neither, the cache
@@ -108,6 +298,7 @@ class LocalCache(object):
       value: The value to store in the cache.  Must be picklable.
       ttl: How long to keep this value, relative time in seconds.
       expiry: When to expiry this value, absolute timestamp in seconds.
+      mode: COPY, PICKLE, or FROZEN; None means use the mode of this cache.
     Returns:
       True if it was stored, False otherwise.
     Raises:
@@ -123,14 +314,24 @@ class LocalCache(object):
         ttl = self._ttl
       expiry = ttl + now if ttl > 0 else 0
     if expiry == 0 or now < expiry:
-      self._cache[key] = _CacheEntry(value, expiry)
+      entry = _CacheEntry(value, expiry, mode or self._mode)
+      if self._max_bytes and entry.size > self._max_bytes:
+        self._Remove(key)  # too big to store at all; don't keep the old value
+        return False
+      entry.last_used = self._ticks.next()
+      with self._lock:
+        old = self._cache.get(key)
+        self._cache[key] = entry
+        self._bytes += entry.size - (old and old.size or 0)
+      if self._max_bytes and self._bytes > self._max_bytes:
+        self._Evict()
       self._Sweep()
       return True
     return False
 
   def Delete(self, key):
     """Delete the entry referenced by key, if it exists."""
-    self._cache.pop(key, None)
+    self._Remove(key)
 
   def Add(self, key, value, expiry):  # pylint:disable=unused-argument
     # pylint: disable=g-doc-args
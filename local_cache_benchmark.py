@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Compares the cost of LocalCache hits in its COPY, PICKLE, and FROZEN modes.
+
+Uses the MapRoot fixtures that testdata.py loads into the datastore.  Usage:
+
+    python local_cache_benchmark.py [num_gets]
+"""
+
+import json
+import os
+import sys
+import timeit
+
+import local_cache
+
+# The MapRoot files used by testdata.py.
+MAPROOT_FILES = ['godzilla.json', 'test_maproot.json', 'gas_stations.json']
+MODES = [local_cache.COPY, local_cache.PICKLE, local_cache.FROZEN]
+
+
+def LoadMapRoot(filename):
+  directory = os.path.join(os.path.dirname(__file__) or '.', 'resource')
+  return json.load(open(os.path.join(directory, filename)))
+
+
+def Benchmark(map_root, mode, num_gets):
+  """Returns the (set, get) times in microseconds for one MapRoot and mode."""
+  cache = local_cache.LocalCache(mode=mode)
+  set_time = timeit.timeit(lambda: cache.Set('key', map_root), number=100)
+  get_time = timeit.timeit(lambda: cache.Get('key'), number=num_gets)
+  return set_time / 100 * 1e6, get_time / num_gets * 1e6
+
+
+def main(argv):
+  num_gets = int(argv[1]) if len(argv) > 1 else 10000
+  print '%-20s %8s %12s %12s' % ('maproot', 'mode', 'set (us)', 'get (us)')
+  for filename in MAPROOT_FILES:
+    map_root = LoadMapRoot(filename)
+    for mode in MODES:
+      set_us, get_us = Benchmark(map_root, mode, num_gets)
+      print '%-20s %8s %12.1f %12.2f' % (filename, mode, set_us, get_us)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# Copyright 2014 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Tests for local_cache.py."""
+
+import copy
+import pickle
+import unittest
+
+import local_cache
+
+
+class LocalCacheTest(unittest.TestCase):
+
+  def testCopyMode(self):
+    cache = local_cache.LocalCache()
+    value = {'a': [1, 2]}
+    cache.Set('x', value)
+    value['a'].append(3)
+    self.assertEquals({'a': [1, 2]}, cache.Get('x'))
+    cache.Get('x')['a'].append(4)
+    self.assertEquals({'a': [1, 2]}, cache.Get('x'))
+
+  def testPickleMode(self):
+    cache = local_cache.LocalCache(mode=local_cache.PICKLE)
+    value = {'a': [1, 2]}
+    cache.Set('x', value)
+    value['a'].append(3)
+    self.assertEquals({'a': [1, 2]}, cache.Get('x'))
+    cache.Get('x')['a'].append(4)
+    self.assertEquals({'a': [1, 2]}, cache.Get('x'))
+    self.assertFalse(cache.Get('x') is cache.Get('x'))
+
+  def testFrozenMode(self):
+    cache = local_cache.LocalCache(mode=local_cache.FROZEN)
+    value = {'a': [1, {'b': 2}], 'c': set([3])}
+    cache.Set('x', value)
+    value['a'].append(3)
+    result = cache.Get('x')
+    self.assertEquals({'a': [1, {'b': 2}], 'c': set([3])}, result)
+    self.assertTrue(result is cache.Get('x'))  # no copying on a hit
+    self.assertRaises(TypeError, result.update, {})
+    self.assertRaises(TypeError, result['a'].append, 4)
+    self.assertRaises(TypeError, result['a'][1].__setitem__, 'b', 5)
+
+  def testSetModeOverridesCacheMode(self):
+    cache = local_cache.LocalCache(mode=local_cache.FROZEN)
+    cache.Set('x', [1], mode=local_cache.COPY)
+    cache.Get('x').append(2)
+    self.assertEquals([1], cache.Get('x'))
+
+  def testFreeze(self):
+    class Thing(object):
+      def __init__(self, items):
+        self.items = items
+    thing = Thing([1, 2])
+    frozen = local_cache.Freeze(thing)
+    self.assertFalse(frozen is thing)
+    self.assertEquals([1, 2], frozen.items)
+    self.assertRaises(TypeError, frozen.items.append, 3)
+    thing.items.append(3)  # the original is still mutable
+    self.assertEquals('abc', local_cache.Freeze('abc'))
+
+  def testFrozenValuesCanBeCopiedAndPickled(self):
+    frozen = local_cache.Freeze({'a': [1, 2]})
+    for protocol in [0, 2]:
+      self.assertEquals(frozen, pickle.loads(pickle.dumps(frozen, protocol)))
+    self.assertEquals(frozen, copy.deepcopy(frozen))
+
+  def testEstimateSize(self):
+    small = local_cache.EstimateSize({'a': 'x'})
+    big = local_cache.EstimateSize({'a': 'x' * 10000})
+    self.assertGreaterEqual(big - small, 10000 - 1)
+    shared = 'y' * 10000
+    self.assertLess(local_cache.EstimateSize([shared, shared]),
+                    local_cache.EstimateSize(shared) * 2)
+
+  def testByteAccounting(self):
+    cache = local_cache.LocalCache()
+    cache.Set('x', 'a' * 1000)
+    cache.Set('y', 'b' * 1000)
+    size = cache.GetStats()['bytes']
+    self.assertGreater(size, 2000)
+    cache.Set('x', 'a' * 3000)  # replacing an entry adjusts the total
+    self.assertEquals(size + 2000, cache.GetStats()['bytes'])
+    cache.Delete('x')
+    cache.Delete('y')
+    self.assertEquals({'entries': 0, 'bytes': 0, 'max_bytes': 0,
+                       'evictions': 0}, cache.GetStats())
+
+  def testLruEviction(self):
+    entry_size = local_cache.EstimateSize('a' * 1000)
+    cache = local_cache.LocalCache(max_bytes=entry_size * 3)
+    cache.Set('a', 'a' * 1000)
+    cache.Set('b', 'b' * 1000)
+    cache.Set('c', 'c' * 1000)
+    cache.Get('a')  # now 'b' is the least recently used, then 'c'
+    cache.Set('d', 'd' * 1000)
+
+    # Eviction frees up space down to 90% of the budget, so two entries go.
+    self.assertEquals(None, cache.Get('b'))
+    self.assertEquals(None, cache.Get('c'))
+    self.assertEquals('a' * 1000, cache.Get('a'))
+    self.assertEquals('d' * 1000, cache.Get('d'))
+    stats = cache.GetStats()
+    self.assertEquals(2, stats['evictions'])
+    self.assertEquals(entry_size * 2, stats['bytes'])
+
+  def testValueLargerThanBudgetIsNotStored(self):
+    cache = local_cache.LocalCache(max_bytes=1000)
+    cache.Set('x', 'small')
+    self.assertFalse(cache.Set('x', 'a' * 2000))
+    self.assertEquals(None, cache.Get('x'))
+    self.assertEquals(0, cache.GetStats()['bytes'])
+
+
+if __name__ == '__main__':
+  unittest.main()
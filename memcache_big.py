@@ -12,39 +12,143 @@
 """Wrap memcache to support caching things bigger than 1mb.
 
 This module wraps appengine memcache get/set/add/delete methods to do chunking.
-It pickles the value, and if it's longer than _CHUNK_SIZE_BYTES splits it into
-chunks of that size. It then sets the first key with a _CacheEntry header and
-the rest with keys that indicate their position. The remaining keys have an
-additional random component so that it is very very unlikely that you'll replace
-the previous entry and run into a race condition where you get half of the old
-value and half of the new value.
+It encodes the value (see _encode), and if the result is longer than
+_CHUNK_SIZE_BYTES splits it into chunks of that size. It then sets the first
+key with a _CacheEntry header and the rest with keys that indicate their
+position. The remaining keys have an additional random component so that it is
+very very unlikely that you'll replace the previous entry and run into a race
+condition where you get half of the old value and half of the new value.
+
+Encoded values start with a short header giving the format version and whether
+the payload (a binary pickle) is zlib-compressed.  Values written before the
+header was introduced are plain protocol-0 pickles, which can still be read.
 """
 
 
 
+import cPickle as pickle
+import cStringIO
 import logging
-import pickle
 import random
+import zlib
 
 from google.appengine.api import memcache
 
+# A client instance is needed for the asynchronous calls.
+_CLIENT = memcache.Client()
+
 
 _CHUNK_SIZE_BYTES = 980 * 1000  # 20,000 below memcache limit, needed for header
 _MAX_VALUE_SIZE = 16 * 1000 * 1000  # If you're above this, use something else.
 _WARN_VALUE_SIZE = _CHUNK_SIZE_BYTES  # Using multiple chunks should be rare
 _NAMESPACE = 'mcb'
 
+# An encoded value is _MAGIC, then a format version byte, then a flags byte,
+# then the payload.  A protocol-0 pickle never starts with a NUL byte, so the
+# magic string distinguishes encoded values from the old unversioned format.
+_MAGIC = '\0mcb'
+_HEADER_SIZE = len(_MAGIC) + 2
+_FORMAT_VERSION = 1
+_FLAG_ZLIB = 1  # the payload is zlib-compressed
+_PICKLE_PROTOCOL = 2
+# Don't bother compressing payloads smaller than this.
+_COMPRESS_MIN_BYTES = 1000
+_COMPRESS_LEVEL = 1  # fast; pickled text and JSON still shrink several-fold
+
 
 class _CacheEntry(object):
   """Stored for cache entries larger than 1mb, used to find remaining chunks."""
 
-  def __init__(self, value, num_chunks, rand):
+  def __init__(self, value, num_chunks, rand, checksum=None):
     self.value = value
     self.num_chunks = num_chunks
     self.rand = rand
+    self.checksum = checksum  # Adler-32 of all the chunks, in order
+
+  def __setstate__(self, state):
+    self.checksum = None  # entries pickled before checksums were added
+    self.__dict__.update(state)
 
   def __repr__(self):
-    return '_CacheEntry(%s, %s, %s)' % (self.value, self.num_chunks, self.rand)
+    return '_CacheEntry(%s, %s, %s, %s)' % (
+        self.value, self.num_chunks, self.rand, self.checksum)
+
+
+class _ChecksumError(Exception):
+  """The chunks of a value don't match the checksum in its first chunk."""
+
+
+class _GetMultiFuture(object):
+  """A pending get_multi_async result; call get_result() to get the values.
+
+  The first chunks of all the values are requested immediately.  As soon as
+  they arrive, the remaining chunks (for values that span several chunks) are
+  requested in a single batch.  This happens when get_result() is called, or
+  earlier if the app waits on any other RPC in the meantime, so the second
+  round trip can overlap with other work.
+  """
+
+  def __init__(self, keys):
+    self._keys = keys
+    self._chunk_fetch_started = False
+    self._heads = self._chunk_rpc = self._results = None
+    rpc = memcache.create_rpc(callback=self._StartChunkFetch)
+    self._head_rpc = _CLIENT.get_multi_async(
+        keys, namespace=_NAMESPACE, rpc=rpc)
+
+  def _StartChunkFetch(self):
+    """Collects the first chunks and starts fetching the remaining ones."""
+    if self._chunk_fetch_started:  # this can be reentered via the callback
+      return
+    self._chunk_fetch_started = True
+    self._heads = self._head_rpc.get_result() or {}
+    remain_keys = []
+    for key, value in self._heads.items():
+      if isinstance(value, _CacheEntry):  # more chunks to follow
+        # We already have the first part so don't need it again.
+        remain_keys += _keys(key, value.num_chunks, value.rand)[1:]
+    if remain_keys:
+      self._chunk_rpc = _CLIENT.get_multi_async(
+          remain_keys, namespace=_NAMESPACE)
+
+  def get_result(self):
+    """Waits for the values, returning a dictionary like memcache.get_multi."""
+    if self._results is None:
+      self._StartChunkFetch()  # no-op if the callback already did this
+      remain = self._chunk_rpc and self._chunk_rpc.get_result() or {}
+      self._results = {}
+      for key, value in self._heads.items():
+        if not value:
+          continue
+        if isinstance(value, _CacheEntry):
+          chunk_keys = _keys(key, value.num_chunks, value.rand)[1:]
+          if not all(k in remain for k in chunk_keys):
+            # One or more of the remaining ones missed, treat as a full miss.
+            continue
+          chunks = [value.value] + [remain[k] for k in chunk_keys]
+        else:
+          chunks = [value]
+        try:
+          self._results[key] = _decode_chunks(chunks, getattr(
+              value, 'checksum', None))
+        except _ChecksumError:
+          logging.warn('Chunks of value for key %s have a bad checksum; '
+                       'treating as a cache miss', key)
+        except Exception:  # pylint:disable=broad-except
+          logging.exception('Failed to decode value for key: %s, '
+                            'encoded len: %s', key, sum(map(len, chunks)))
+    return self._results
+
+
+class _GetFuture(object):
+  """A pending get_async result; call get_result() to get the value."""
+
+  def __init__(self, key):
+    self._key = key
+    self._future = _GetMultiFuture([key])
+
+  def get_result(self):
+    return self._future.get_result().get(self._key)
 
 
 def _key(key, i, rand):
@@ -57,23 +161,45 @@ def _keys(key, num, rand):
 
 def get(key):
   """Like memcache.get but supports values > 1mb."""
-  value = memcache.get(key, namespace=_NAMESPACE)
-  if not value:
-    return None
-  if isinstance(value, _CacheEntry):  # more chunks to follow
-    remain_keys = _keys(key, value.num_chunks, value.rand)
-    remain_keys.pop(0)  # We already have the first part so don't need it again.
-    remain = memcache.get_multi(remain_keys, namespace=_NAMESPACE)
-    if 1 + len(remain) < value.num_chunks:
-      # One or more of the remaining ones missed, treat as a full cache miss.
-      return None
-    value = ''.join([value.value] + [remain[k] for k in remain_keys])
-  try:
-    return pickle.loads(value)
-  except Exception:  # pylint:disable=broad-except
-    logging.exception('Failed to unpickle value for key: %s, pickled len: %s',
-                      key, len(value))
-    return None
+  return get_async(key).get_result()
+
+
+def get_async(key):
+  """Starts a get; returns an object whose get_result() method gets the value.
+
+  Args:
+    key: A string key.
+  Returns:
+    An object with a get_result() method that returns the value, or None if
+    the key isn't in memcache.
+  """
+  return _GetFuture(key)
+
+
+def get_multi(keys):
+  """Like memcache.get_multi but supports values > 1mb.
+
+  All the first chunks are fetched in one round trip, then the remaining
+  chunks of all the multi-chunk values are fetched in at most one more.
+
+  Args:
+    keys: A list of string keys.
+  Returns:
+    A dictionary of the keys that were found, mapped to their values.
+  """
+  return get_multi_async(keys).get_result()
+
+
+def get_multi_async(keys):
+  """Starts a get_multi; returns an object with a get_result() method.
+
+  Args:
+    keys: A list of string keys.
+  Returns:
+    An object whose get_result() method returns a dictionary of the keys that
+    were found, mapped to their values.
+  """
+  return _GetMultiFuture(keys)
 
 
 def delete(key):
@@ -84,16 +210,41 @@ def delete(key):
 
 def set(key, value, time=0):  # pylint:disable=redefined-builtin
   """Like memcache.set but supports values > 1mb."""
-  chunks = _chunks(key, value)
+  return not set_multi({key: value}, time=time)  # ie True if nothing failed.
+
+
+def set_multi(mapping, time=0):  # pylint:disable=redefined-builtin
+  """Like memcache.set_multi but supports values > 1mb.
+
+  Args:
+    mapping: A dictionary of keys to values.
+    time: The expiration time, as for memcache.set_multi.
+  Returns:
+    A list of the keys whose values could not be set.
+  """
+  chunks, owners = _chunks_multi(mapping)
   not_set = memcache.set_multi(chunks, time=time, namespace=_NAMESPACE)
-  return not not_set  # ie True if the list is empty.
+  return sorted({owners[k] for k in not_set})
 
 
 def add(key, value, time=0):
   """Like memcache.add but supports values > 1mb."""
-  chunks = _chunks(key, value)
+  return key not in add_multi({key: value}, time=time)
+
+
+def add_multi(mapping, time=0):
+  """Like memcache.add_multi but supports values > 1mb.
+
+  Args:
+    mapping: A dictionary of keys to values.
+    time: The expiration time, as for memcache.add_multi.
+  Returns:
+    A list of the keys that were already set and thus not added.
+  """
+  chunks, _ = _chunks_multi(mapping)
   not_added = memcache.add_multi(chunks, time=time, namespace=_NAMESPACE)
-  return key not in not_added
+  # Only the first chunk matters; the others have random, unique keys.
+  return [key for key in mapping if key in not_added]
 
 
 def flush_all():
@@ -101,9 +252,83 @@ def flush_all():
   return memcache.flush_all()
 
 
+def _encode(value):
+  """Serializes a value into a string with a versioned header."""
+  payload = pickle.dumps(value, _PICKLE_PROTOCOL)
+  flags = 0
+  if len(payload) >= _COMPRESS_MIN_BYTES:
+    compressed = zlib.compress(payload, _COMPRESS_LEVEL)
+    if len(compressed) < len(payload):  # e.g. KMZ files won't shrink further
+      payload, flags = compressed, flags | _FLAG_ZLIB
+  return _MAGIC + chr(_FORMAT_VERSION) + chr(flags) + payload
+
+
+def _decode(data):
+  """Deserializes a string produced by _encode or by the old pickle format.
+
+  Args:
+    data: The encoded string.
+  Returns:
+    The original value.
+  Raises:
+    ValueError: The data has an unknown format version.
+    Other exceptions: The data is corrupt.
+  """
+  if not data.startswith(_MAGIC):
+    return pickle.loads(data)  # unversioned format: a protocol-0 pickle
+  version, flags = ord(data[len(_MAGIC)]), ord(data[len(_MAGIC) + 1])
+  if version != _FORMAT_VERSION:
+    raise ValueError('Unknown memcache_big format version: %d' % version)
+  # Read the payload through a buffer to avoid copying it just to skip the
+  # header; cPickle reads directly from a cStringIO.
+  payload = buffer(data, _HEADER_SIZE)
+  if flags & _FLAG_ZLIB:
+    return pickle.loads(zlib.decompress(payload))
+  return pickle.load(cStringIO.StringIO(payload))
+
+
+def _decode_chunks(chunks, checksum=None):
+  """Verifies the checksum of a list of chunks, then decodes them.
+
+  Args:
+    chunks: The list of chunks of an encoded value, in order.
+    checksum: The Adler-32 checksum of the chunks, or None to skip the check.
+  Returns:
+    The original value.
+  Raises:
+    _ChecksumError: The chunks don't match the checksum (e.g. a chunk from a
+        different version of the value was read).
+  """
+  if checksum is not None:
+    actual = 1  # the Adler-32 initial value
+    for chunk in chunks:
+      actual = zlib.adler32(chunk, actual)
+    if actual & 0xffffffff != checksum:
+      raise _ChecksumError()
+  # The payload has to be contiguous for unpickling, so this is the one copy.
+  return _decode(chunks[0] if len(chunks) == 1 else ''.join(chunks))
+
+
+def _chunks_multi(mapping):
+  """Return a k,v pairing of the chunks of all the values in a mapping.
+
+  Args:
+    mapping: A dictionary of keys to values.
+  Returns:
+    A pair (chunks, owners), where chunks is a dictionary of chunk keys to
+    chunks and owners maps each chunk key back to its key in mapping.
+  """
+  chunks, owners = {}, {}
+  for key, value in mapping.items():
+    for chunk_key, chunk in _chunks(key, value).items():
+      chunks[chunk_key] = chunk
+      owners[chunk_key] = key
+  return chunks, owners
+
+
 def _chunks(key, value):
   """Return a k,v pairing of chunks."""
-  value = pickle.dumps(value)
+  value = _encode(value)
   if len(value) < _CHUNK_SIZE_BYTES:
     return {key: value}
 
@@ -117,8 +342,9 @@ def _chunks(key, value):
                  len(value), key)
 
   rand = random.getrandbits(30)
+  checksum = zlib.adler32(value) & 0xffffffff
   chunks = [value[i:i + _CHUNK_SIZE_BYTES]
             for i in xrange(0, len(value), _CHUNK_SIZE_BYTES)]
-  chunks[0] = _CacheEntry(chunks[0], len(chunks), rand)
+  chunks[0] = _CacheEntry(chunks[0], len(chunks), rand, checksum)
   keys = _keys(key, len(chunks), rand)
   return dict(zip(keys, chunks))
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# Copyright 2012 Google Inc.  All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License.  You may obtain a copy
+# of the License at: http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distrib-
+# uted under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, either express or implied.  See the License for
+# specific language governing permissions and limitations under the License.
+
+"""Tests for memcache_big.py."""
+
+import os
+import pickle
+
+import memcache_big
+import test_utils
+
+from google.appengine.api import memcache
+
+
+class MemcacheBigTest(test_utils.BaseTest):
+  """Tests the chunking memcache wrapper."""
+
+  def testSmallValue(self):
+    self.assertTrue(memcache_big.set('x', {'a': [1, 2]}))
+    self.assertEquals({'a': [1, 2]}, memcache_big.get('x'))
+    self.assertFalse(memcache_big.add('x', 3))
+    self.assertTrue(memcache_big.delete('x'))
+    self.assertEquals(None, memcache_big.get('x'))
+
+  def testCompressibleValueFitsInOneChunk(self):
+    value = ['<Placemark><name>%d</name></Placemark>' % i
+             for i in range(100000)]
+    self.assertGreater(len(pickle.dumps(value)),
+                       memcache_big._CHUNK_SIZE_BYTES)
+    chunks = memcache_big._chunks('x', value)
+    self.assertEquals(['x'], chunks.keys())
+    memcache_big.set('x', value)
+    self.assertEquals(value, memcache_big.get('x'))
+
+  def testIncompressibleValueIsChunked(self):
+    value = os.urandom(3 * memcache_big._CHUNK_SIZE_BYTES)
+    self.assertEquals(4, len(memcache_big._chunks('x', value)))
+    memcache_big.set('x', value)
+    self.assertEquals(value, memcache_big.get('x'))
+
+  def testMissingChunkIsACacheMiss(self):
+    value = os.urandom(2 * memcache_big._CHUNK_SIZE_BYTES)
+    chunks = memcache_big._chunks('x', value)
+    memcache.set_multi(chunks, namespace=memcache_big._NAMESPACE)
+    memcache.delete([k for k in chunks if k != 'x'][0],
+                    namespace=memcache_big._NAMESPACE)
+    self.assertEquals(None, memcache_big.get('x'))
+
+  def testTornReadIsACacheMiss(self):
+    value = os.urandom(2 * memcache_big._CHUNK_SIZE_BYTES)
+    chunks = memcache_big._chunks('x', value)
+    memcache.set_multi(chunks, namespace=memcache_big._NAMESPACE)
+    self.assertEquals(value, memcache_big.get('x'))
+
+    # Replace the last chunk with garbage of the same length.
+    last_key = [k for k in chunks if k != 'x' and k.startswith('2-')][0]
+    memcache.set(last_key, os.urandom(len(chunks[last_key])),
+                 namespace=memcache_big._NAMESPACE)
+    self.assertEquals(None, memcache_big.get('x'))
+
+  def testGetAsync(self):
+    big_value = os.urandom(2 * memcache_big._CHUNK_SIZE_BYTES)
+    memcache_big.set_multi({'a': 1, 'b': big_value})
+    future = memcache_big.get_async('a')
+    multi_future = memcache_big.get_multi_async(['a', 'b', 'c'])
+    self.assertEquals({'a': 1, 'b': big_value}, multi_future.get_result())
+    self.assertEquals(1, future.get_result())
+    self.assertEquals(None, memcache_big.get_async('c').get_result())
+
+  def testReadsUnversionedFormat(self):
+    # Values stored before the versioned header was added are bare pickles.
+    memcache.set('x', pickle.dumps({'a': 1}), namespace=memcache_big._NAMESPACE)
+    self.assertEquals({'a': 1}, memcache_big.get('x'))
+
+    # Multi-chunk values from before checksums were added have no checksum.
+    value = os.urandom(memcache_big._CHUNK_SIZE_BYTES)
+    pickled, size = pickle.dumps(value), memcache_big._CHUNK_SIZE_BYTES
+    parts = [pickled[i:i + size] for i in range(0, len(pickled), size)]
+    head = memcache_big._CacheEntry(parts[0], len(parts), 123)
+    del head.checksum
+    chunks = {'y': head}
+    chunks.update(('%d-123:y' % i, parts[i]) for i in range(1, len(parts)))
+    memcache.set_multi(chunks, namespace=memcache_big._NAMESPACE)
+    self.assertEquals(value, memcache_big.get('y'))
+
+  def testMulti(self):
+    self.assertEquals([], memcache_big.set_multi({'a': 1, 'b': 2}))
+    self.assertEquals(['a'], memcache_big.add_multi({'a': 3, 'c': 4}))
+    self.assertEquals({'a': 1, 'b': 2, 'c': 4},
+                      memcache_big.get_multi(['a', 'b', 'c', 'd']))
+
+
+if __name__ == '__main__':
+  test_utils.main()
@@ -75,15 +75,17 @@ def ActivateSources(sources):
   # skip activation if the same set of layers has been activated recently.
   if ACTIVATE_CACHE.Add(sources, 1):
     num_fetches = {}  # number of fetches, keyed by hostname
-    for address in sources:
-      if ACTIVE_CACHE.Add(address, 1):
+    added = ACTIVE_CACHE.AddMulti([(address, 1) for address in sources])
+    for address, was_added in zip(sources, added):
+      if was_added:
         logging.info('Activating layer: ' + address)
         hostname = maproot.GetHostnameForSource(address)
         num_fetches[hostname] = num_fetches.get(hostname, 0) + 1
         # Spread out the fetches to each origin server.  It's more polite.
         metadata_fetch.ScheduleFetch(address, num_fetches[hostname] * 0.25)
-      else:  # Extend the lifetime of the existing active flag.
-        ACTIVE_CACHE.Set(address, 1)
+    # Extend the lifetime of the existing active flags.
+    ACTIVE_CACHE.SetMulti([(address, 1) for address, was_added
+                           in zip(sources, added) if not was_added])
 
 
 class Metadata(base_handler.BaseHandler):
@@ -103,5 +105,5 @@ class Metadata(base_handler.BaseHandler):
     if sources:  # extend the lifetime of the cache entry
       SOURCE_ADDRESS_CACHE.Set(cache_key, sources)
     sources += self.request.get_all('source')
-    self.WriteJson({s: METADATA_CACHE.Get(s) for s in sources})
+    self.WriteJson(dict(zip(sources, METADATA_CACHE.GetMulti(sources))))
     ActivateSources(sources)
@@ -19,6 +19,7 @@ import json
 
 import cache
 import domains
+import local_cache
 import logs
 import perms
 import users
@@ -52,12 +53,15 @@ LISTED_CATALOG_CACHE = cache.Cache('model.listed_catalog', 300, 0.5)
 
 # MapRoot data for published maps, keyed by [domain, label].  The 500-ms ULL
 # is intended to beat the time it takes to manually navigate to a map after
-# the user hits Publish to update the map.
-PUBLISHED_MAP_ROOT_CACHE = cache.Cache('model.published_map_root', 300, 0.5)
+# the user hits Publish to update the map.  MapRoot dicts can be big and are
+# never modified by callers, so local hits share one frozen copy.
+PUBLISHED_MAP_ROOT_CACHE = cache.Cache('model.published_map_root', 300, 0.5,
+                                       local_mode=local_cache.FROZEN)
 
 # MapRoot data for maps, keyed by map ID.  The 500-ms ULL is intended to beat
 # the time it takes to manually reload a map page after saving edits.
-MAP_ROOT_CACHE = cache.Cache('model.map_root', 300, 0.5)
+MAP_ROOT_CACHE = cache.Cache('model.map_root', 300, 0.5,
+                             local_mode=local_cache.FROZEN)
 
 # Authorization entities are written offline, so users never expect to see
 # immediate effects.  The 1000-ms ULL is intended to beat the time it takes for
@@ -915,6 +919,20 @@ class _CrowdReportModel(ndb.Model):
     return 'CrowdReportModel'  # so we can name the Python class with a _
 
 
+def GetCrowdReportTag(full_topic_id):
+  """Gets the cache tag for data derived from the crowd reports in a topic.
+
+  Caches of such data (e.g. card.REPORT_CACHE) tag their entries with this, so
+  that new reports and changes to reports' hidden flags can invalidate them.
+
+  Args:
+    full_topic_id: A topic ID in the form map_id + '.' + topic_id.
+  Returns:
+    The tag, for use with cache.Cache.Get and cache.InvalidateTags.
+  """
+  return ['crowd_reports', full_topic_id]
+
+
 class CrowdReport(utils.Struct):
   """Application-level object representing a crowd report."""
   index = search.Index('CrowdReport')
@@ -1238,17 +1256,31 @@ class CrowdReport(utils.Struct):
              # Reviewer votes count 1000x user votes
              1000 * (reviewer_upvote_count - reviewer_downvote_count))
     hidden = score <= -2  # for now, two downvotes hide a report
-    cls.PutScoreForReport(
+    changed_topic_ids = cls.PutScoreForReport(
         report_id, upvote_count + reviewer_upvote_count,
         downvote_count + reviewer_downvote_count, score, hidden)
+    if changed_topic_ids:
+      # Cached answers include only unhidden reports, so they're now stale.
+      cache.InvalidateTags(*map(GetCrowdReportTag, changed_topic_ids))
 
   @classmethod
   @ndb.transactional
   def PutScoreForReport(
       cls, report_id, upvote_count, downvote_count, score, hidden):
-    """Atomically writes the voting stats on a report."""
+    """Atomically writes the voting stats on a report.
+
+    Args:
+      report_id: The ID of the report.
+      upvote_count: The number of upvotes.
+      downvote_count: The number of downvotes.
+      score: The score.
+      hidden: True if the report should be hidden.
+    Returns:
+      The report's topic IDs if its hidden flag changed, or else [].
+    """
     model = _CrowdReportModel.get_by_id(report_id)
     if model:
+      was_hidden = model.hidden
       model.upvote_count = upvote_count
       model.downvote_count = downvote_count
       model.score = score
@@ -1256,6 +1288,9 @@ class CrowdReport(utils.Struct):
       document = cls._CreateSearchDocument(model)
       model.put()
       cls.index.put(document)
+      if hidden != was_hidden:
+        return model.topic_ids
+    return []
 
 # Possible types of votes.  Each vote type is associated with a particular
 # weight, and some vote types are only available to privileged users.
@@ -14,6 +14,7 @@
 
 __author__ = 'lschumacher@google.com (Lee Schumacher)'
 
+import cache
 import copy
 import datetime
 import domains
@@ -558,7 +559,7 @@ class CrowdVoteTests(test_utils.BaseTest):
     self.assertEquals(None, votes.get(r3.id))
 
   def testUpdateScore(self):
-    r1 = test_utils.NewCrowdReport(text='hello')
+    r1 = test_utils.NewCrowdReport(text='hello', topic_ids=['m1.t1'])
 
     # Should increment the report's upvote_count.
     model.CrowdVote.Put(r1.id, 'voter1', 'ANONYMOUS_UP')
@@ -578,18 +579,26 @@ class CrowdVoteTests(test_utils.BaseTest):
     self.assertEquals(0, r1.upvote_count)
     self.assertEquals(0, r1.downvote_count)
 
-    # Two downvotes should hide the report.
+    # Two downvotes should hide the report and invalidate cached data
+    # derived from the reports in its topics.
+    c = cache.Cache('test', 300)
+    tags = map(model.GetCrowdReportTag, r1.topic_ids)
+    c.Set('a', 1, tags=tags)
     r1 = model.CrowdReport.Get(r1.id)
     self.assertFalse(r1.hidden)
     model.CrowdVote.Put(r1.id, 'voter1', 'ANONYMOUS_DOWN')
+    self.assertEquals(1, c.Get('a', tags=tags))  # not hidden yet
     model.CrowdVote.Put(r1.id, 'voter2', 'ANONYMOUS_DOWN')
     r1 = model.CrowdReport.Get(r1.id)
     self.assertTrue(r1.hidden)
+    self.assertEquals(None, c.Get('a', tags=tags))
 
     # Cancelling a downvote should unhide the report.
+    c.Set('a', 1, tags=tags)
     model.CrowdVote.Put(r1.id, 'voter2', None)
     r1 = model.CrowdReport.Get(r1.id)
     self.assertFalse(r1.hidden)
+    self.assertEquals(None, c.Get('a', tags=tags))
 
     model.CrowdVote.Put(r1.id, 'voter1', None)
     r1 = model.CrowdReport.Get(r1.id)
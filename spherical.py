@@ -19,6 +19,13 @@ module -- all that's needed are 'lat' and 'lon' attributes in degrees.
 import itertools
 import math
 
+# NumPy makes GetEarthDistances much faster, but is optional.
+# pylint: disable=g-import-not-at-top
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 atan, atan2, asin, cos, sin, sqrt, pi = (
     math.atan, math.atan2, math.asin, math.cos, math.sin, math.sqrt, math.pi)
 
@@ -252,6 +259,40 @@ def GetEarthDistance(a, b):
   return ToRadians(GetAngularDistance(a, b)) * EARTH_MEAN_RADIUS
 
 
+def GetEarthDistances(center, lats, lons, radius=EARTH_MEAN_RADIUS):
+  """Finds the great-circle distances in meters from a point to many points.
+
+  This is like calling GetEarthDistance once for each point, but the trig
+  for the center is done only once, and all the points are handled in one
+  vectorized pass when NumPy is available.
+
+  Args:
+    center: The point to measure from (with 'lat' and 'lon' attributes).
+    lats: A sequence of latitudes in degrees, such as a list or array.array.
+    lons: A sequence of longitudes in degrees, the same length as lats.
+    radius: The radius of the sphere, in meters.
+  Returns:
+    A list of the distances in meters, in the same order as the points.
+  """
+  # Haversine formula, as in GetAngularDistance.
+  c_lat, c_lon = ToRadians(center.lat), ToRadians(center.lon)
+  cos_c_lat = cos(c_lat)
+  if numpy:
+    lats = numpy.radians(numpy.asarray(lats, dtype=float))
+    lons = numpy.radians(numpy.asarray(lons, dtype=float))
+    a = (numpy.sin((lats - c_lat) / 2)**2 +
+         cos_c_lat * numpy.cos(lats) * numpy.sin((lons - c_lon) / 2)**2)
+    return (2 * radius * numpy.arctan2(
+        numpy.sqrt(a), numpy.sqrt(numpy.maximum(0, 1 - a)))).tolist()
+  distances = []
+  for lat, lon in itertools.izip(lats, lons):
+    lat, lon = lat * pi / 180, lon * pi / 180
+    a = (sin((lat - c_lat) / 2)**2 +
+         cos_c_lat * cos(lat) * sin((lon - c_lon) / 2)**2)
+    distances.append(2 * radius * atan2(sqrt(a), sqrt(max(0, 1 - a))))
+  return distances
+
+
 def GetLatitudeOnGreatCircle(a, b, longitude):
   """Computes the latitude where a given meridian intersects a great circle.
 
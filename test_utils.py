@@ -44,6 +44,7 @@ import webob
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_types
 from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
 from google.appengine.api.memcache import memcache_stub
 from google.appengine.ext import testbed
 
@@ -190,6 +191,17 @@ def NewCrowdReport(source='http://source.com/',
       location, map_id=map_id)
 
 
+class FakeRpc(object):
+  """A fake urlfetch RPC that calls a fetch function for its result."""
+
+  def __init__(self, fetch):
+    self.fetch = fetch
+    self.url = self.kwargs = None
+
+  def get_result(self):
+    return self.fetch(self.url, **self.kwargs)
+
+
 class BaseTest(unittest.TestCase):
   """Base Tests for appengine classes."""
 
@@ -324,12 +336,20 @@ class BaseTest(unittest.TestCase):
     path = task['url'][len(ROOT_PATH):]
     if task['method'] == 'POST':
       return self.DoPost(path, self.GetTaskBody(task))
-    return self.DoGet(path)
+    return self.DoGet(path, headers={
+        'X-AppEngine-QueueName': task.get('queue_name', 'default')})
 
   def SetForTest(self, parent, child_name, new_child):
     """Sets an attribute of an object, just for the duration of the test."""
     self.mox.stubs.Set(parent, child_name, new_child)
 
+  def StubFetch(self, fetch):
+    """Makes urlfetch RPCs get their responses from a function like fetch()."""
+    def MakeFetchCall(rpc, url, **kwargs):
+      rpc.url, rpc.kwargs = url, kwargs
+    self.mox.stubs.Set(urlfetch, 'create_rpc', lambda **_: FakeRpc(fetch))
+    self.mox.stubs.Set(urlfetch, 'make_fetch_call', MakeFetchCall)
+
   def SetTime(self, timestamp):
     """Sets a fake value for the current time, for the duration of the test."""
     self.SetForTest(time, 'time', lambda: timestamp)
@@ -21,6 +21,8 @@ of an XML document to or from a Python value.  The type and structure of
 the Python value is up to the Converter.
 """
 
+import StringIO
+
 # pylint:disable=g-import-not-at-top
 try:
   import xml.etree.cElementTree as ElementTree
@@ -92,6 +94,11 @@ def Read(fileobject):
   return ElementTree.parse(fileobject)
 
 
+def IterParse(string, events=('end',)):
+  """Parses XML from a string incrementally, yielding (event, element) pairs."""
+  return ElementTree.iterparse(StringIO.StringIO(string), events)
+
+
 # ==== Serializing and writing elements ====================================
 
 